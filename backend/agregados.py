@@ -0,0 +1,338 @@
+"""Agregados de lecturas por minuto, hora y día (tabla agregados_lecturas).
+
+Los reportes y estadísticas (/reportes/analitica, /reportes/dashboard,
+/admin/dashboard/stats y las estadísticas de cada sesión) contaban y
+promediaban recorriendo las tablas de lecturas. Ahora cada lote de la ingesta
+suma, en la misma transacción, sus lecturas a una fila por (período, usuario,
+sensor, inicio) con conteo, suma, suma de cuadrados, mínimo, máximo y conteo
+por estado, y las consultas leen esas filas: un rango se parte en minutos en
+los bordes, horas y días enteros en el medio (tramos()), así que un reporte de
+30 días cuesta lo mismo que uno de una hora.
+
+Cada lectura cuenta una vez por usuario destinatario, con su momento real
+(no el de la racha de banda muerta que la guarda), en cualquiera de los dos
+modos de almacenamiento. La resolución es de un minuto: los bordes de un
+rango se redondean al minuto que los contiene.
+
+Los datos anteriores a esta tabla se cargan una vez con
+    python agregados.py reconstruir
+(con la ingesta detenida: la reconstrucción borra y vuelve a sumar).
+"""
+import argparse
+import math
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func, or_
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.orm import Session
+
+import models
+
+PERIODOS = ("minuto", "hora", "dia")
+ESTADOS = ("bueno", "advertencia", "malo")
+SENSORES = ("mq135", "mq4", "mq7")
+
+# Cubeta en memoria: [conteo, suma, suma_cuadrados, minimo, maximo, n_bueno, n_advertencia, n_malo]
+_POSICION_ESTADO = {e: 5 + i for i, e in enumerate(ESTADOS)}
+
+
+def _inicio(momento: datetime, periodo: str) -> datetime:
+    if periodo == "minuto":
+        return momento.replace(second=0, microsecond=0)
+    if periodo == "hora":
+        return momento.replace(minute=0, second=0, microsecond=0)
+    return momento.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _techo(momento: datetime, periodo: str) -> datetime:
+    inicio = _inicio(momento, periodo)
+    if inicio == momento:
+        return inicio
+    return inicio + {"minuto": timedelta(minutes=1), "hora": timedelta(hours=1), "dia": timedelta(days=1)}[periodo]
+
+
+def _sin_tz(momento):
+    return momento.astimezone().replace(tzinfo=None) if momento is not None and momento.tzinfo else momento
+
+
+def acumular(cubetas: dict, momento: datetime, valor: float, estado: str, n: int = 1):
+    """Suma n lecturas de valor en la cubeta de su minuto (cubetas: minuto -> lista)."""
+    minuto = momento.replace(second=0, microsecond=0)
+    c = cubetas.get(minuto)
+    if c is None:
+        c = cubetas[minuto] = [0, 0.0, 0.0, valor, valor, 0, 0, 0]
+    c[0] += n
+    c[1] += valor * n
+    c[2] += valor * valor * n
+    if valor < c[3]:
+        c[3] = valor
+    if valor > c[4]:
+        c[4] = valor
+    c[_POSICION_ESTADO[estado]] += n
+
+
+def repartir(cubetas: dict, inicio: datetime, fin: datetime | None, valor: float, estado: str, n: int = 1):
+    """acumular() de una racha de banda muerta: n lecturas a intervalos iguales entre inicio y fin.
+
+    Es el mismo reparto que mediciones.salida(expandir=True); sin fin (o con
+    una sola lectura) todas caen en el minuto de inicio.
+    """
+    if n <= 1 or fin is None or fin <= inicio:
+        acumular(cubetas, inicio, valor, estado, n)
+        return
+    paso = (fin - inicio) / (n - 1)
+    for i in range(n):
+        acumular(cubetas, inicio + paso * i, valor, estado)
+
+
+def _combinar(destino: list, origen: list):
+    destino[0] += origen[0]
+    destino[1] += origen[1]
+    destino[2] += origen[2]
+    destino[3] = min(destino[3], origen[3])
+    destino[4] = max(destino[4], origen[4])
+    for i in (5, 6, 7):
+        destino[i] += origen[i]
+
+
+def guardar(db: Session, grupos):
+    """Suma a agregados_lecturas los grupos [(usuario_id, sensor_codigo, cubetas por minuto)].
+
+    Cada minuto se acumula también en su hora y su día. Es un upsert
+    executemany en orden de clave (siempre el mismo orden de bloqueo entre
+    transacciones concurrentes). No hace commit.
+    """
+    filas = {}
+    for usuario_id, sensor_codigo, cubetas in grupos:
+        for minuto, c in cubetas.items():
+            for periodo in PERIODOS:
+                clave = (periodo, usuario_id, sensor_codigo, _inicio(minuto, periodo))
+                actual = filas.get(clave)
+                if actual is None:
+                    filas[clave] = list(c)
+                else:
+                    _combinar(actual, c)
+    if not filas:
+        return
+    _upsert(db, [
+        {
+            "periodo": periodo, "usuario_id": usuario_id, "sensor_codigo": sensor_codigo, "inicio": inicio,
+            "conteo": c[0], "suma": c[1], "suma_cuadrados": c[2], "minimo": c[3], "maximo": c[4],
+            "n_bueno": c[5], "n_advertencia": c[6], "n_malo": c[7],
+        }
+        for (periodo, usuario_id, sensor_codigo, inicio), c in sorted(filas.items(), key=lambda f: f[0])
+    ])
+
+
+def _upsert(db: Session, filas: list):
+    t = models.AgregadoLectura.__table__
+    if db.get_bind().dialect.name == "mysql":
+        stmt = mysql.insert(t)
+        stmt = stmt.on_duplicate_key_update(**_sumas(t, stmt.inserted, func.least, func.greatest))
+    else:
+        # SQLite (desarrollo): ON CONFLICT; min() y max() con dos argumentos son escalares
+        stmt = sqlite.insert(t)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["periodo", "usuario_id", "sensor_codigo", "inicio"],
+            set_=_sumas(t, stmt.excluded, func.min, func.max),
+        )
+    db.execute(stmt, filas)
+
+
+def _sumas(t, nuevo, menor, mayor) -> dict:
+    return {
+        "conteo": t.c.conteo + nuevo.conteo,
+        "suma": t.c.suma + nuevo.suma,
+        "suma_cuadrados": t.c.suma_cuadrados + nuevo.suma_cuadrados,
+        "minimo": menor(t.c.minimo, nuevo.minimo),
+        "maximo": mayor(t.c.maximo, nuevo.maximo),
+        "n_bueno": t.c.n_bueno + nuevo.n_bueno,
+        "n_advertencia": t.c.n_advertencia + nuevo.n_advertencia,
+        "n_malo": t.c.n_malo + nuevo.n_malo,
+    }
+
+
+def descontar(db: Session, usuario_id: int, sensor_codigo: str, valor: float, estado: str, momento: datetime, n: int = 1, ultimo_en: datetime | None = None):
+    """Resta una fila de lectura borrada de sus agregados.
+
+    Una racha (n lecturas entre momento y ultimo_en) se resta repartida como
+    en repartir(), minuto por minuto y en las horas y días que abarca. El
+    mínimo y el máximo no se pueden deshacer y quedan como estaban.
+    """
+    A = models.AgregadoLectura
+    cubetas = {}
+    repartir(cubetas, _sin_tz(momento), _sin_tz(ultimo_en), valor, estado, n)
+    restas = {}
+    for minuto, c in cubetas.items():
+        for periodo in PERIODOS:
+            clave = (periodo, _inicio(minuto, periodo))
+            restas[clave] = restas.get(clave, 0) + c[0]
+    columna_estado = getattr(A, f"n_{estado}")
+    for (periodo, inicio), m in sorted(restas.items(), key=lambda r: (PERIODOS.index(r[0][0]), r[0][1])):
+        db.query(A).filter(
+            A.periodo == periodo,
+            A.usuario_id == usuario_id,
+            A.sensor_codigo == sensor_codigo,
+            A.inicio == inicio,
+        ).update({
+            A.conteo: A.conteo - m,
+            A.suma: A.suma - valor * m,
+            A.suma_cuadrados: A.suma_cuadrados - valor * valor * m,
+            columna_estado: columna_estado - m,
+        }, synchronize_session=False)
+
+
+# ----------- CONSULTAS -----------
+
+def tramos(desde: datetime | None, hasta: datetime | None) -> list[tuple]:
+    """Parte [desde, hasta) en [(periodo, inicio_desde | None, inicio_hasta)] alineados.
+
+    desde se redondea al minuto que lo contiene y hasta al minuto siguiente;
+    sin desde se toma todo lo anterior y sin hasta, hasta el final de hoy.
+    """
+    a = _inicio(_sin_tz(desde), "minuto") if desde is not None else None
+    b = _techo(_sin_tz(hasta), "minuto") if hasta is not None else _inicio(datetime.now(), "dia") + timedelta(days=1)
+    if a is not None and a >= b:
+        return []
+    resultado = []
+    # Minutos hasta la primera hora entera, horas hasta el primer día entero, y simétrico al final
+    h1 = _techo(a, "hora") if a is not None else None
+    h2 = _inicio(b, "hora")
+    if h1 is not None and h1 >= h2:
+        return [("minuto", a, b)]
+    d1 = _techo(h1, "dia") if h1 is not None else None
+    d2 = _inicio(h2, "dia")
+    if a is not None and a < h1:
+        resultado.append(("minuto", a, h1))
+    if d1 is None or d1 < d2:
+        if d1 is not None and h1 < d1:
+            resultado.append(("hora", h1, d1))
+        resultado.append(("dia", d1, d2))
+        if d2 < h2:
+            resultado.append(("hora", d2, h2))
+    else:
+        resultado.append(("hora", h1, h2))
+    if h2 < b:
+        resultado.append(("minuto", h2, b))
+    return resultado
+
+
+def consulta_resumen(db: Session, desde: datetime | None, hasta: datetime | None, usuario_id: int | None, sensores):
+    """Query agrupada por sensor de resumen() (None si el rango o los sensores están vacíos)."""
+    A = models.AgregadoLectura
+    partes = tramos(desde, hasta)
+    if not partes or not sensores:
+        return None
+    condiciones = [
+        and_(A.periodo == periodo, A.inicio < fin, *([A.inicio >= inicio] if inicio is not None else []))
+        for periodo, inicio, fin in partes
+    ]
+    q = db.query(
+        A.sensor_codigo,
+        func.sum(A.conteo), func.sum(A.suma), func.sum(A.suma_cuadrados), func.min(A.minimo), func.max(A.maximo),
+        func.sum(A.n_bueno), func.sum(A.n_advertencia), func.sum(A.n_malo),
+    ).filter(or_(*condiciones), A.sensor_codigo.in_(list(sensores)))
+    if usuario_id is not None:
+        q = q.filter(A.usuario_id == usuario_id)
+    return q.group_by(A.sensor_codigo)
+
+
+def resumen(db: Session, desde: datetime | None = None, hasta: datetime | None = None, usuario_id: int | None = None, sensores=SENSORES) -> dict:
+    """sensor -> {conteo, promedio, desviacion, minimo, maximo, bueno, advertencia, malo} en el rango.
+
+    Sin usuario_id suma todos los usuarios (cada lectura cuenta una vez por
+    destinatario, como en las tablas de lecturas).
+    """
+    resultado = {s: _vacio() for s in sensores}
+    q = consulta_resumen(db, desde, hasta, usuario_id, sensores)
+    if q is None:
+        return resultado
+    for sensor_codigo, conteo, suma, suma_cuadrados, minimo, maximo, bueno, advertencia, malo in q:
+        conteo = int(conteo or 0)
+        if not conteo:
+            continue
+        promedio = suma / conteo
+        resultado[sensor_codigo] = {
+            "conteo": conteo,
+            "promedio": round(promedio, 2),
+            "desviacion": round(math.sqrt(max(suma_cuadrados / conteo - promedio * promedio, 0.0)), 2),
+            "minimo": minimo,
+            "maximo": maximo,
+            "bueno": int(bueno or 0),
+            "advertencia": int(advertencia or 0),
+            "malo": int(malo or 0),
+        }
+    return resultado
+
+
+def _vacio() -> dict:
+    return {"conteo": 0, "promedio": None, "desviacion": None, "minimo": None, "maximo": None, "bueno": 0, "advertencia": 0, "malo": 0}
+
+
+# ----------- RECONSTRUCCIÓN -----------
+
+def reconstruir(db: Session, desde: datetime | None = None, lote: int = 5000) -> int:
+    """Vuelve a calcular los agregados desde las tablas de lecturas (desde el día de desde).
+
+    Recorre las lecturas de cada usuario y sensor con mediciones.consulta_lecturas
+    (sirve para los dos modos). Una racha de banda muerta se reparte entre
+    creado_en y ultimo_en (repartir()): las lecturas intermedias no guardan su
+    momento real. Devuelve cuántas filas de lectura se procesaron.
+    """
+    import mediciones
+
+    A = models.AgregadoLectura
+    if desde is not None:
+        desde = _inicio(_sin_tz(desde), "dia")
+    borrar = db.query(A)
+    if desde is not None:
+        borrar = borrar.filter(A.inicio >= desde)
+    borrar.delete(synchronize_session=False)
+
+    total = 0
+    for (usuario_id,) in db.query(models.Usuario.id).order_by(models.Usuario.id).all():
+        for sensor_codigo in SENSORES:
+            query, tabla = mediciones.consulta_lecturas(db, usuario_id, sensor_codigo)
+            if desde is not None:
+                # Una racha empezada antes de desde aporta sus lecturas desde desde en adelante
+                query = query.filter(mediciones.fin_racha(tabla) >= desde)
+            cubetas = {}
+            for fila in query.order_by(tabla.creado_en).yield_per(lote):
+                if fila.creado_en is None:
+                    continue
+                repartir(
+                    cubetas, _sin_tz(fila.creado_en), _sin_tz(fila.ultimo_en), fila.valor,
+                    getattr(fila.estado, "value", str(fila.estado)), fila.conteo or 1,
+                )
+                total += 1
+            if desde is not None:
+                cubetas = {m: c for m, c in cubetas.items() if m >= desde}
+            guardar(db, [(usuario_id, sensor_codigo, cubetas)])
+        db.commit()
+    return total
+
+
+def estado(db: Session) -> dict:
+    A = models.AgregadoLectura
+    return {p: n for p, n in db.query(A.periodo, func.count(A.id)).group_by(A.periodo).all()}
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Agregados de lecturas por minuto, hora y día")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    p_reconstruir = sub.add_parser("reconstruir", help="Recalcular los agregados desde las tablas de lecturas")
+    p_reconstruir.add_argument("--desde", help="Fecha ISO; por defecto, todo el historial")
+    sub.add_parser("estado", help="Filas de agregados por período")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.comando == "reconstruir":
+            n = reconstruir(db, datetime.fromisoformat(args.desde) if args.desde else None)
+            print(f"Agregados reconstruidos a partir de {n} filas de lectura")
+        elif args.comando == "estado":
+            print(estado(db))
+    finally:
+        db.close()
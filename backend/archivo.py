@@ -0,0 +1,297 @@
+"""Archivo frío en Parquet de las lecturas que vence la retención.
+
+Con ARCHIVO_LECTURAS=1, retencion.py no solo borra las filas vencidas de
+lecturas_mq135/mq4/mq7: antes de borrar cada tramo las escribe (y hace fsync)
+en ARCHIVO_DIR (obligatorio, en un volumen persistente: sin él la aplicación
+no arranca), particionadas por sensor y mes de creado_en:
+
+    archivo/sensor=mq135/mes=2026-09/parte-<ns>.parquet    (un archivo por tramo)
+    archivo/sensor=mq135/mes=2026-09/lecturas.parquet      (mes compactado)
+
+Al final de cada pasada, los meses ya cerrados (todo el mes antes del
+horizonte) o con muchas partes se compactan en un solo lecturas.parquet
+ordenado por (usuario_id, creado_en), con zstd y grupos de filas chicos para
+que los filtros por usuario y fecha salten grupos enteros.
+
+/reportes/me y /lecturas/admin leen el archivo cuando el rango pedido empieza
+antes del horizonte de retención (o no tiene inicio): pyarrow.dataset poda las
+particiones de sensor y mes y empuja los filtros de usuario, fecha y estado a
+las estadísticas de cada grupo de filas. Los resultados se unen con los de la
+BD (una fila está en uno u otro lado; si una compactación se cortó a medias,
+se descartan ids repetidos). Una racha de banda muerta se encuentra por el
+mes de su creado_en. Las mediciones de LECTURAS_UNICAS no se archivan.
+
+Cada worker corre la retención: la compactación se serializa entre procesos
+con un flock sobre ARCHIVO_DIR/.compactar.lock.
+
+Inspección y compactación manual:
+    python archivo.py estado
+    python archivo.py compactar
+"""
+import argparse
+import fcntl
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from deadband import DEADBAND_RACHA_MAX_SEGUNDOS
+
+ARCHIVO_LECTURAS = os.getenv("ARCHIVO_LECTURAS", "0") == "1"
+ARCHIVO_DIR = os.getenv("ARCHIVO_DIR")   # obligatorio con ARCHIVO_LECTURAS=1 (volumen persistente)
+ARCHIVO_PARTES_MAX = int(os.getenv("ARCHIVO_PARTES_MAX", "32"))   # partes de un mes abierto antes de compactarlas
+
+COLUMNAS = ("id", "usuario_id", "valor", "estado", "creado_en", "conteo", "ultimo_en")
+ESQUEMA = pa.schema([
+    ("id", pa.int64()),
+    ("usuario_id", pa.int64()),
+    ("valor", pa.float64()),
+    ("estado", pa.string()),
+    ("creado_en", pa.timestamp("us")),
+    ("conteo", pa.int32()),
+    ("ultimo_en", pa.timestamp("us")),
+])
+_PARTICION_MES = ds.partitioning(pa.schema([("mes", pa.string())]), flavor="hive")
+_GRUPO_FILAS = 64 * 1024
+_COMPACTADO = "lecturas.parquet"
+
+_lock = threading.Lock()
+
+# Lo archivado es la única copia de lo que borró la retención: no puede caer en un directorio efímero
+if ARCHIVO_LECTURAS and not ARCHIVO_DIR:
+    raise RuntimeError("ARCHIVO_LECTURAS=1 requiere ARCHIVO_DIR en un volumen persistente")
+
+
+class Fila:
+    """Lectura archivada con la misma forma que las filas de mediciones.consulta_lecturas."""
+
+    __slots__ = COLUMNAS
+
+    def __init__(self, d: dict):
+        for c in COLUMNAS:
+            setattr(self, c, d[c])
+
+
+def _mes(momento: datetime) -> str:
+    return momento.strftime("%Y-%m")
+
+
+def _dir_mes(sensor_codigo: str, mes: str) -> str:
+    return os.path.join(ARCHIVO_DIR, f"sensor={sensor_codigo}", f"mes={mes}")
+
+
+@contextmanager
+def _compactando():
+    """Excluye otras compactaciones: de este proceso (_lock) y de otros workers (flock en ARCHIVO_DIR)."""
+    with _lock:
+        os.makedirs(ARCHIVO_DIR, exist_ok=True)
+        with open(os.path.join(ARCHIVO_DIR, ".compactar.lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _escribir(tabla: pa.Table, ruta: str):
+    """Escribe a un temporal, fsync y renombra: el archivo final nunca queda a medias."""
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    with open(temporal, "wb") as f:
+        pq.write_table(tabla, f, compression="zstd", row_group_size=_GRUPO_FILAS)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporal, ruta)
+
+
+def guardar(sensor_codigo: str, filas: list):
+    """Archiva filas de lecturas_<sensor> (id, usuario_id, valor, estado, creado_en, conteo, ultimo_en).
+
+    Lo llama retencion.py antes de borrarlas; si falla, el tramo no se borra.
+    """
+    por_mes = {}
+    for f in filas:
+        por_mes.setdefault(_mes(f.creado_en), []).append({
+            "id": f.id,
+            "usuario_id": f.usuario_id,
+            "valor": f.valor,
+            "estado": getattr(f.estado, "value", str(f.estado)),
+            "creado_en": f.creado_en,
+            "conteo": f.conteo or 1,
+            "ultimo_en": f.ultimo_en,
+        })
+    with _lock:
+        for mes, registros in por_mes.items():
+            ruta = os.path.join(_dir_mes(sensor_codigo, mes), f"parte-{time.time_ns()}-{os.getpid()}.parquet")
+            _escribir(pa.Table.from_pylist(registros, schema=ESQUEMA), ruta)
+
+
+def _meses(sensor_codigo: str) -> list[str]:
+    base = os.path.join(ARCHIVO_DIR, f"sensor={sensor_codigo}")
+    if not os.path.isdir(base):
+        return []
+    return sorted(d.split("=", 1)[1] for d in os.listdir(base) if d.startswith("mes="))
+
+
+def _archivos(directorio: str) -> list[str]:
+    return sorted(
+        os.path.join(directorio, n) for n in os.listdir(directorio) if n.endswith(".parquet")
+    ) if os.path.isdir(directorio) else []
+
+
+def compactar(horizonte: datetime | None = None, forzar: bool = False) -> int:
+    """Une las partes de cada mes cerrado (o con ARCHIVO_PARTES_MAX partes) en lecturas.parquet.
+
+    Un mes está cerrado cuando el horizonte ya pasó su final. Cada worker
+    corre su retención, así que la pasada completa va bajo un flock: otro
+    proceso que compactara el mismo mes a la vez podría pisar el
+    lecturas.parquet con uno sin las partes que este ya borró. Devuelve cuántos
+    meses se compactaron.
+    """
+    compactados = 0
+    with _compactando():
+        for sensor_codigo in ("mq135", "mq4", "mq7"):
+            for mes in _meses(sensor_codigo):
+                directorio = _dir_mes(sensor_codigo, mes)
+                archivos = _archivos(directorio)
+                partes = [a for a in archivos if os.path.basename(a) != _COMPACTADO]
+                if not partes:
+                    continue
+                cerrado = horizonte is not None and _mes(horizonte) > mes
+                if not (forzar or cerrado or len(partes) >= ARCHIVO_PARTES_MAX):
+                    continue
+                tabla = pa.concat_tables([pq.read_table(a, schema=ESQUEMA) for a in archivos])
+                tabla = _sin_repetidos(tabla).sort_by([("usuario_id", "ascending"), ("creado_en", "ascending")])
+                _escribir(tabla, os.path.join(directorio, _COMPACTADO))
+                for a in partes:
+                    os.remove(a)
+                compactados += 1
+    return compactados
+
+
+def _sin_repetidos(tabla: pa.Table) -> pa.Table:
+    ids = tabla.column("id").to_pylist()
+    if len(set(ids)) == len(ids):
+        return tabla
+    vistos, indices = set(), []
+    for i, id_ in enumerate(ids):
+        if id_ not in vistos:
+            vistos.add(id_)
+            indices.append(i)
+    return tabla.take(indices)
+
+
+# ----------- CONSULTAS -----------
+
+def aplica(desde: datetime | None, horizonte: datetime | None) -> bool:
+    """Si un rango que empieza en desde puede tener lecturas archivadas."""
+    return ARCHIVO_LECTURAS and horizonte is not None and (desde is None or desde < horizonte)
+
+
+def leer(sensor_codigo: str, usuario_id: int | None = None, desde: datetime | None = None, hasta: datetime | None = None, estados=None, limite: int | None = None) -> list[Fila]:
+    """Lecturas archivadas del sensor, de la más reciente a la más antigua.
+
+    Mismos filtros que /reportes/me: la racha termina en o después de desde
+    (ultimo_en o creado_en) y empieza en o antes de hasta.
+    """
+    directorio = os.path.join(ARCHIVO_DIR, f"sensor={sensor_codigo}")
+    if not os.path.isdir(directorio):
+        return []
+    filtro = None
+
+    def y(expresion):
+        nonlocal filtro
+        filtro = expresion if filtro is None else filtro & expresion
+
+    # Particiones (poda de directorios); una racha está en el mes de su creado_en,
+    # que puede ser hasta DEADBAND_RACHA_MAX_SEGUNDOS antes de desde
+    if desde is not None:
+        y(ds.field("mes") >= _mes(desde - timedelta(seconds=DEADBAND_RACHA_MAX_SEGUNDOS)))
+    if hasta is not None:
+        y(ds.field("mes") <= _mes(hasta))
+    # Filas (estadísticas de cada grupo de filas)
+    if usuario_id is not None:
+        y(ds.field("usuario_id") == usuario_id)
+    if desde is not None:
+        y((ds.field("creado_en") >= pa.scalar(desde, pa.timestamp("us"))) | (ds.field("ultimo_en") >= pa.scalar(desde, pa.timestamp("us"))))
+    if hasta is not None:
+        y(ds.field("creado_en") <= pa.scalar(hasta, pa.timestamp("us")))
+    if estados is not None:
+        y(ds.field("estado").isin([getattr(e, "value", str(e)) for e in estados]))
+
+    for intento in (1, 2):
+        try:
+            with _lock:
+                dataset = ds.dataset(directorio, format="parquet", partitioning=_PARTICION_MES, schema=ESQUEMA.append(pa.field("mes", pa.string())))
+                tabla = dataset.to_table(columns=list(COLUMNAS), filter=filtro)
+            break
+        except FileNotFoundError:
+            # Otro proceso compactó el mes entre el listado y la lectura
+            if intento == 2:
+                raise
+    if limite:
+        # Las más recientes primero; el resto no se convierte a Python
+        tabla = tabla.sort_by([("creado_en", "descending"), ("id", "descending")]).slice(0, limite * 2)
+    filas = [Fila(d) for d in _sin_repetidos(tabla).to_pylist()]
+    filas.sort(key=lambda f: (f.creado_en, f.id), reverse=True)
+    return filas[:limite] if limite else filas
+
+
+def completar(filas: list, horizonte: datetime | None, sensor_codigo: str, usuario_id: int | None = None, desde: datetime | None = None, hasta: datetime | None = None, estados=None, limite: int | None = None) -> list:
+    """Agrega a las filas de la BD (ya ordenadas de la más reciente a la más antigua) las archivadas del rango."""
+    desde, hasta = _sin_tz(desde), _sin_tz(hasta)
+    if not aplica(desde, horizonte):
+        return filas
+    # Si la BD ya llenó el límite con lecturas posteriores al horizonte, el archivo no aporta
+    if limite and len(filas) >= limite and _sin_tz(filas[limite - 1].creado_en) >= horizonte:
+        return filas
+    archivadas = leer(sensor_codigo, usuario_id, desde, hasta, estados, limite)
+    if not archivadas:
+        return filas
+    ids = {f.id for f in filas}
+    todas = filas + [f for f in archivadas if f.id not in ids]
+    todas.sort(key=lambda f: (_sin_tz(f.creado_en), f.id), reverse=True)
+    return todas[:limite] if limite else todas
+
+
+def _sin_tz(momento):
+    return momento.astimezone().replace(tzinfo=None) if momento is not None and momento.tzinfo else momento
+
+
+def estado() -> dict:
+    resultado = {"habilitado": ARCHIVO_LECTURAS, "directorio": ARCHIVO_DIR, "sensores": {}}
+    if not ARCHIVO_DIR:
+        return resultado
+    for sensor_codigo in ("mq135", "mq4", "mq7"):
+        meses = {}
+        for mes in _meses(sensor_codigo):
+            archivos = _archivos(_dir_mes(sensor_codigo, mes))
+            meses[mes] = {
+                "archivos": len(archivos),
+                "filas": sum(pq.ParquetFile(a).metadata.num_rows for a in archivos),
+                "bytes": sum(os.path.getsize(a) for a in archivos),
+            }
+        resultado["sensores"][sensor_codigo] = meses
+    return resultado
+
+
+if __name__ == "__main__":
+    import json
+
+    parser = argparse.ArgumentParser(description="Archivo Parquet de lecturas vencidas")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    sub.add_parser("estado", help="Meses archivados por sensor (archivos, filas, bytes)")
+    sub.add_parser("compactar", help="Unir ya las partes de cada mes en un solo archivo")
+    args = parser.parse_args()
+    if not ARCHIVO_DIR:
+        parser.error("falta ARCHIVO_DIR")
+
+    if args.comando == "estado":
+        print(json.dumps(estado(), indent=2))
+    elif args.comando == "compactar":
+        print(f"{compactar(forzar=True)} meses compactados")
@@ -0,0 +1,72 @@
+"""Compara el costo de parseo de /lecturas/device: JSON (Pydantic) vs formato binario.
+
+Uso (desde backend/):
+    python bench/bench_formato_binario.py [--lecturas 500] [--repeticiones 200]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import formato_binario  # noqa: E402
+import schemas  # noqa: E402
+
+RANGOS = {"mq135": (50, 1500), "mq4": (100, 6000), "mq7": (0, 60)}
+
+
+def generar(n: int) -> list[tuple]:
+    codigos = list(RANGOS)
+    return [(c, round(random.uniform(*RANGOS[c]), 2)) for c in (codigos[i % 3] for i in range(n))]
+
+
+def parsear_json(cuerpo: bytes) -> list[tuple]:
+    data = schemas.LecturaCreateDevice.model_validate_json(cuerpo)
+    return [(l.sensor_codigo, l.valor, l.estado.value) for l in data.lecturas]
+
+
+def medir(funcion, cuerpo: bytes, repeticiones: int) -> float:
+    inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        funcion(cuerpo)
+    return time.perf_counter() - inicio
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lecturas", type=int, default=500, help="lecturas por petición")
+    parser.add_argument("--repeticiones", type=int, default=200)
+    args = parser.parse_args()
+
+    lecturas = generar(args.lecturas)
+    ahora = time.time()
+    cuerpos = {
+        "json": json.dumps({"lecturas": [
+            {"sensor_codigo": c, "valor": v, "estado": "bueno"} for c, v in lecturas
+        ]}).encode(),
+        "binario": formato_binario.codificar(lecturas),
+        "binario+ts": formato_binario.codificar([(c, v, ahora) for c, v in lecturas], con_timestamp=True),
+    }
+    funciones = {"json": parsear_json, "binario": formato_binario.decodificar, "binario+ts": formato_binario.decodificar}
+
+    resultados = {}
+    for nombre, cuerpo in cuerpos.items():
+        segundos = medir(funciones[nombre], cuerpo, args.repeticiones)
+        total = args.lecturas * args.repeticiones
+        resultados[nombre] = {
+            "bytes_por_peticion": len(cuerpo),
+            "bytes_por_lectura": round(len(cuerpo) / args.lecturas, 2),
+            "lecturas_por_seg": round(total / segundos),
+            "us_por_peticion": round(segundos / args.repeticiones * 1e6, 1),
+        }
+    base = resultados["json"]["lecturas_por_seg"]
+    for r in resultados.values():
+        r["vs_json"] = round(r["lecturas_por_seg"] / base, 2)
+    print(json.dumps({"lecturas": args.lecturas, "repeticiones": args.repeticiones, "resultados": resultados}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
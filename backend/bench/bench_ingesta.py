@@ -0,0 +1,243 @@
+"""Mide cuántas lecturas por segundo sostiene /lecturas/device con una flota simulada de ESP32.
+
+Levanta la API con uvicorn contra una BD SQLite temporal (o la URL de --db, que
+debe ser una BD vacía y desechable), crea N usuarios con sensores asignados y
+activos, y lanza M placas que envían lotes con valores realistas de MQ-135,
+MQ-4 y MQ-7. Reporta lecturas/seg, latencias p50/p95/p99 y sentencias SQL por
+petición en JSON, para comparar entre versiones.
+
+Uso (desde backend/):
+    python bench/bench_ingesta.py [--usuarios 20] [--placas 8] [--peticiones 100]
+                                  [--lecturas 10] [--formato json|binario] [--salida resultado.json]
+
+El modo de ingesta se elige con las mismas variables que en producción
+(INGESTA_ASINCRONA=1, INGESTA_SPOOL=1).
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Línea base, desviación del ruido y probabilidad de pico por sensor
+PERFILES = {
+    "mq135": (420.0, 15.0, 0.02),
+    "mq4": (180.0, 20.0, 0.01),
+    "mq7": (3.0, 0.8, 0.01),
+}
+# Umbrales por defecto de ConfiguracionSistema, como los calcula el firmware
+UMBRALES = {"mq135": (400, 1000), "mq4": (1000, 5000), "mq7": (9, 35)}
+
+
+class Placa:
+    """Genera una serie con reversión a la media y picos ocasionales por sensor."""
+
+    def __init__(self, semilla: int):
+        self.rnd = random.Random(semilla)
+        self.valores = {c: base for c, (base, _, _) in PERFILES.items()}
+
+    def siguiente(self, codigo: str) -> float:
+        base, ruido, p_pico = PERFILES[codigo]
+        v = self.valores[codigo]
+        v += 0.1 * (base - v) + self.rnd.gauss(0, ruido)
+        if self.rnd.random() < p_pico:
+            v *= self.rnd.uniform(2.5, 12.0)
+        v = max(0.0, v)
+        self.valores[codigo] = v
+        return round(v, 2)
+
+    def lote(self, n: int) -> list[tuple]:
+        codigos = list(PERFILES)
+        return [(c, self.siguiente(c)) for c in (codigos[i % 3] for i in range(n))]
+
+
+def estado_de(codigo: str, valor: float) -> str:
+    advertencia, malo = UMBRALES[codigo]
+    return "bueno" if valor < advertencia else ("advertencia" if valor < malo else "malo")
+
+
+def percentil(ordenados: list[float], p: float) -> float:
+    if not ordenados:
+        return 0.0
+    k = min(len(ordenados) - 1, max(0, round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[k]
+
+
+def sembrar(usuarios: int, p_asignado: float, semilla: int):
+    import models
+    from database import SessionLocal
+
+    rnd = random.Random(semilla)
+    db = SessionLocal()
+    try:
+        sensores = {}
+        for codigo, nombre in (("mq135", "MQ-135"), ("mq4", "MQ-4"), ("mq7", "MQ-7")):
+            s = db.query(models.Sensor).filter(models.Sensor.codigo == codigo).first()
+            if not s:
+                s = models.Sensor(codigo=codigo, nombre=nombre)
+                db.add(s)
+                db.flush()
+            sensores[codigo] = s.id
+        if not db.query(models.ConfiguracionSistema).first():
+            # Sin límite por dispositivo: se mide la capacidad de la API, no la cubeta
+            db.add(models.ConfiguracionSistema(ingesta_peticiones_por_seg=0))
+
+        asignaciones = 0
+        for i in range(usuarios):
+            u = models.Usuario(nombre=f"bench{i}", email=f"bench{i}@bench.local", password="x")
+            db.add(u)
+            db.flush()
+            activos = {}
+            for codigo, sensor_id in sensores.items():
+                if rnd.random() < p_asignado:
+                    db.add(models.UsuarioSensor(usuario_id=u.id, sensor_id=sensor_id))
+                    db.add(models.SesionCaptura(usuario_id=u.id, sensor_codigo=codigo, activo=True))
+                    activos[f"{codigo}_activo"] = True
+                    asignaciones += 1
+            db.add(models.SensoresActivos(usuario_id=u.id, **activos))
+            db.add(models.ConfiguracionNotificaciones(usuario_id=u.id))
+        db.commit()
+        return asignaciones
+    finally:
+        db.close()
+
+
+def iniciar_servidor(app):
+    import uvicorn
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        puerto = s.getsockname()[1]
+    servidor = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=puerto, log_level="warning"))
+    hilo = threading.Thread(target=servidor.run, daemon=True)
+    hilo.start()
+    while not servidor.started:
+        time.sleep(0.05)
+    return servidor, hilo, f"http://127.0.0.1:{puerto}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--usuarios", type=int, default=20)
+    parser.add_argument("--asignado", type=float, default=0.7, help="probabilidad de que un usuario tenga cada sensor")
+    parser.add_argument("--placas", type=int, default=8, help="dispositivos concurrentes")
+    parser.add_argument("--peticiones", type=int, default=100, help="peticiones por placa")
+    parser.add_argument("--lecturas", type=int, default=10, help="lecturas por petición")
+    parser.add_argument("--formato", choices=("json", "binario"), default="json")
+    parser.add_argument("--db", help="URL de una BD vacía y desechable (por defecto SQLite temporal)")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--salida", help="guardar el resultado JSON en este archivo")
+    args = parser.parse_args()
+
+    directorio = tempfile.mkdtemp(prefix="bench_ingesta_")
+    os.environ["DATABASE_URL"] = args.db or f"sqlite:///{os.path.join(directorio, 'bench.db')}"
+    os.environ.setdefault("SPOOL_DIR", os.path.join(directorio, "spool"))
+
+    import httpx
+    from sqlalchemy import event
+
+    import formato_binario
+    import main as api
+    from database import engine
+
+    asignaciones = sembrar(args.usuarios, args.asignado, args.semilla)
+
+    sentencias = [0]
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def contar(conn, cursor, statement, parameters, context, executemany):
+        sentencias[0] += 1
+
+    servidor, hilo, url = iniciar_servidor(api.app)
+    latencias = []
+    errores = []
+    lock = threading.Lock()
+
+    def correr_placa(n: int):
+        placa = Placa(args.semilla * 1000 + n)
+        cabeceras = {"X-API-KEY": api.DEVICE_API_KEY, "X-Dispositivo": f"bench-{n}"}
+        with httpx.Client(base_url=url, timeout=30) as cliente:
+            for i in range(args.peticiones):
+                lecturas = placa.lote(args.lecturas)
+                cabeceras["X-Lote-Id"] = str(i)
+                if args.formato == "binario":
+                    kwargs = {
+                        "content": formato_binario.codificar(lecturas),
+                        "headers": {**cabeceras, "Content-Type": formato_binario.CONTENT_TYPE},
+                    }
+                else:
+                    kwargs = {
+                        "json": {"lecturas": [
+                            {"sensor_codigo": c, "valor": v, "estado": estado_de(c, v)} for c, v in lecturas
+                        ]},
+                        "headers": cabeceras,
+                    }
+                inicio = time.perf_counter()
+                try:
+                    r = cliente.post("/lecturas/device", **kwargs)
+                    ok = r.status_code in (200, 202)
+                    detalle = r.status_code
+                except httpx.HTTPError as e:
+                    ok, detalle = False, type(e).__name__
+                duracion = time.perf_counter() - inicio
+                with lock:
+                    latencias.append(duracion)
+                    if not ok:
+                        errores.append(detalle)
+
+    sentencias_base = sentencias[0]
+    inicio = time.perf_counter()
+    hilos = [threading.Thread(target=correr_placa, args=(n,)) for n in range(args.placas)]
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+    segundos = time.perf_counter() - inicio
+
+    # Con escritor asíncrono o spool, esperar a que lo aceptado llegue a la BD
+    servidor.should_exit = True
+    hilo.join(30)
+
+    peticiones = len(latencias)
+    ordenadas = sorted(latencias)
+    resultado = {
+        "config": {
+            "usuarios": args.usuarios,
+            "asignaciones": asignaciones,
+            "placas": args.placas,
+            "peticiones_por_placa": args.peticiones,
+            "lecturas_por_peticion": args.lecturas,
+            "formato": args.formato,
+            "bd": engine.url.get_backend_name(),
+            "asincrona": os.getenv("INGESTA_ASINCRONA", "0") == "1",
+            "spool": os.getenv("INGESTA_SPOOL", "0") == "1",
+        },
+        "segundos": round(segundos, 3),
+        "peticiones": peticiones,
+        "errores": len(errores),
+        "codigos_error": sorted({str(e) for e in errores}),
+        "peticiones_por_seg": round(peticiones / segundos, 1),
+        "lecturas_por_seg": round(peticiones * args.lecturas / segundos, 1),
+        "latencia_ms": {
+            "p50": round(percentil(ordenadas, 50) * 1000, 2),
+            "p95": round(percentil(ordenadas, 95) * 1000, 2),
+            "p99": round(percentil(ordenadas, 99) * 1000, 2),
+            "max": round((ordenadas[-1] if ordenadas else 0) * 1000, 2),
+        },
+        "sentencias_por_peticion": round((sentencias[0] - sentencias_base) / max(peticiones, 1), 2),
+    }
+    salida = json.dumps(resultado, indent=2)
+    print(salida)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            f.write(salida + "\n")
+
+
+if __name__ == "__main__":
+    main()
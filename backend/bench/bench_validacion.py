@@ -0,0 +1,114 @@
+"""Compara la validación de lotes JSON: modelo Pydantic por lectura vs validacion.py.
+
+Antes de medir comprueba que ambos caminos dan las mismas tuplas para un lote
+válido y los mismos errores (tipo, loc y mensaje) para lotes inválidos.
+
+Uso (desde backend/):
+    python bench/bench_validacion.py [--lecturas 5000] [--repeticiones 50]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pydantic import ValidationError  # noqa: E402
+
+import schemas  # noqa: E402
+import validacion  # noqa: E402
+
+RANGOS = {"mq135": (50, 1500), "mq4": (100, 6000), "mq7": (0, 60)}
+
+INVALIDOS = [
+    b"{bad",
+    b"[]",
+    b'{"lecturas": {}}',
+    b'{"lecturas": [{"sensor_codigo": "mq135", "valor": "abc", "estado": "bueno"}]}',
+    b'{"lecturas": [{"sensor_codigo": "mq135", "valor": 1, "estado": "regular"}]}',
+    b'{"lecturas": [{"sensor_codigo": 7, "valor": 1}]}',
+    b'{"lecturas": [{"sensor_codigo": "mq4", "valor": 1, "estado": "malo"}, {"valor": null}]}',
+]
+
+
+def generar(n: int) -> list[dict]:
+    codigos = list(RANGOS)
+    return [
+        {"sensor_codigo": c, "valor": round(random.uniform(*RANGOS[c]), 2), "estado": "bueno"}
+        for c in (codigos[i % 3] for i in range(n))
+    ]
+
+
+def con_modelo(cuerpo: bytes) -> list[tuple]:
+    """Camino anterior de /lecturas/device."""
+    data = schemas.LecturaCreateDevice.model_validate_json(cuerpo)
+    return [(l.sensor_codigo, l.valor, l.estado.value) for l in data.lecturas]
+
+
+def con_modelo_backfill(cuerpo: bytes) -> list[tuple]:
+    data = schemas.LecturaBackfillDevice.model_validate_json(cuerpo)
+    return [(l.sensor_codigo, l.valor, l.estado.value if l.estado else None, l.creado_en) for l in data.lecturas]
+
+
+def errores(funcion, cuerpo: bytes):
+    try:
+        funcion(cuerpo)
+    except ValidationError as e:
+        return [(err["type"], err["loc"], err["msg"]) for err in e.errors()]
+    return None
+
+
+def verificar(cuerpo: bytes, cuerpo_backfill: bytes):
+    assert con_modelo(cuerpo) == validacion.lote_device(cuerpo), "lote válido: tuplas distintas"
+    assert con_modelo_backfill(cuerpo_backfill) == validacion.lote_backfill(cuerpo_backfill), "backfill: tuplas distintas"
+    for invalido in INVALIDOS:
+        esperado = errores(con_modelo, invalido)
+        assert esperado is not None, invalido
+        assert esperado == errores(validacion.lote_device, invalido), f"errores distintos para {invalido!r}"
+
+
+def medir(funcion, cuerpo: bytes, repeticiones: int) -> float:
+    inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        funcion(cuerpo)
+    return time.perf_counter() - inicio
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lecturas", type=int, default=5000, help="lecturas por petición")
+    parser.add_argument("--repeticiones", type=int, default=50)
+    args = parser.parse_args()
+
+    lecturas = generar(args.lecturas)
+    inicio = datetime.now() - timedelta(hours=6)
+    cuerpo = json.dumps({"lecturas": lecturas}).encode()
+    cuerpo_backfill = json.dumps({"lecturas": [
+        {**l, "creado_en": (inicio + timedelta(seconds=i)).isoformat()} for i, l in enumerate(lecturas)
+    ]}).encode()
+    verificar(cuerpo, cuerpo_backfill)
+
+    casos = {
+        "device": (cuerpo, con_modelo, validacion.lote_device),
+        "backfill": (cuerpo_backfill, con_modelo_backfill, validacion.lote_backfill),
+    }
+    resultados = {}
+    for nombre, (datos, anterior, rapido) in casos.items():
+        t_modelo = medir(anterior, datos, args.repeticiones)
+        t_rapido = medir(rapido, datos, args.repeticiones)
+        total = args.lecturas * args.repeticiones
+        resultados[nombre] = {
+            "modelo_lecturas_por_seg": round(total / t_modelo),
+            "rapido_lecturas_por_seg": round(total / t_rapido),
+            "modelo_ms_por_peticion": round(t_modelo / args.repeticiones * 1000, 2),
+            "rapido_ms_por_peticion": round(t_rapido / args.repeticiones * 1000, 2),
+            "aceleracion": round(t_modelo / t_rapido, 2),
+        }
+    print(json.dumps({"lecturas": args.lecturas, "repeticiones": args.repeticiones, "resultados": resultados}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
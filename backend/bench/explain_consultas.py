@@ -0,0 +1,100 @@
+"""Planes de ejecución de las consultas calientes: falla si alguna recorre la tabla completa.
+
+Arma las mismas consultas que /lecturas/me, /reportes/me, activar_captura,
+obtener_estadisticas_sesion (agregados.consulta_resumen), /reportes/sensores y
+las notificaciones (con mediciones.consulta_lecturas, así que respeta
+LECTURAS_UNICAS), las pasa por EXPLAIN contra DATABASE_URL y
+marca como regresión:
+
+- MySQL: type ALL (tabla completa) o index (índice completo).
+- SQLite: un paso SCAN sobre una tabla (sin SEARCH por índice).
+
+Sale con código 1 si hay regresiones, así sirve como chequeo en CI tras
+`alembic upgrade head`. En MySQL conviene correrlo sobre una copia con datos
+reales: con tablas casi vacías el optimizador puede preferir recorrerlas.
+
+Uso (desde backend/):
+    python bench/explain_consultas.py [--usuario 1] [--mostrar]
+"""
+import argparse
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, text  # noqa: E402
+
+import agregados  # noqa: E402
+import mediciones  # noqa: E402
+import models  # noqa: E402
+from database import SessionLocal  # noqa: E402
+
+
+def consultas(db, usuario_id: int) -> dict:
+    """Nombre -> query, con los mismos filtros y orden que los endpoints."""
+    ahora = datetime.now()
+    desde, hasta = ahora - timedelta(days=7), ahora
+    resultado = {}
+    for sensor in mediciones.TABLAS_LECTURA:
+        query, tabla = mediciones.consulta_lecturas(db, usuario_id, sensor)
+        resultado[f"lecturas_me[{sensor}]"] = query.order_by(tabla.creado_en.desc(), tabla.id.desc()).limit(100)
+        resultado[f"reportes_me[{sensor}]"] = query.filter(
+            mediciones.desde_racha(db, tabla, desde),
+            tabla.creado_en <= hasta,
+            tabla.estado.in_(list(models.EstadoLecturaEnum)),
+        ).order_by(tabla.creado_en.desc(), tabla.id.desc()).limit(1000)
+        # obtener_estadisticas_sesion: agregados del usuario en el rango de la sesión
+        resultado[f"estadisticas_sesion[{sensor}]"] = agregados.consulta_resumen(db, desde, hasta, usuario_id, (sensor,))
+        propia = mediciones.TABLAS_LECTURA[sensor]
+        resultado[f"recientes[{sensor}]"] = db.query(func.count(propia.id)).filter(
+            propia.usuario_id == usuario_id, mediciones.desde_racha(db, propia, ahora - timedelta(seconds=30))
+        )
+
+    S, N = models.SesionCaptura, models.Notificacion
+    resultado["sesion_activa"] = db.query(S).filter(S.usuario_id == usuario_id, S.sensor_codigo == "mq135", S.activo == True)  # noqa: E712
+    resultado["sesiones_activas_por_sensor"] = db.query(S.sensor_codigo, func.count(S.id)).filter(S.activo == True).group_by(S.sensor_codigo)  # noqa: E712
+    resultado["notificaciones_me"] = db.query(N).filter(N.usuario_id == usuario_id).order_by(N.creado_en.desc()).limit(50)
+    resultado["notificaciones_no_leidas"] = db.query(func.count(N.id)).filter(N.usuario_id == usuario_id, N.leida == False)  # noqa: E712
+    return resultado
+
+
+def plan(db, query) -> tuple[list[str], list[str]]:
+    """(líneas del plan, pasos que recorren una tabla completa)."""
+    dialecto = db.get_bind().dialect
+    sql = str(query.statement.compile(dialect=dialecto, compile_kwargs={"literal_binds": True}))
+    if dialecto.name == "sqlite":
+        filas = db.execute(text("EXPLAIN QUERY PLAN " + sql)).mappings().all()
+        lineas = [f["detail"] for f in filas]
+        completos = [l for l in lineas if l.startswith("SCAN ") and " USING " not in l and "CONSTANT ROW" not in l]
+        return lineas, completos
+    filas = db.execute(text("EXPLAIN " + sql)).mappings().all()
+    lineas = [f"{f['table']}: type={f['type']} key={f['key']} rows={f['rows']} {f['Extra'] or ''}".strip() for f in filas]
+    completos = [l for f, l in zip(filas, lineas) if f["table"] and f["type"] in ("ALL", "index")]
+    return lineas, completos
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--usuario", type=int, default=1, help="usuario_id para los filtros")
+    parser.add_argument("--mostrar", action="store_true", help="imprimir el plan completo de cada consulta")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    regresiones = 0
+    try:
+        for nombre, query in consultas(db, args.usuario).items():
+            lineas, completos = plan(db, query)
+            print(f"{'FULL SCAN' if completos else 'ok':>9}  {nombre}")
+            for linea in lineas if args.mostrar else completos:
+                print(f"{'':>11}{linea}")
+            regresiones += bool(completos)
+    finally:
+        db.close()
+
+    print(f"\n{regresiones} consultas con recorrido completo" if regresiones else "\nTodas las consultas usan índices")
+    sys.exit(1 if regresiones else 0)
+
+
+if __name__ == "__main__":
+    main()
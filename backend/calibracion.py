@@ -0,0 +1,157 @@
+"""Calibración en el servidor: cuentas ADC crudas -> ppm con NumPy.
+
+En modo crudo (formato_binario con FLAG_ADC) la placa envía solo u16 por
+lectura y el servidor aplica la curva de cada sensor de esa placa:
+
+    V     = cuentas / adc_max * vref
+    Rs    = rl * (vc - V) / V
+    razón = Rs / r0   [/ (1 + coef_temp * (T - temp_ref)) si llega X-Temperatura]
+    ppm   = a * razón ** b
+
+Los parámetros salen de calibraciones_sensor (por dispositivo y sensor) o de
+CURVAS_DEFECTO. Se guardan como una matriz por placa con una fila por
+sensor_id, así que todo el lote se convierte en una sola pasada vectorizada
+(indexar la matriz con los sensor_id y operar columna a columna), sin bucles
+por lectura. Cambiar la calibración no requiere reflashear: basta el endpoint
+de administración. La caché se recarga cada CALIBRACION_RECARGAR_SEGUNDOS y al
+momento desde esos endpoints (invalidar()).
+"""
+import os
+import threading
+from datetime import datetime
+
+import numpy as np
+
+import formato_binario
+import models
+from database import SessionLocal
+
+CALIBRACION_RECARGAR_SEGUNDOS = int(os.getenv("CALIBRACION_RECARGAR_SEGUNDOS", "60"))
+
+PARAMETROS = ("adc_max", "vref", "vc", "rl", "r0", "a", "b", "coef_temp", "temp_ref")
+
+# Curvas típicas de hoja de datos (ESP32: ADC de 12 bits a 3.3 V, módulo a 5 V, RL 10 kΩ).
+# r0 debe medirse en aire limpio para cada sensor; 10 kΩ es solo un punto de partida.
+CURVAS_DEFECTO = {
+    "mq135": {"adc_max": 4095, "vref": 3.3, "vc": 5.0, "rl": 10.0, "r0": 10.0, "a": 110.47, "b": -2.862, "coef_temp": 0.0, "temp_ref": 20.0},
+    "mq4": {"adc_max": 4095, "vref": 3.3, "vc": 5.0, "rl": 10.0, "r0": 10.0, "a": 1012.7, "b": -2.786, "coef_temp": 0.0, "temp_ref": 20.0},
+    "mq7": {"adc_max": 4095, "vref": 3.3, "vc": 5.0, "rl": 10.0, "r0": 10.0, "a": 99.042, "b": -1.518, "coef_temp": 0.0, "temp_ref": 20.0},
+}
+
+# Tablas indexadas por sensor_id (u8): código y si es un sensor conocido
+_CODIGOS = np.array([formato_binario.SENSORES_POR_ID.get(i) for i in range(256)], dtype=object)
+_VALIDOS = np.array([i in formato_binario.SENSORES_POR_ID for i in range(256)])
+_N_IDS = max(formato_binario.SENSORES_POR_ID) + 1
+
+_DTYPE = np.dtype([("sensor", "u1"), ("cuentas", "<u2")])
+_DTYPE_TS = np.dtype([("sensor", "u1"), ("cuentas", "<u2"), ("ts", "<u4")])
+
+
+def _matriz(curvas: dict) -> np.ndarray:
+    """Fila sensor_id -> parámetros (la fila 0 no se usa)."""
+    m = np.full((_N_IDS, len(PARAMETROS)), np.nan)
+    for sensor_id, codigo in formato_binario.SENSORES_POR_ID.items():
+        m[sensor_id] = [curvas[codigo][p] for p in PARAMETROS]
+    return m
+
+
+_DEFECTO = _matriz(CURVAS_DEFECTO)
+
+_lock = threading.Lock()
+_cache = {
+    "last_fetch": None,
+    "por_dispositivo": {},  # codigo -> matriz de parámetros
+}
+
+
+def necesita_recarga() -> bool:
+    if _cache["last_fetch"] is None:
+        return True
+    return (datetime.utcnow() - _cache["last_fetch"]).total_seconds() > CALIBRACION_RECARGAR_SEGUNDOS
+
+
+def recargar():
+    """Carga las calibraciones personalizadas de las placas (con sesión propia)."""
+    db = SessionLocal()
+    try:
+        filas = db.query(models.Dispositivo.codigo, models.CalibracionSensor).join(
+            models.CalibracionSensor, models.CalibracionSensor.dispositivo_id == models.Dispositivo.id
+        ).all()
+    finally:
+        db.close()
+    curvas = {}
+    for codigo, cal in filas:
+        if cal.sensor_codigo in CURVAS_DEFECTO:
+            curvas.setdefault(codigo, {k: dict(v) for k, v in CURVAS_DEFECTO.items()})[cal.sensor_codigo] = {
+                p: getattr(cal, p) for p in PARAMETROS
+            }
+    with _lock:
+        _cache["por_dispositivo"] = {codigo: _matriz(c) for codigo, c in curvas.items()}
+        _cache["last_fetch"] = datetime.utcnow()
+
+
+def invalidar():
+    """Forzar recarga en la próxima petición (llamar tras el commit)."""
+    _cache["last_fetch"] = None
+
+
+def convertir(sensor_ids: np.ndarray, cuentas: np.ndarray, dispositivo: str | None = None, temperatura: float | None = None) -> np.ndarray:
+    """ppm para cada (sensor_id, cuentas) con la calibración de la placa."""
+    m = _cache["por_dispositivo"].get(dispositivo, _DEFECTO) if dispositivo else _DEFECTO
+    adc_max, vref, vc, rl, r0, a, b, coef_temp, temp_ref = m[sensor_ids].T
+    # 0 cuentas sería Rs infinita; V >= vc daría Rs negativa
+    v = np.maximum(cuentas, 1) / adc_max * vref
+    rs = rl * np.maximum(vc - v, 1e-6) / v
+    razon = rs / r0
+    if temperatura is not None:
+        razon = razon / np.maximum(1 + coef_temp * (temperatura - temp_ref), 1e-3)
+    return a * np.power(razon, b)
+
+
+def decodificar(cuerpo: bytes, dispositivo: str | None = None, temperatura: float | None = None) -> list[tuple]:
+    """Cuerpo binario con FLAG_ADC -> lecturas (sensor_codigo, ppm, None, creado_en | None).
+
+    Lanza ValueError si el cuerpo es inválido, igual que formato_binario.decodificar.
+    """
+    version, flags = formato_binario.cabecera(cuerpo)
+    if version != formato_binario.VERSION:
+        raise ValueError(f"Versión de formato no soportada: {version}")
+    dtype = _DTYPE_TS if flags & formato_binario.FLAG_TIMESTAMP else _DTYPE
+    datos = memoryview(cuerpo)[2:]
+    if len(datos) % dtype.itemsize:
+        raise ValueError(f"Longitud inválida: se esperaban registros de {dtype.itemsize} bytes")
+
+    registros = np.frombuffer(datos, dtype=dtype)
+    ids = registros["sensor"]
+    validos = _VALIDOS[ids]
+    if not validos.all():
+        raise ValueError(f"sensor_id desconocido: {int(ids[~validos][0])}")
+
+    valores = np.round(convertir(ids, registros["cuentas"], dispositivo, temperatura), 2)
+    if not np.isfinite(valores).all():
+        # Curva mal cargada (p.ej. r0 = 0): no llegar a la BD con NaN o infinito
+        raise ValueError(f"La calibración dio un valor no finito para {_CODIGOS[ids[~np.isfinite(valores)][0]]}")
+    valores = valores.tolist()
+    codigos = _CODIGOS[ids].tolist()
+    if dtype is _DTYPE_TS:
+        momentos = [datetime.fromtimestamp(ts) for ts in registros["ts"].tolist()]
+    else:
+        momentos = [None] * len(codigos)
+    return list(zip(codigos, valores, [None] * len(codigos), momentos))
+
+
+def curva(cal: models.CalibracionSensor) -> dict:
+    return {"sensor_codigo": cal.sensor_codigo, **{p: getattr(cal, p) for p in PARAMETROS}, "personalizada": True}
+
+
+def curvas(personalizadas: list) -> list[dict]:
+    """Curva vigente de cada sensor de la placa (personalizada o por defecto), para la API."""
+    por_sensor = {c.sensor_codigo: c for c in personalizadas}
+    return [
+        curva(por_sensor[sensor]) if sensor in por_sensor else {"sensor_codigo": sensor, **defecto, "personalizada": False}
+        for sensor, defecto in CURVAS_DEFECTO.items()
+    ]
+
+
+def estado() -> dict:
+    return {"dispositivos_calibrados": len(_cache["por_dispositivo"])}
@@ -0,0 +1,151 @@
+"""Compresión por banda muerta (deadband) de las lecturas en la ingesta.
+
+Los sensores de gas pasan horas en casi el mismo valor. Con mqXX_deadband > 0
+en ConfiguracionSistema, una lectura que difiere como mucho epsilon del valor
+de la última fila guardada para el mismo usuario (o para el sensor, con
+LECTURAS_UNICAS) y tiene el mismo estado no crea fila nueva: esa fila suma
+conteo y mueve ultimo_en. Cada fila representa así una racha de conteo
+lecturas entre creado_en y ultimo_en (mediciones.expandir la vuelve a abrir).
+
+La racha se corta si cambia el estado, si pasan más de DEADBAND_HUECO_SEGUNDOS
+sin lecturas (para no ocultar cortes del dispositivo), si ya abarca
+DEADBAND_RACHA_MAX_SEGUNDOS, si la lectura es anterior al final de la racha o
+si el usuario empezó otra sesión de captura. El largo máximo permite filtrar
+"rachas que siguen después de x" con creado_en >= x - DEADBAND_RACHA_MAX_SEGUNDOS,
+que sí usa el índice (usuario_id, creado_en) (mediciones.desde_racha).
+Alertas, notificaciones y total_lecturas de las sesiones siguen contando
+lectura por lectura.
+
+La fila abierta de cada racha ("cabeza") se recuerda en memoria por proceso:
+tras un reinicio, o si una transacción falla (invalidar()), la siguiente
+lectura abre una racha nueva en vez de consultar la BD. La fila que queda como
+cabeza de cada clave se inserta sola para tomar su id del propio INSERT (otra
+transacción puede estar insertando en la misma tabla a la vez).
+"""
+import os
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, insert, update
+from sqlalchemy.orm import Session
+
+DEADBAND_HUECO_SEGUNDOS = int(os.getenv("DEADBAND_HUECO_SEGUNDOS", "300"))
+DEADBAND_RACHA_MAX_SEGUNDOS = int(os.getenv("DEADBAND_RACHA_MAX_SEGUNDOS", "3600"))
+
+
+class _Cabeza:
+    """Última fila de una racha. id es None mientras la fila no está insertada."""
+
+    __slots__ = ("id", "valor", "estado", "inicio", "ultimo", "sesion", "fila", "lote")
+
+    def __init__(self, valor, estado, inicio, sesion, fila, lote):
+        self.id = None
+        self.valor = valor
+        self.estado = estado
+        self.inicio = inicio
+        self.ultimo = inicio
+        self.sesion = sesion
+        self.fila = fila
+        self.lote = lote
+
+
+_lock = threading.Lock()
+_cabezas = {}  # (tabla, clave) -> _Cabeza
+
+
+def guardar(db: Session, tabla, columna: str, filas: list, epsilon: float, insertar, sesiones: dict | None = None, ahora: datetime | None = None) -> int:
+    """Guarda filas de lectura de una tabla acumulando las que caen en la banda muerta.
+
+    columna es la clave de la racha ("usuario_id", o "sensor_codigo" en
+    mediciones); sesiones mapea esa clave a su sesión de captura activa.
+    insertar(db, tabla, filas) hace el INSERT multi-fila de las rachas nuevas.
+    No hace commit. Devuelve cuántas filas se insertaron.
+    """
+    if not filas:
+        return 0
+    ahora = ahora or datetime.now()
+    hueco = timedelta(seconds=DEADBAND_HUECO_SEGUNDOS)
+    racha_max = timedelta(seconds=DEADBAND_RACHA_MAX_SEGUNDOS)
+    nombre = tabla.__tablename__
+    lote = object()
+    nuevas = []
+    extensiones = {}
+
+    with _lock:
+        for fila in filas:
+            clave = fila[columna]
+            momento = fila.get("creado_en") or ahora
+            sesion = sesiones.get(clave) if sesiones is not None else None
+            cabeza = _cabezas.get((nombre, clave))
+            if (
+                cabeza is not None
+                and (cabeza.id is not None or cabeza.lote is lote)
+                and cabeza.sesion == sesion
+                and cabeza.estado == fila["estado"]
+                and abs(fila["valor"] - cabeza.valor) <= epsilon
+                and timedelta(0) <= momento - cabeza.ultimo <= hueco
+                and momento - cabeza.inicio <= racha_max
+            ):
+                cabeza.ultimo = momento
+                if cabeza.fila is not None:
+                    # Racha abierta en este mismo lote: todavía es un dict por insertar
+                    cabeza.fila["conteo"] += 1
+                    cabeza.fila["ultimo_en"] = momento
+                else:
+                    extension = extensiones.setdefault(cabeza.id, {"b_id": cabeza.id, "b_n": 0, "b_ultimo": momento})
+                    extension["b_n"] += 1
+                    extension["b_ultimo"] = momento
+                continue
+            nueva = {**fila, "conteo": 1, "ultimo_en": None}
+            nuevas.append(nueva)
+            _cabezas[(nombre, clave)] = _Cabeza(fila["valor"], fila["estado"], momento, sesion, nueva, lote)
+
+    if extensiones:
+        t = tabla.__table__
+        db.execute(
+            update(t).where(t.c.id == bindparam("b_id")).values(
+                conteo=t.c.conteo + bindparam("b_n"), ultimo_en=bindparam("b_ultimo")
+            ),
+            list(extensiones.values()),
+        )
+    if not nuevas:
+        return 0
+
+    # Las cabezas (última fila nueva de cada clave) van una por una para saber su id;
+    # el resto, en el INSERT multi-fila
+    with _lock:
+        cabezas = {
+            id(c.fila): c for (t, _), c in _cabezas.items() if t == nombre and c.lote is lote
+        }
+    insertar(db, tabla, [f for f in nuevas if id(f) not in cabezas])
+    ids = {}
+    for f in nuevas:
+        if id(f) in cabezas:
+            valores = f if f.get("creado_en") is not None else {k: v for k, v in f.items() if k != "creado_en"}
+            ids[id(f)] = db.execute(insert(tabla).values(**valores)).inserted_primary_key[0]
+    with _lock:
+        for clave_fila, cabeza in cabezas.items():
+            # Si otro lote ya la reemplazó, la cabeza vieja no se toca
+            if cabeza.lote is lote:
+                cabeza.id, cabeza.fila, cabeza.lote = ids[clave_fila], None, None
+    return len(nuevas)
+
+
+def abiertas(tabla, claves) -> list[int]:
+    """ids de las filas ya insertadas que la próxima lectura de esas claves podría extender."""
+    nombre = tabla.__tablename__
+    with _lock:
+        return [
+            c.id for c in (_cabezas.get((nombre, clave)) for clave in claves)
+            if c is not None and c.id is not None
+        ]
+
+
+def invalidar():
+    """Olvida todas las rachas abiertas (p.ej. tras un rollback)."""
+    with _lock:
+        _cabezas.clear()
+
+
+def estado() -> dict:
+    return {"rachas_abiertas": len(_cabezas), "hueco_segundos": DEADBAND_HUECO_SEGUNDOS, "racha_max_segundos": DEADBAND_RACHA_MAX_SEGUNDOS}
@@ -0,0 +1,99 @@
+"""Registro de dispositivos con API key propia y verificación en memoria.
+
+Cada placa tiene una fila en dispositivos con el SHA-256 de su clave (las
+claves son aleatorias de 256 bits, así que un hash rápido basta y permite
+buscar en O(1)). El índice hash -> dispositivo se carga completo en memoria,
+se recarga cada DISPOSITIVOS_RECARGAR_SEGUNDOS y se actualiza al momento desde
+los endpoints de administración; autenticar una petición no toca la BD.
+
+La clave global DEVICE_API_KEY sigue aceptándose mientras las placas migran;
+en ese caso el dispositivo es el que declare la cabecera X-Dispositivo, con
+el prefijo "legado:" para que no pueda hacerse pasar por uno registrado (su
+idempotencia, calibración y límite de peticiones son aparte).
+"""
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+from datetime import datetime
+
+import models
+from database import SessionLocal
+
+DEVICE_API_KEY = os.getenv("DEVICE_API_KEY", "ESP32_SENSOR_KEY_2024")
+DISPOSITIVOS_RECARGAR_SEGUNDOS = int(os.getenv("DISPOSITIVOS_RECARGAR_SEGUNDOS", "60"))
+
+# Valor devuelto por autenticar() para la clave global heredada
+LEGADO = ""
+PREFIJO_LEGADO = "legado:"
+
+_lock = threading.Lock()
+_cache = {
+    "last_fetch": None,
+    "por_hash": {},  # clave_hash -> codigo del dispositivo
+}
+
+
+def generar_clave() -> str:
+    return secrets.token_urlsafe(32)
+
+
+def hash_clave(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+def necesita_recarga() -> bool:
+    if _cache["last_fetch"] is None:
+        return True
+    return (datetime.utcnow() - _cache["last_fetch"]).total_seconds() > DISPOSITIVOS_RECARGAR_SEGUNDOS
+
+
+def recargar():
+    """Carga los dispositivos activos desde la BD (con sesión propia)."""
+    db = SessionLocal()
+    try:
+        filas = db.query(models.Dispositivo.clave_hash, models.Dispositivo.codigo).filter(
+            models.Dispositivo.activo == True
+        ).all()
+    finally:
+        db.close()
+    with _lock:
+        _cache["por_hash"] = {h: c for h, c in filas}
+        _cache["last_fetch"] = datetime.utcnow()
+
+
+def autenticar(api_key: str | None) -> str | None:
+    """Código del dispositivo dueño de la clave, LEGADO para DEVICE_API_KEY o None si no es válida."""
+    if not api_key:
+        return None
+    # Buscar por el hash no expone la clave por tiempos; la global se compara en tiempo constante
+    codigo = _cache["por_hash"].get(hash_clave(api_key))
+    if codigo is not None:
+        return codigo
+    if DEVICE_API_KEY and hmac.compare_digest(api_key.encode("utf-8"), DEVICE_API_KEY.encode("utf-8")):
+        return LEGADO
+    return None
+
+
+def identificar(autenticado: str, declarado: str | None) -> str | None:
+    """Dispositivo de la petición: el registrado o, con la clave global, el declarado con PREFIJO_LEGADO."""
+    if autenticado != LEGADO:
+        return autenticado
+    # Recortado a las 64 columnas de lotes_procesados.dispositivo
+    return (PREFIJO_LEGADO + declarado)[:64] if declarado else None
+
+
+# ----------- ACTUALIZACIONES EN CALIENTE (llamar tras el commit) -----------
+
+def registrar(dispositivo: models.Dispositivo):
+    with _lock:
+        por_hash = {h: c for h, c in _cache["por_hash"].items() if c != dispositivo.codigo}
+        if dispositivo.activo:
+            por_hash[dispositivo.clave_hash] = dispositivo.codigo
+        _cache["por_hash"] = por_hash
+
+
+def olvidar(codigo: str):
+    with _lock:
+        _cache["por_hash"] = {h: c for h, c in _cache["por_hash"].items() if c != codigo}
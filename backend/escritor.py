@@ -0,0 +1,152 @@
+"""Escritor asíncrono con commit agrupado para la ingesta de dispositivos.
+
+Con INGESTA_ASINCRONA=1, /lecturas/device solo valida y encola el lote; un
+hilo en segundo plano vacía la cola y guarda las lecturas de muchas peticiones
+en una sola transacción (ingesta.procesar_peticiones_en_sesion). Si la cola se llena, la
+petición se rechaza con 429 + Retry-After en vez de bloquear workers.
+
+Si la transacción de un grupo falla, cada petición del grupo se vuelve a
+guardar por separado: solo se descarta (y se libera su lote para que el
+dispositivo lo reenvíe) la que vuelve a fallar.
+"""
+import math
+import os
+import queue
+import threading
+import time
+
+import idempotencia
+import limitador
+from ingesta import procesar_peticiones_en_sesion
+
+INGESTA_ASINCRONA = os.getenv("INGESTA_ASINCRONA", "0") == "1"
+ESCRITOR_COLA_MAX = int(os.getenv("ESCRITOR_COLA_MAX", "1000"))      # peticiones en espera
+ESCRITOR_LOTE_MAX = int(os.getenv("ESCRITOR_LOTE_MAX", "5000"))      # lecturas por transacción
+ESCRITOR_ESPERA_MS = int(os.getenv("ESCRITOR_ESPERA_MS", "50"))      # ventana para agrupar peticiones
+
+
+class ColaLlena(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("Cola de ingesta llena")
+        self.retry_after = retry_after
+
+
+class EscritorAgrupado:
+    def __init__(self, maxsize: int = ESCRITOR_COLA_MAX, lote_max: int = ESCRITOR_LOTE_MAX, espera_ms: int = ESCRITOR_ESPERA_MS):
+        self._cola = queue.Queue(maxsize=maxsize)
+        self._lote_max = lote_max
+        self._espera = espera_ms / 1000.0
+        self._hilo = None
+        self._detener = threading.Event()
+        # Métricas simples para estimar Retry-After y exponer estado
+        self._peticiones_por_seg = 0.0
+        self._ultimo_commit_ms = 0.0
+        self._lotes_escritos = 0
+        self._errores = 0
+        self._descartados = 0
+
+    # ----------- ciclo de vida -----------
+    def iniciar(self):
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._bucle, name="escritor-ingesta", daemon=True)
+        self._hilo.start()
+
+    def detener(self, timeout: float = 10.0):
+        """Deja de aceptar trabajo y vacía lo pendiente antes de salir."""
+        self._detener.set()
+        if self._hilo:
+            self._hilo.join(timeout)
+
+    # ----------- productor -----------
+    def encolar(self, lecturas: list, lote: tuple | None = None):
+        try:
+            self._cola.put_nowait((lecturas, lote))
+        except queue.Full:
+            raise ColaLlena(self.retry_after())
+
+    def profundidad(self) -> int:
+        return self._cola.qsize()
+
+    def capacidad(self) -> int:
+        return self._cola.maxsize
+
+    def retry_after(self) -> int:
+        """Segundos estimados para vaciar la cola al ritmo de escritura reciente."""
+        ritmo = self._peticiones_por_seg or 1.0
+        return max(1, min(60, math.ceil(self._cola.qsize() / ritmo)))
+
+    def estado(self) -> dict:
+        return {
+            "activo": bool(self._hilo and self._hilo.is_alive()),
+            "en_cola": self._cola.qsize(),
+            "capacidad": self._cola.maxsize,
+            "peticiones_por_seg": round(self._peticiones_por_seg, 2),
+            "ultimo_commit_ms": round(self._ultimo_commit_ms, 2),
+            "lotes_escritos": self._lotes_escritos,
+            "errores": self._errores,
+            "descartados": self._descartados,
+        }
+
+    # ----------- consumidor -----------
+    def _tomar_grupo(self) -> list:
+        """Bloquea hasta la primera petición y agrupa las que lleguen en la ventana."""
+        grupo = []
+        try:
+            grupo.append(self._cola.get(timeout=0.5))
+        except queue.Empty:
+            return grupo
+        total = len(grupo[0][0])
+        limite = time.monotonic() + self._espera
+        while total < self._lote_max:
+            restante = limite - time.monotonic()
+            try:
+                item = self._cola.get(timeout=restante) if restante > 0 else self._cola.get_nowait()
+            except queue.Empty:
+                break
+            grupo.append(item)
+            total += len(item[0])
+        return grupo
+
+    def _escribir(self, grupo: list):
+        inicio = time.monotonic()
+        try:
+            procesar_peticiones_en_sesion(grupo)
+            self._lotes_escritos += 1
+        except Exception as e:
+            self._errores += 1
+            if len(grupo) == 1:
+                self._descartar(grupo[0], e)
+            else:
+                # Una petición mala no debe perder las del resto del grupo: se reintenta cada una por separado
+                print(f"[WARN] escritor-ingesta: falló un grupo de {len(grupo)} peticiones, se guardan por separado: {e}")
+                for item in grupo:
+                    try:
+                        procesar_peticiones_en_sesion([item])
+                        self._lotes_escritos += 1
+                    except Exception as e_item:
+                        self._descartar(item, e_item)
+        duracion = max(time.monotonic() - inicio, 1e-6)
+        self._ultimo_commit_ms = duracion * 1000
+        limitador.registrar_latencia(self._ultimo_commit_ms, sum(len(item[0]) for item in grupo))
+        # Media móvil de peticiones drenadas por segundo
+        ritmo = len(grupo) / duracion
+        self._peticiones_por_seg = ritmo if not self._peticiones_por_seg else 0.8 * self._peticiones_por_seg + 0.2 * ritmo
+
+    def _descartar(self, item: tuple, error: Exception):
+        lecturas, lote = item
+        self._descartados += 1
+        print(f"[ERROR] escritor-ingesta: se descarta una petición de {len(lecturas)} lecturas (lote {lote}): {error}")
+        # Permitir que el dispositivo reintente el lote perdido
+        if lote is not None:
+            idempotencia.liberar(*lote)
+
+    def _bucle(self):
+        while not (self._detener.is_set() and self._cola.empty()):
+            grupo = self._tomar_grupo()
+            if grupo:
+                self._escribir(grupo)
+
+
+escritor = EscritorAgrupado()
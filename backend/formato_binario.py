@@ -0,0 +1,134 @@
+"""Formato binario compacto para /lecturas/device (Content-Type: application/x-lecturas-bin).
+
+Estructura (little-endian):
+
+    cabecera   u8 versión (=1) | u8 flags (bit 0: cada lectura trae timestamp,
+                                        bit 1: cuentas ADC crudas)
+    lectura    u8 sensor_id | f32 valor [| u32 timestamp epoch en segundos]
+    lectura    u8 sensor_id | u16 cuentas ADC [| u32 timestamp]   (con bit 1)
+
+En el canal WebSocket cada trama binaria antepone u32 seq (número de lote del
+dispositivo) al cuerpo anterior.
+
+sensor_id usa la misma numeración que el resto de la API: 1=mq135, 2=mq4,
+3=mq7. El estado no viaja: el servidor lo clasifica con los umbrales
+configurados. Una lectura ocupa 5 bytes (9 con timestamp) frente a ~60 en JSON.
+Con cuentas ADC (3 bytes, 7 con timestamp) la conversión a ppm la hace el
+servidor con la curva de calibración de cada placa (calibracion.py).
+"""
+import math
+import struct
+from datetime import datetime
+
+CONTENT_TYPE = "application/x-lecturas-bin"
+VERSION = 1
+FLAG_TIMESTAMP = 0x01
+FLAG_ADC = 0x02
+
+SENSORES_POR_ID = {1: "mq135", 2: "mq4", 3: "mq7"}
+IDS_POR_SENSOR = {c: i for i, c in SENSORES_POR_ID.items()}
+
+_CABECERA = struct.Struct("<BB")
+_LECTURA = struct.Struct("<Bf")
+_LECTURA_TS = struct.Struct("<BfI")
+_LECTURA_ADC = struct.Struct("<BH")
+_LECTURA_ADC_TS = struct.Struct("<BHI")
+_SEQ = struct.Struct("<I")
+
+
+def decodificar(cuerpo: bytes) -> list[tuple]:
+    """Convierte el cuerpo binario en lecturas (sensor_codigo, valor, estado, creado_en).
+
+    El estado va como None para que la ingesta lo clasifique; creado_en es None
+    si el lote no trae timestamps. Lanza ValueError si el cuerpo es inválido
+    (también si algún valor es NaN o infinito).
+    """
+    vista = memoryview(cuerpo)
+    if len(vista) < _CABECERA.size:
+        raise ValueError("Cuerpo binario demasiado corto")
+    version, flags = _CABECERA.unpack_from(vista)
+    if version != VERSION:
+        raise ValueError(f"Versión de formato no soportada: {version}")
+
+    if flags & FLAG_ADC:
+        raise ValueError("El cuerpo trae cuentas ADC: se decodifica con calibracion.decodificar")
+
+    registro = _LECTURA_TS if flags & FLAG_TIMESTAMP else _LECTURA
+    datos = vista[_CABECERA.size:]
+    if len(datos) % registro.size:
+        raise ValueError(f"Longitud inválida: se esperaban registros de {registro.size} bytes")
+
+    # iter_unpack recorre el buffer original sin copiarlo
+    lecturas = []
+    if registro is _LECTURA_TS:
+        for sensor_id, valor, ts in registro.iter_unpack(datos):
+            codigo = SENSORES_POR_ID.get(sensor_id)
+            if codigo is None:
+                raise ValueError(f"sensor_id desconocido: {sensor_id}")
+            if not math.isfinite(valor):
+                raise ValueError(f"Valor no finito para {codigo}: {valor}")
+            lecturas.append((codigo, valor, None, datetime.fromtimestamp(ts)))
+    else:
+        for sensor_id, valor in registro.iter_unpack(datos):
+            codigo = SENSORES_POR_ID.get(sensor_id)
+            if codigo is None:
+                raise ValueError(f"sensor_id desconocido: {sensor_id}")
+            if not math.isfinite(valor):
+                raise ValueError(f"Valor no finito para {codigo}: {valor}")
+            lecturas.append((codigo, valor, None, None))
+    return lecturas
+
+
+def cabecera(cuerpo: bytes) -> tuple[int, int]:
+    """(versión, flags) del cuerpo. Lanza ValueError si es demasiado corto."""
+    if len(cuerpo) < _CABECERA.size:
+        raise ValueError("Cuerpo binario demasiado corto")
+    return _CABECERA.unpack_from(cuerpo)
+
+
+def es_adc(cuerpo: bytes) -> bool:
+    return len(cuerpo) >= _CABECERA.size and bool(cuerpo[1] & FLAG_ADC)
+
+
+def separar_trama(trama: bytes) -> tuple[int, memoryview]:
+    """Trama binaria del WebSocket: (seq, cuerpo sin decodificar)."""
+    if len(trama) < _SEQ.size:
+        raise ValueError("Trama binaria demasiado corta")
+    (seq,) = _SEQ.unpack_from(trama)
+    return seq, memoryview(trama)[_SEQ.size:]
+
+
+def decodificar_trama(trama: bytes) -> tuple[int, list[tuple]]:
+    """Trama binaria del WebSocket: (seq, lecturas)."""
+    seq, cuerpo = separar_trama(trama)
+    return seq, decodificar(cuerpo)
+
+
+def codificar(lecturas, con_timestamp: bool = False) -> bytes:
+    """Inverso de decodificar; referencia para firmware, pruebas y benchmarks.
+
+    lecturas: iterable de (sensor_codigo, valor) o (sensor_codigo, valor, timestamp).
+    """
+    partes = [_CABECERA.pack(VERSION, FLAG_TIMESTAMP if con_timestamp else 0)]
+    for l in lecturas:
+        if con_timestamp:
+            partes.append(_LECTURA_TS.pack(IDS_POR_SENSOR[l[0]], l[1], int(l[2])))
+        else:
+            partes.append(_LECTURA.pack(IDS_POR_SENSOR[l[0]], l[1]))
+    return b"".join(partes)
+
+
+def codificar_adc(lecturas, con_timestamp: bool = False) -> bytes:
+    """Cuerpo con cuentas ADC: lecturas (sensor_codigo, cuentas[, timestamp])."""
+    partes = [_CABECERA.pack(VERSION, FLAG_ADC | (FLAG_TIMESTAMP if con_timestamp else 0))]
+    for l in lecturas:
+        if con_timestamp:
+            partes.append(_LECTURA_ADC_TS.pack(IDS_POR_SENSOR[l[0]], int(l[1]), int(l[2])))
+        else:
+            partes.append(_LECTURA_ADC.pack(IDS_POR_SENSOR[l[0]], int(l[1])))
+    return b"".join(partes)
+
+
+def codificar_trama(seq: int, lecturas, con_timestamp: bool = False) -> bytes:
+    """Inverso de decodificar_trama."""
+    return _SEQ.pack(seq) + codificar(lecturas, con_timestamp)
@@ -0,0 +1,98 @@
+"""Deduplicación de lotes reenviados por los dispositivos.
+
+El ESP32 puede enviar X-Dispositivo y X-Lote-Id; si reintenta un lote ya
+guardado, se responde OK sin tocar las tablas de lecturas. Cada dispositivo
+tiene una ventana LRU en memoria con sus últimos lotes, respaldada por la
+tabla lotes_procesados (se inserta en la misma transacción que las lecturas)
+para que sobreviva a reinicios.
+"""
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+import models
+from database import SessionLocal
+
+IDEMPOTENCIA_VENTANA = int(os.getenv("IDEMPOTENCIA_VENTANA", "256"))            # lotes recordados por dispositivo
+IDEMPOTENCIA_RETENCION_HORAS = int(os.getenv("IDEMPOTENCIA_RETENCION_HORAS", "24"))
+
+_lock = threading.Lock()
+_ventanas: dict[str, OrderedDict] = {}
+_ultima_purga = {"en": None}
+
+
+def cargado(dispositivo: str) -> bool:
+    return dispositivo in _ventanas
+
+
+def precargar(dispositivo: str):
+    """Carga desde la BD los últimos lotes del dispositivo (una vez por proceso)."""
+    db = SessionLocal()
+    try:
+        filas = db.query(models.LoteProcesado.lote_id).filter(
+            models.LoteProcesado.dispositivo == dispositivo
+        ).order_by(models.LoteProcesado.id.desc()).limit(IDEMPOTENCIA_VENTANA).all()
+    finally:
+        db.close()
+    with _lock:
+        ventana = _ventanas.setdefault(dispositivo, OrderedDict())
+        for (lote_id,) in reversed(filas):
+            ventana.setdefault(lote_id, True)
+
+
+def reservar(dispositivo: str, lote_id: str) -> bool:
+    """Marca el lote como recibido. False si ya estaba en la ventana (duplicado)."""
+    with _lock:
+        ventana = _ventanas.setdefault(dispositivo, OrderedDict())
+        if lote_id in ventana:
+            ventana.move_to_end(lote_id)
+            return False
+        ventana[lote_id] = True
+        while len(ventana) > IDEMPOTENCIA_VENTANA:
+            ventana.popitem(last=False)
+        return True
+
+
+def liberar(dispositivo: str, lote_id: str):
+    """Olvida una reserva cuyo guardado falló, para que el reintento se procese."""
+    with _lock:
+        ventana = _ventanas.get(dispositivo)
+        if ventana is not None:
+            ventana.pop(lote_id, None)
+
+
+def es_lote_repetido(error: Exception) -> bool:
+    """Si el error es la clave única de lotes_procesados (otro worker guardó el mismo lote a la vez)."""
+    mensaje = str(getattr(error, "orig", error))
+    # MySQL nombra la clave (uq_dispositivo_lote); SQLite, las columnas de la tabla
+    return "uq_dispositivo_lote" in mensaje or "lotes_procesados." in mensaje
+
+
+def filtrar_guardados(db: Session, lotes) -> set:
+    """De los lotes (dispositivo, lote_id) dados, los que ya están en la BD."""
+    lotes = {l for l in lotes if l is not None}
+    if not lotes:
+        return set()
+    filas = db.query(models.LoteProcesado.dispositivo, models.LoteProcesado.lote_id).filter(
+        models.LoteProcesado.dispositivo.in_({d for d, _ in lotes}),
+        models.LoteProcesado.lote_id.in_({s for _, s in lotes})
+    ).all()
+    return {tuple(f) for f in filas} & lotes
+
+
+def registrar(db: Session, lotes):
+    """Inserta los lotes en la transacción en curso (y purga los viejos cada hora)."""
+    lotes = [{"dispositivo": d, "lote_id": s} for d, s in lotes]
+    if lotes:
+        db.execute(insert(models.LoteProcesado), lotes)
+
+    ahora = datetime.now()
+    if _ultima_purga["en"] is None or ahora - _ultima_purga["en"] > timedelta(hours=1):
+        _ultima_purga["en"] = ahora
+        db.query(models.LoteProcesado).filter(
+            models.LoteProcesado.creado_en < ahora - timedelta(hours=IDEMPOTENCIA_RETENCION_HORAS)
+        ).delete(synchronize_session=False)
@@ -0,0 +1,521 @@
+import os
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, insert, or_, update
+from sqlalchemy.orm import Session
+
+import agregados
+import deadband
+import idempotencia
+import models
+import recientes
+import reglas
+import ruteo
+import ultimos
+from database import SessionLocal
+from mediciones import LECTURAS_UNICAS, TABLAS_LECTURA
+
+# Sensores soportados
+SENSORES_VALIDOS = ("mq135", "mq4", "mq7")
+# Estado en texto -> enum de columna, sin pasar por el constructor de Enum en cada lectura
+_ESTADOS = {e.value: e for e in models.EstadoLecturaEnum}
+
+# Eventos iguales (usuario, sensor, estado) separados por menos de esta ventana
+# se acumulan en una sola notificación; 0 desactiva la agrupación
+NOTIFICACION_VENTANA_SEGUNDOS = int(os.getenv("NOTIFICACION_VENTANA_SEGUNDOS", "300"))
+
+
+# ----------- SEVERIDAD -----------
+def calcular_severidad_dinamica(sensor_codigo: str, valor: float, db: Session) -> str:
+    """Calcula severidad (bueno/advertencia/malo) usando umbrales configurables."""
+    return reglas.obtener(db).severidad(sensor_codigo, valor)
+
+
+# ----------- NOTIFICACIONES -----------
+
+# Textos por sensor y estado: (tipo, título, mensaje)
+_TEXTOS_NOTIFICACION = {
+    "mq135": {
+        "bueno": ("info", "Calidad del aire buena", "Los niveles de CO₂ están en rango normal"),
+        "advertencia": ("warning", "Advertencia de calidad del aire", "Los niveles de CO₂ están elevados"),
+        "malo": ("danger", "Alerta de calidad del aire", "Los niveles de CO₂ son peligrosos"),
+    },
+    "mq7": {
+        "bueno": ("info", "Monóxido de carbono normal", "Los niveles de CO están en rango seguro"),
+        "advertencia": ("warning", "Advertencia de monóxido de carbono", "Los niveles de CO están elevados"),
+        "malo": ("danger", "Alerta de monóxido de carbono", "Los niveles de CO son peligrosos"),
+    },
+    "mq4": {
+        "bueno": ("info", "Metano normal", "Los niveles de metano están en rango seguro"),
+        "advertencia": ("warning", "Advertencia de metano", "Los niveles de metano están elevados"),
+        "malo": ("danger", "Alerta de metano", "Los niveles de metano son peligrosos"),
+    },
+}
+
+
+def construir_notificacion(usuario_id: int, sensor_codigo: str, valor: float, estado: str) -> dict | None:
+    """Fila de notificación a insertar (la decisión de notificar la toma reglas)."""
+    textos = _TEXTOS_NOTIFICACION.get(sensor_codigo, {}).get(estado)
+    if not textos:
+        return None
+    tipo, titulo, mensaje = textos
+    return {
+        "usuario_id": usuario_id,
+        "sensor_codigo": sensor_codigo,
+        "valor": valor,
+        "estado": estado,
+        "titulo": titulo,
+        "mensaje": mensaje,
+        "tipo": tipo,
+        "leida": False,
+    }
+
+
+def agregar_notificaciones(db: Session, eventos: list, ventana: int | None = None):
+    """Escribe eventos de notificación agrupando los repetidos.
+
+    eventos: [(usuario_id, sensor_codigo, estado, valor, momento), ...] en orden
+    de llegada. Los eventos iguales separados por menos de la ventana se funden
+    en una notificación con conteo y primera/última aparición; si ya existe una
+    notificación sin leer dentro de la ventana, se le suman. Todo se escribe con
+    un SELECT, un UPDATE y un INSERT multi-fila; el commit queda para quien llama.
+    """
+    ventana = NOTIFICACION_VENTANA_SEGUNDOS if ventana is None else ventana
+    grupos = {}  # (usuario, sensor, estado) -> [fila, ...]
+    for usuario_id, sensor_codigo, estado, valor, momento in eventos:
+        clave = (usuario_id, sensor_codigo, estado)
+        filas = grupos.setdefault(clave, [])
+        if ventana > 0 and filas and (momento - filas[-1]["ultima_en"]).total_seconds() <= ventana:
+            fila = filas[-1]
+            fila["conteo"] += 1
+            fila["valor"] = valor
+            fila["ultima_en"] = max(fila["ultima_en"], momento)
+            continue
+        fila = construir_notificacion(usuario_id, sensor_codigo, valor, estado)
+        if fila:
+            fila.update(conteo=1, primera_en=momento, ultima_en=momento, creado_en=momento)
+            filas.append(fila)
+    grupos = {clave: filas for clave, filas in grupos.items() if filas}
+    if not grupos:
+        return
+
+    acumular = []
+    if ventana > 0:
+        N = models.Notificacion
+        desde = min(f[0]["primera_en"] for f in grupos.values())
+        abiertas = {}
+        for id_, usuario_id, sensor_codigo, estado, ultima_en in db.query(
+            N.id, N.usuario_id, N.sensor_codigo, N.estado, N.ultima_en
+        ).filter(
+            N.usuario_id.in_({c[0] for c in grupos}),
+            N.leida == False,
+            N.ultima_en >= desde - timedelta(seconds=ventana)
+        ).order_by(N.ultima_en).all():
+            abiertas[(usuario_id, sensor_codigo, estado)] = (id_, ultima_en)  # queda la más reciente
+
+        for clave, filas in grupos.items():
+            abierta = abiertas.get(clave)
+            if abierta is None:
+                continue
+            id_, ultima_en = abierta
+            primera = filas[0]
+            if (primera["primera_en"] - ultima_en.replace(tzinfo=None)).total_seconds() <= ventana:
+                acumular.append({
+                    "b_id": id_,
+                    "b_conteo": primera["conteo"],
+                    "b_valor": primera["valor"],
+                    "b_ultima": max(ultima_en.replace(tzinfo=None), primera["ultima_en"]),
+                })
+                filas.pop(0)
+
+    if acumular:
+        tabla = models.Notificacion.__table__
+        db.execute(
+            update(tabla).where(tabla.c.id == bindparam("b_id")).values(
+                conteo=tabla.c.conteo + bindparam("b_conteo"),
+                valor=bindparam("b_valor"),
+                ultima_en=bindparam("b_ultima"),
+            ),
+            acumular,
+        )
+    nuevas = [f for filas in grupos.values() for f in filas]
+    if nuevas:
+        db.execute(insert(models.Notificacion), nuevas)
+
+
+def crear_notificacion_si_necesario(db: Session, usuario_id: int, sensor_codigo: str, valor: float, estado: str):
+    """Función para crear notificación si el usuario la tiene configurada"""
+    r = reglas.obtener(db)
+    estado = r.severidad(sensor_codigo, valor)
+    if not r.debe_notificar(usuario_id, sensor_codigo, estado):
+        return
+    agregar_notificaciones(db, [(usuario_id, sensor_codigo, estado, valor, datetime.now())])
+    db.commit()
+
+
+# ---------- ALERTAS PERSONALIZADAS: evaluación de triggers ----------
+def _trigger_matches(valor: float, umbral: float | None, tipo: str) -> bool:
+    if umbral is None:
+        return False
+    try:
+        v = float(valor)
+        u = float(umbral)
+    except Exception:
+        return False
+    t = (tipo or 'igual').lower()
+    if t == 'igual':
+        return v == u
+    if t == 'mayor_igual':
+        return v >= u
+    if t == 'menor_igual':
+        return v <= u
+    return False
+
+
+def evaluar_alerta_personalizada(db: Session, usuario_id: int, sensor_codigo: str, valor: float):
+    r = reglas.obtener(db)
+    umbral, tipo = r.trigger(sensor_codigo)
+    if not _trigger_matches(valor, umbral, tipo):
+        return
+
+    # Calcular severidad con umbrales dinámicos
+    sev = r.severidad(sensor_codigo, valor)
+    alerta = models.AlertaPersonalizada(
+        usuario_id=usuario_id,
+        sensor_codigo=sensor_codigo,
+        valor=float(valor),
+        umbral_usado=float(umbral) if umbral is not None else None,
+        tipo_trigger=str(tipo or 'igual'),
+        severidad_calculada=sev
+    )
+    db.add(alerta)
+    db.commit()
+
+
+# ----------- INGESTA POR LOTES -----------
+
+def _insertar_filas(db: Session, tabla, filas: list):
+    """INSERT multi-fila; separa las filas con creado_en explícito de las que usan el default."""
+    con_fecha = [f for f in filas if f.get("creado_en") is not None]
+    sin_fecha = [{k: v for k, v in f.items() if k != "creado_en"} for f in filas if f.get("creado_en") is None]
+    for grupo in (con_fecha, sin_fecha):
+        if grupo:
+            db.execute(insert(tabla), grupo)
+
+
+def procesar_lote(db: Session, lecturas, lotes=()) -> dict:
+    """Guarda un lote de lecturas para todos sus destinatarios.
+
+    Cada lectura es (sensor_codigo, valor, estado) o (sensor_codigo, valor,
+    estado, creado_en) cuando el momento de la medición ya se conoce (p.ej. al
+    reproducir el spool). estado puede ser None y entonces se clasifica aquí.
+    lotes son los (dispositivo, lote_id) que quedan registrados en la misma
+    transacción para descartar reintentos. Las lecturas y alertas se escriben con
+    INSERT multi-fila, las notificaciones repetidas se agrupan (agregar_notificaciones)
+    y todo el lote se confirma con un único commit. Con LECTURAS_UNICAS cada
+    lectura se guarda una sola vez en mediciones, sin copia por usuario. Con
+    banda muerta configurada (deadband.py) las lecturas estables se acumulan en
+    la fila anterior en lugar de crear una nueva. Los agregados por minuto,
+    hora y día (agregados.py) se actualizan en la misma transacción.
+    """
+    lecturas = [
+        (l[0], float(l[1]), l[2], l[3] if len(l) > 3 else None)
+        for l in lecturas if l[0] in SENSORES_VALIDOS
+    ]
+    destinatarios = ruteo.destinatarios(db, {l[0] for l in lecturas})
+    usuarios = {u for ids in destinatarios.values() for u in ids}
+    if not usuarios:
+        if lotes:
+            idempotencia.registrar(db, lotes)
+            db.commit()
+        return {"total_guardadas": 0, "usuarios": []}
+
+    # Umbrales, triggers y preferencias precompilados (sin consultas)
+    r = reglas.obtener(db)
+
+    filas_lectura = {c: [] for c in SENSORES_VALIDOS}
+    filas_medicion = []
+    eventos_notificacion = []
+    ahora = datetime.now()
+    filas_alerta = []
+    conteo_sesion = {}
+    cubetas = {c: {} for c in SENSORES_VALIDOS}
+    ultimos_lote = {}
+
+    for sensor_codigo, valor, estado, creado_en in lecturas:
+        ids = destinatarios.get(sensor_codigo)
+        if not ids:
+            continue
+        severidad = r.severidad(sensor_codigo, valor)
+        # Sin estado del dispositivo (p.ej. formato binario) se usa la severidad calculada
+        estado_enum = _ESTADOS[estado or severidad]
+        agregados.acumular(cubetas[sensor_codigo], creado_en or ahora, valor, estado_enum.value)
+        ultimos.acumular(ultimos_lote, (ultimos.SENSOR, sensor_codigo), valor, estado_enum.value, creado_en or ahora)
+        umbral, tipo = r.trigger(sensor_codigo)
+        dispara = _trigger_matches(valor, umbral, tipo)
+        if LECTURAS_UNICAS:
+            filas_medicion.append({"sensor_codigo": sensor_codigo, "valor": valor, "estado": estado_enum, "creado_en": creado_en})
+
+        for usuario_id in ids:
+            if not LECTURAS_UNICAS:
+                filas_lectura[sensor_codigo].append({"usuario_id": usuario_id, "valor": valor, "estado": estado_enum, "creado_en": creado_en})
+
+            if r.debe_notificar(usuario_id, sensor_codigo, severidad):
+                eventos_notificacion.append((usuario_id, sensor_codigo, severidad, valor, creado_en or ahora))
+
+            if dispara:
+                filas_alerta.append({
+                    "usuario_id": usuario_id,
+                    "sensor_codigo": sensor_codigo,
+                    "valor": valor,
+                    "umbral_usado": float(umbral),
+                    "tipo_trigger": str(tipo or 'igual'),
+                    "severidad_calculada": severidad,
+                    "creado_en": creado_en,
+                })
+
+            clave = (usuario_id, sensor_codigo)
+            conteo_sesion[clave] = conteo_sesion.get(clave, 0) + 1
+
+    sesiones = ruteo.sesiones_activas(db, conteo_sesion) if conteo_sesion else {}
+
+    # Lecturas por usuario y sensor: solo los sensores con anillos de /lecturas/me cargados
+    destinatarios_lectura = {c: destinatarios[c] for c, filas in filas_lectura.items() if filas}
+    marcas = recientes.marcar(db, destinatarios_lectura)
+
+    for sensor_codigo, filas in filas_lectura.items():
+        epsilon = r.deadband.get(sensor_codigo, 0)
+        if epsilon > 0:
+            por_usuario = {u: sesion_id for (u, c), sesion_id in sesiones.items() if c == sensor_codigo}
+            deadband.guardar(db, TABLAS_LECTURA[sensor_codigo], "usuario_id", filas, epsilon, _insertar_filas, por_usuario, ahora)
+        else:
+            _insertar_filas(db, TABLAS_LECTURA[sensor_codigo], filas)
+    if any(r.deadband.get(c, 0) > 0 for c in SENSORES_VALIDOS):
+        for sensor_codigo in SENSORES_VALIDOS:
+            filas = [f for f in filas_medicion if f["sensor_codigo"] == sensor_codigo]
+            epsilon = r.deadband.get(sensor_codigo, 0)
+            if epsilon > 0:
+                deadband.guardar(db, models.Medicion, "sensor_codigo", filas, epsilon, _insertar_filas, ahora=ahora)
+            else:
+                _insertar_filas(db, models.Medicion, filas)
+    else:
+        _insertar_filas(db, models.Medicion, filas_medicion)
+    agregar_notificaciones(db, eventos_notificacion)
+    _insertar_filas(db, models.AlertaPersonalizada, filas_alerta)
+    # Todas las lecturas de un sensor van a los mismos destinatarios: mismas cubetas
+    agregados.guardar(db, [
+        (usuario_id, sensor_codigo, cubetas[sensor_codigo])
+        for sensor_codigo, ids in destinatarios.items() if cubetas.get(sensor_codigo)
+        for usuario_id in ids
+    ])
+    # La última lectura de cada sensor es también la de cada uno de sus destinatarios
+    for (_, sensor_codigo), lectura in list(ultimos_lote.items()):
+        for usuario_id in destinatarios[sensor_codigo]:
+            ultimos_lote[(usuario_id, sensor_codigo)] = lectura
+    ultimos.guardar(db, ultimos_lote)
+    nuevas = recientes.leer(db, marcas, destinatarios_lectura)
+
+    total_guardadas = sum(conteo_sesion.values())
+    usuarios_afectados = sorted({u for u, _ in conteo_sesion})
+
+    # Contadores de las sesiones de captura activas: un UPDATE atómico por sesión
+    if conteo_sesion:
+        incrementos = [
+            {"b_id": sesion_id, "b_n": conteo_sesion[clave]}
+            for clave, sesion_id in sesiones.items()
+        ]
+        if incrementos:
+            tabla = models.SesionCaptura.__table__
+            db.execute(
+                update(tabla).where(tabla.c.id == bindparam("b_id"), tabla.c.activo == True).values(
+                    total_lecturas=tabla.c.total_lecturas + bindparam("b_n")
+                ),
+                incrementos,
+            )
+
+    if lotes:
+        idempotencia.registrar(db, lotes)
+    db.commit()
+    recientes.aplicar(nuevas, destinatarios_lectura)
+    ultimos.actualizar(ultimos_lote)
+    return {"total_guardadas": total_guardadas, "usuarios": usuarios_afectados}
+
+
+def procesar_peticiones(db: Session, peticiones) -> dict:
+    """Guarda varias peticiones [(lecturas, lote | None), ...] en una transacción.
+
+    Descarta las que repiten un lote ya guardado (reintentos del dispositivo o
+    tramos del spool reproducidos dos veces).
+    """
+    vistos = idempotencia.filtrar_guardados(db, [lote for _, lote in peticiones])
+    lecturas = []
+    lotes = []
+    for lecturas_peticion, lote in peticiones:
+        if lote is not None:
+            if lote in vistos:
+                continue
+            vistos.add(lote)
+            lotes.append(lote)
+        lecturas.extend(lecturas_peticion)
+    return procesar_lote(db, lecturas, lotes)
+
+
+def procesar_peticiones_en_sesion(peticiones) -> dict:
+    """procesar_peticiones con una sesión propia (para llamarlo fuera de get_db)."""
+    db = SessionLocal()
+    try:
+        return procesar_peticiones(db, peticiones)
+    except Exception:
+        db.rollback()
+        # Las rachas abiertas en memoria pueden apuntar a filas que no llegaron a guardarse
+        deadband.invalidar()
+        raise
+    finally:
+        db.close()
+
+
+# ----------- BACKFILL (LECTURAS ATRASADAS CON TIMESTAMP) -----------
+
+def _sin_tz(momento: datetime) -> datetime:
+    """Hora local sin zona, como la guardan las columnas DateTime de la BD."""
+    return momento.astimezone().replace(tzinfo=None) if momento.tzinfo else momento
+
+
+def _incrementar_sesiones(db: Session, conteo: dict):
+    """total_lecturas += n por id de sesión (activa o ya finalizada), en un executemany."""
+    if not conteo:
+        return
+    tabla = models.SesionCaptura.__table__
+    db.execute(
+        update(tabla).where(tabla.c.id == bindparam("b_id")).values(
+            total_lecturas=tabla.c.total_lecturas + bindparam("b_n")
+        ),
+        [{"b_id": sesion_id, "b_n": n} for sesion_id, n in conteo.items()],
+    )
+
+
+def procesar_backfill(db: Session, lecturas, lote: tuple | None = None) -> dict:
+    """Guarda lecturas atrasadas en las sesiones de captura que cubrían su momento.
+
+    Cada lectura es (sensor_codigo, valor, estado | None, creado_en) y pueden
+    llegar desordenadas. Los destinatarios no son los usuarios activos ahora,
+    sino los que tenían una sesión de captura de ese sensor abierta en ese
+    momento; las lecturas que no caen en ninguna sesión se descartan. Se
+    generan las alertas personalizadas (con su fecha original) pero no
+    notificaciones, que ya no serían actuales. Los contadores de cada sesión
+    afectada se incrementan en lugar de recalcularse.
+    """
+    if lote is not None and idempotencia.filtrar_guardados(db, [lote]):
+        return {"total_guardadas": 0, "usuarios": [], "descartadas": 0, "duplicado": True}
+
+    lecturas = sorted(
+        ((l[0], float(l[1]), l[2], _sin_tz(l[3])) for l in lecturas if l[0] in SENSORES_VALIDOS),
+        key=lambda l: l[3],
+    )
+    por_sensor = {}
+    for lectura in lecturas:
+        por_sensor.setdefault(lectura[0], []).append(lectura)
+    tiempos = {c: [l[3] for l in lista] for c, lista in por_sensor.items()}
+
+    sesiones = []
+    if lecturas:
+        S = models.SesionCaptura
+        sesiones = db.query(S.id, S.usuario_id, S.sensor_codigo, S.iniciado_en, S.finalizado_en).filter(
+            S.sensor_codigo.in_(list(por_sensor)),
+            S.iniciado_en <= lecturas[-1][3],
+            or_(S.finalizado_en.is_(None), S.finalizado_en >= lecturas[0][3])
+        ).all()
+
+    r = reglas.obtener(db)
+    severidades = {c: [r.severidad(c, l[1]) for l in lista] for c, lista in por_sensor.items()}
+    filas_lectura = {c: [] for c in SENSORES_VALIDOS}
+    filas_alerta = []
+    cubiertas = {c: set() for c in por_sensor}
+    conteo_sesion = {}
+    usuarios = set()
+    grupos_agregados = []
+    ultimos_lote = {}
+
+    for sesion_id, usuario_id, sensor_codigo, iniciado_en, finalizado_en in sesiones:
+        lista = por_sensor[sensor_codigo]
+        # Lecturas del sensor dentro de [iniciado_en, finalizado_en] por búsqueda binaria
+        i = bisect_left(tiempos[sensor_codigo], _sin_tz(iniciado_en)) if iniciado_en else 0
+        j = bisect_right(tiempos[sensor_codigo], _sin_tz(finalizado_en)) if finalizado_en else len(lista)
+        if i >= j:
+            continue
+        umbral, tipo = r.trigger(sensor_codigo)
+        cubetas = {}
+        for k in range(i, j):
+            _, valor, estado, creado_en = lista[k]
+            severidad = severidades[sensor_codigo][k]
+            cubiertas[sensor_codigo].add(k)
+            agregados.acumular(cubetas, creado_en, valor, estado or severidad)
+            if not LECTURAS_UNICAS:
+                filas_lectura[sensor_codigo].append({
+                    "usuario_id": usuario_id,
+                    "valor": valor,
+                    "estado": _ESTADOS[estado or severidad],
+                    "creado_en": creado_en,
+                })
+            if _trigger_matches(valor, umbral, tipo):
+                filas_alerta.append({
+                    "usuario_id": usuario_id,
+                    "sensor_codigo": sensor_codigo,
+                    "valor": valor,
+                    "umbral_usado": float(umbral),
+                    "tipo_trigger": str(tipo or 'igual'),
+                    "severidad_calculada": severidad,
+                    "creado_en": creado_en,
+                })
+        conteo_sesion[sesion_id] = conteo_sesion.get(sesion_id, 0) + (j - i)
+        # La lista está ordenada por momento: la última del tramo es la más reciente
+        _, valor, estado, creado_en = lista[j - 1]
+        for clave in ((usuario_id, sensor_codigo), (ultimos.SENSOR, sensor_codigo)):
+            ultimos.acumular(ultimos_lote, clave, valor, _ESTADOS[estado or severidades[sensor_codigo][j - 1]].value, creado_en)
+        usuarios.add(usuario_id)
+        grupos_agregados.append((usuario_id, sensor_codigo, cubetas))
+
+    if LECTURAS_UNICAS:
+        filas_medicion = []
+        for sensor_codigo, indices in cubiertas.items():
+            for k in sorted(indices):
+                _, valor, estado, creado_en = por_sensor[sensor_codigo][k]
+                filas_medicion.append({
+                    "sensor_codigo": sensor_codigo,
+                    "valor": valor,
+                    "estado": _ESTADOS[estado or severidades[sensor_codigo][k]],
+                    "creado_en": creado_en,
+                })
+        _insertar_filas(db, models.Medicion, filas_medicion)
+    for sensor_codigo, filas in filas_lectura.items():
+        _insertar_filas(db, TABLAS_LECTURA[sensor_codigo], filas)
+    _insertar_filas(db, models.AlertaPersonalizada, filas_alerta)
+    _incrementar_sesiones(db, conteo_sesion)
+    agregados.guardar(db, grupos_agregados)
+    ultimos.guardar(db, ultimos_lote)
+
+    if lote is not None:
+        idempotencia.registrar(db, [lote])
+    db.commit()
+    ultimos.actualizar(ultimos_lote)
+    # Lecturas atrasadas: quedan en medio de los anillos de /lecturas/me, que se vuelven a cargar
+    for sensor_codigo, filas in filas_lectura.items():
+        for usuario_id in {f["usuario_id"] for f in filas}:
+            recientes.invalidar(usuario_id, sensor_codigo)
+    return {
+        "total_guardadas": sum(conteo_sesion.values()),
+        "usuarios": sorted(usuarios),
+        "descartadas": len(lecturas) - sum(len(c) for c in cubiertas.values()),
+    }
+
+
+def procesar_backfill_en_sesion(lecturas, lote: tuple | None = None) -> dict:
+    db = SessionLocal()
+    try:
+        return procesar_backfill(db, lecturas, lote)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
@@ -0,0 +1,116 @@
+"""Control de admisión de la ingesta: cubeta de tokens por dispositivo y contrapresión.
+
+Cada dispositivo (o cada IP de origen, si la placa usa la clave global sin
+X-Dispositivo) tiene una cubeta que se rellena a ingesta_peticiones_por_seg hasta ingesta_rafaga
+(ConfiguracionSistema). Detrás de un proxy (Railway) la IP de origen sale de
+X-Forwarded-For: la entrada que agregó el último de los
+INGESTA_PROXIES_CONFIABLES proxies (0 = usar la IP de la conexión).
+
+Además, si la cola del escritor asíncrono pasa de INGESTA_PRESION_COLA de su
+capacidad o la latencia reciente de escritura en la BD supera
+INGESTA_LATENCIA_MAX_MS, se rechaza toda la ingesta con un Retry-After
+calculado para que las placas esperen antes de saturar la API. La latencia se
+mide por commit de la ingesta en vivo, escalada a un lote de
+INGESTA_LATENCIA_LECTURAS lecturas (un lote grande no cuenta como BD lenta),
+y cada muestra se acota a 2x el máximo: hacen falta varios commits lentos
+seguidos para rechazar, no uno solo.
+"""
+import math
+import os
+import random
+import threading
+import time
+
+INGESTA_PRESION_COLA = float(os.getenv("INGESTA_PRESION_COLA", "0.8"))        # fracción de la cola
+INGESTA_LATENCIA_MAX_MS = float(os.getenv("INGESTA_LATENCIA_MAX_MS", "1000"))
+INGESTA_LATENCIA_LECTURAS = int(os.getenv("INGESTA_LATENCIA_LECTURAS", "100"))  # lote de referencia
+INGESTA_PROXIES_CONFIABLES = int(os.getenv("INGESTA_PROXIES_CONFIABLES", "1"))
+LIMITADOR_CUBETAS_MAX = int(os.getenv("LIMITADOR_CUBETAS_MAX", "10000"))
+
+_lock = threading.Lock()
+_cubetas: dict[str, list] = {}  # clave -> [tokens, último relleno (monotonic)]
+_latencia = {"ms": 0.0, "en": 0.0}
+
+# La latencia registrada se olvida con esta constante de tiempo: si se rechaza
+# todo y no hay escrituras nuevas, la presión baja sola y se vuelve a admitir
+LATENCIA_OLVIDO_SEGUNDOS = 10.0
+
+
+def registrar_latencia(ms: float, lecturas: int):
+    """Media móvil de lo que tarda un commit de ingesta en vivo de lecturas en la BD."""
+    if lecturas > INGESTA_LATENCIA_LECTURAS:
+        ms *= INGESTA_LATENCIA_LECTURAS / lecturas
+    ms = min(ms, 2 * INGESTA_LATENCIA_MAX_MS)
+    # La media parte de 0: una sola muestra nunca llega al máximo
+    _latencia["ms"] = 0.8 * latencia_ms() + 0.2 * ms
+    _latencia["en"] = time.monotonic()
+
+
+def latencia_ms() -> float:
+    if not _latencia["ms"]:
+        return 0.0
+    return _latencia["ms"] * math.exp(-(time.monotonic() - _latencia["en"]) / LATENCIA_OLVIDO_SEGUNDOS)
+
+
+def cliente(directo: str | None, reenviado: str | None) -> str | None:
+    """IP de origen: de X-Forwarded-For (reenviado) según INGESTA_PROXIES_CONFIABLES, o la de la conexión."""
+    if INGESTA_PROXIES_CONFIABLES and reenviado:
+        ips = [ip.strip() for ip in reenviado.split(",") if ip.strip()]
+        # Las entradas de la derecha las agregaron nuestros proxies; las de la izquierda, el cliente
+        if len(ips) >= INGESTA_PROXIES_CONFIABLES:
+            return ips[-INGESTA_PROXIES_CONFIABLES]
+    return directo
+
+
+def _purgar(ahora: float, tasa: float, rafaga: int):
+    """Quita cubetas llenas (inactivas) para acotar la memoria."""
+    for clave in [c for c, (tokens, ultimo) in _cubetas.items() if tokens + (ahora - ultimo) * tasa >= rafaga]:
+        del _cubetas[clave]
+
+
+def consumir(clave: str, tasa: float, rafaga: int, costo: float = 1.0) -> int:
+    """Gasta tokens de la cubeta. 0 si hay saldo; si no, segundos hasta que lo haya."""
+    if tasa <= 0:
+        return 0
+    ahora = time.monotonic()
+    with _lock:
+        cubeta = _cubetas.get(clave)
+        if cubeta is None:
+            if len(_cubetas) >= LIMITADOR_CUBETAS_MAX:
+                _purgar(ahora, tasa, rafaga)
+            cubeta = _cubetas[clave] = [float(rafaga), ahora]
+        cubeta[0] = min(float(rafaga), cubeta[0] + (ahora - cubeta[1]) * tasa)
+        cubeta[1] = ahora
+        if cubeta[0] >= costo:
+            cubeta[0] -= costo
+            return 0
+        return max(1, math.ceil((costo - cubeta[0]) / tasa))
+
+
+def presion(profundidad: int, capacidad: int, retry_cola: int) -> int:
+    """Retry-After por sobrecarga (cola casi llena o BD lenta); 0 si se puede admitir."""
+    espera = 0
+    if capacidad and profundidad >= capacidad * INGESTA_PRESION_COLA:
+        espera = retry_cola
+    latencia = latencia_ms()
+    if latencia > INGESTA_LATENCIA_MAX_MS:
+        espera = max(espera, math.ceil(latencia / INGESTA_LATENCIA_MAX_MS))
+    if not espera:
+        return 0
+    # Un poco de dispersión para que las placas no vuelvan todas a la vez
+    return min(60, espera + random.randint(0, max(1, espera // 2)))
+
+
+def carga(profundidad: int, capacidad: int) -> float:
+    """Carga de la ingesta de 0 (libre) a 1 (en el límite de presion()), para muestreo.py."""
+    cola = profundidad / (capacidad * INGESTA_PRESION_COLA) if capacidad else 0.0
+    return max(0.0, min(1.0, max(cola, latencia_ms() / INGESTA_LATENCIA_MAX_MS)))
+
+
+def estado() -> dict:
+    return {
+        "cubetas": len(_cubetas),
+        "latencia_bd_ms": round(latencia_ms(), 2),
+        "presion_cola": INGESTA_PRESION_COLA,
+        "latencia_max_ms": INGESTA_LATENCIA_MAX_MS,
+    }
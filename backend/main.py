@@ -1,13 +1,22 @@
 
 
-from fastapi import FastAPI, Depends, HTTPException, Header
+from fastapi import FastAPI, Depends, HTTPException, Header, Request, WebSocket, WebSocketDisconnect
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
 from sqlalchemy import func, cast, String, text
+from sqlalchemy.exc import IntegrityError
 import os
+import time
 from dotenv import load_dotenv
 
 from database import get_db, engine
-import models, schemas, auth
+import models, schemas, auth, ruteo, reglas, escritor, formato_binario, idempotencia, mediciones, dispositivos, limitador, validacion, deadband, muestreo, calibracion, agregados, archivo, recientes, ultimos
+from spool import spool, INGESTA_SPOOL
+from retencion import retencion, RETENCION_LECTURAS_DIAS, horizonte as retencion_horizonte
+from ingesta import calcular_severidad_dinamica, procesar_peticiones_en_sesion, procesar_backfill_en_sesion
 
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -45,42 +54,6 @@ app.add_middleware(
 
 # ----------- ENDPOINTS -----------
 
-# ----------- UTILIDADES DE UMBRALES Y SEVERIDAD -----------
-def _get_thresholds(db: Session) -> dict:
-    """Obtiene umbrales globales configurados; si no existen, usa defaults."""
-    cfg = db.query(models.ConfiguracionSistema).first()
-    return {
-        "mq135_warning": float(getattr(cfg, "mq135_warning_threshold", 400) or 400),
-        "mq135_bad": float(getattr(cfg, "mq135_bad_threshold", 1000) or 1000),
-        "mq4_warning": float(getattr(cfg, "mq4_warning_threshold", 1000) or 1000),
-        "mq4_bad": float(getattr(cfg, "mq4_bad_threshold", 5000) or 5000),
-        "mq7_warning": float(getattr(cfg, "mq7_warning_threshold", 9) or 9),
-        "mq7_bad": float(getattr(cfg, "mq7_bad_threshold", 35) or 35),
-        # volumen
-        "mq135_win_h": int(getattr(cfg, "mq135_min_count_window_hours", 1) or 1),
-        "mq135_min_count": int(getattr(cfg, "mq135_min_count_threshold", 1) or 1),
-        "mq4_win_h": int(getattr(cfg, "mq4_min_count_window_hours", 1) or 1),
-        "mq4_min_count": int(getattr(cfg, "mq4_min_count_threshold", 1) or 1),
-        "mq7_win_h": int(getattr(cfg, "mq7_min_count_window_hours", 1) or 1),
-        "mq7_min_count": int(getattr(cfg, "mq7_min_count_threshold", 1) or 1),
-    }
-
-def calcular_severidad_dinamica(sensor_codigo: str, valor: float, db: Session) -> str:
-    """Calcula severidad (bueno/advertencia/malo) usando umbrales configurables."""
-    try:
-        v = float(valor)
-    except Exception:
-        return "bueno"
-    th = _get_thresholds(db)
-    sc = (sensor_codigo or "").lower()
-    if sc == "mq135":
-        return "bueno" if v < th["mq135_warning"] else ("advertencia" if v < th["mq135_bad"] else "malo")
-    if sc == "mq4":
-        return "bueno" if v < th["mq4_warning"] else ("advertencia" if v < th["mq4_bad"] else "malo")
-    if sc == "mq7":
-        return "bueno" if v < th["mq7_warning"] else ("advertencia" if v < th["mq7_bad"] else "malo")
-    return "bueno"
-
 # Obtener usuario por id
 @app.get("/usuarios/{usuario_id}")
 def obtener_usuario(usuario_id: int, current_user: models.Usuario = Depends(auth.get_current_user), db: Session = Depends(get_db)):
@@ -287,7 +260,12 @@ def eliminar_usuario(usuario_id: int, current_user: models.Usuario = Depends(aut
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
     
     db.delete(db_usuario)
+    ultimos.olvidar_usuario(db, usuario_id)
     db.commit()
+    ultimos.invalidar()
+    ruteo.olvidar_usuario(usuario_id)
+    reglas.actualizar_usuario(usuario_id, None)
+    recientes.invalidar(usuario_id)
     return {"mensaje": "Usuario eliminado correctamente"}
 
 @app.get("/")
@@ -416,6 +394,9 @@ def actualizar_sensores_usuario(usuario_id: int, payload: schemas.UsuarioSensorU
         relacion = models.UsuarioSensor(usuario_id=usuario_id, sensor_id=sensor_id)
         db.add(relacion)
     db.commit()
+
+    codigos = [c for (c,) in db.query(models.Sensor.codigo).filter(models.Sensor.id.in_(payload.asignados)).all()]
+    ruteo.reemplazar_asignaciones(usuario_id, codigos)
     return {"mensaje": "Sensores actualizados"}
 
 
@@ -494,23 +475,15 @@ def activar_captura(sensor_codigo: str, current_user: models.Usuario = Depends(a
     # Consideramos reciente si hubo lecturas en los últimos SENSOR_CONNECT_GRACE_SECONDS segundos
     reciente_seg = max(5, min(SENSOR_CONNECT_GRACE_SECONDS, 300))
     limite_sql = func.date_sub(func.now(), text(f"INTERVAL {reciente_seg} SECOND"))
+    # Cota inferior de creado_en para las rachas de banda muerta (mediciones.desde_racha)
+    inicio_sql = func.date_sub(func.now(), text(f"INTERVAL {reciente_seg + deadband.DEADBAND_RACHA_MAX_SEGUNDOS} SECOND"))
 
     tiene_lecturas_recientes = False
     recientes_count = 0
-    if sensor_codigo == 'mq135':
-        recientes_count = db.query(func.count(models.LecturaMQ135.id)).filter(
-            models.LecturaMQ135.usuario_id == current_user.id,
-            models.LecturaMQ135.creado_en >= limite_sql
-        ).scalar() or 0
-    elif sensor_codigo == 'mq4':
-        recientes_count = db.query(func.count(models.LecturaMQ4.id)).filter(
-            models.LecturaMQ4.usuario_id == current_user.id,
-            models.LecturaMQ4.creado_en >= limite_sql
-        ).scalar() or 0
-    elif sensor_codigo == 'mq7':
-        recientes_count = db.query(func.count(models.LecturaMQ7.id)).filter(
-            models.LecturaMQ7.usuario_id == current_user.id,
-            models.LecturaMQ7.creado_en >= limite_sql
+    if sensor_codigo in mediciones.TABLAS_LECTURA:
+        query, tabla = mediciones.consulta_lecturas(db, current_user.id, sensor_codigo)
+        recientes_count = query.with_entities(func.count(tabla.id)).filter(
+            mediciones.desde_racha(db, tabla, limite_sql, inicio_sql)
         ).scalar() or 0
     tiene_lecturas_recientes = recientes_count > 0
 
@@ -562,6 +535,7 @@ def activar_captura(sensor_codigo: str, current_user: models.Usuario = Depends(a
         # El frontend mostrará estado 'Conectando' durante unos segundos
     
     db.commit()
+    ruteo.marcar_activo(current_user.id, sensor_codigo, True)
     
     return {
         "mensaje": f"Captura activada para {sensor_codigo.upper()}",
@@ -610,6 +584,7 @@ def desactivar_captura(sensor_codigo: str, current_user: models.Usuario = Depend
         db.delete(sesion_activa)
     
     db.commit()
+    ruteo.marcar_activo(current_user.id, sensor_codigo, False)
     return {"mensaje": "OK"}
 
 
@@ -617,110 +592,462 @@ def desactivar_captura(sensor_codigo: str, current_user: models.Usuario = Depend
 
 
 
-DEVICE_API_KEY = os.getenv("DEVICE_API_KEY", "ESP32_SENSOR_KEY_2024")
+DEVICE_API_KEY = dispositivos.DEVICE_API_KEY
+
+
+async def _autenticar_dispositivo(api_key: str | None, declarado: str | None) -> str | None:
+    """Dispositivo de la petición: el registrado para la clave o, con la clave global,
+    "legado:" + el declarado en X-Dispositivo. Lanza 401 si la clave no es válida."""
+    if dispositivos.necesita_recarga():
+        await run_in_threadpool(dispositivos.recargar)
+    dispositivo = dispositivos.autenticar(api_key)
+    if dispositivo is None:
+        raise HTTPException(status_code=401, detail="API key inválida")
+    return dispositivos.identificar(dispositivo, declarado)
+
+
+def _cliente(conexion) -> str | None:
+    """IP de origen de una petición o WebSocket (tras el proxy, ver limitador.cliente)."""
+    return limitador.cliente(conexion.client.host if conexion.client else None, conexion.headers.get("x-forwarded-for"))
+
 
-@app.post("/lecturas/device")
-def crear_lectura_device(
-    data: schemas.LecturaCreateDevice,
+async def _admitir(dispositivo: str | None, cliente: str | None) -> int:
+    """0 si se admite la petición; si no, segundos para Retry-After (sobrecarga o cubeta vacía).
+
+    Las placas con la clave global y sin X-Dispositivo tienen una cubeta por IP
+    de origen (cliente), no una sola para toda la flota.
+    """
+    if escritor.INGESTA_ASINCRONA:
+        espera = limitador.presion(escritor.escritor.profundidad(), escritor.escritor.capacidad(), escritor.escritor.retry_after())
+    else:
+        espera = limitador.presion(0, 0, 0)
+    if espera:
+        return espera
+    if not reglas.version():
+        await run_in_threadpool(reglas.obtener_en_sesion)
+    tasa, rafaga = reglas.obtener_en_sesion().ingesta
+    return limitador.consumir(dispositivo or f"legado@{cliente}", tasa, rafaga)
+
+
+def _muestreo(dispositivo: str | None) -> dict:
+    """Intervalo y lote recomendados al dispositivo según su señal y la carga actual."""
+    if escritor.INGESTA_ASINCRONA:
+        carga = limitador.carga(escritor.escritor.profundidad(), escritor.escritor.capacidad())
+    else:
+        carga = limitador.carga(0, 0)
+    return muestreo.recomendacion(dispositivo, reglas.obtener_en_sesion().limites, carga)
+
+
+async def _decodificar_binario(cuerpo, dispositivo: str | None, temperatura: float | None = None) -> list[tuple]:
+    """Formato binario con valores en ppm o, con FLAG_ADC, cuentas crudas que se calibran aquí.
+
+    Lanza ValueError si el cuerpo es inválido.
+    """
+    if not formato_binario.es_adc(cuerpo):
+        return formato_binario.decodificar(cuerpo)
+    if calibracion.necesita_recarga():
+        await run_in_threadpool(calibracion.recargar)
+    return calibracion.decodificar(cuerpo, dispositivo, temperatura)
+
+@app.post(
+    "/lecturas/device",
+    openapi_extra={"requestBody": {"content": {
+        "application/json": {"schema": schemas.LecturaCreateDevice.model_json_schema()},
+        formato_binario.CONTENT_TYPE: {"schema": {"type": "string", "format": "binary"}},
+    }, "required": True}},
+)
+async def crear_lectura_device(
+    request: Request,
     x_api_key: str | None = Header(default=None, alias="X-API-KEY"),
-    db: Session = Depends(get_db)
+    x_dispositivo: str | None = Header(default=None, alias="X-Dispositivo", max_length=64),
+    x_lote_id: str | None = Header(default=None, alias="X-Lote-Id", max_length=64),
+    x_temperatura: float | None = Header(default=None, alias="X-Temperatura")
 ):
-    # Validar API KEY
-    if not x_api_key or x_api_key != DEVICE_API_KEY:
-        raise HTTPException(status_code=401, detail="API key inválida")
+    # Validar API KEY (por dispositivo o global)
+    dispositivo = await _autenticar_dispositivo(x_api_key, x_dispositivo)
 
-    # Procesar cada lectura del array
-    total_guardadas = 0
-    usuarios_afectados = set()
-    
-    for lectura in data.lecturas:
-        # Verificar que el sensor es válido
-        if lectura.sensor_codigo not in ['mq135', 'mq4', 'mq7']:
-            continue
+    # Límite por dispositivo y contrapresión antes de leer el cuerpo
+    espera = await _admitir(dispositivo, _cliente(request))
+    if espera:
+        raise HTTPException(status_code=429, detail="Demasiadas peticiones", headers={"Retry-After": str(espera)})
 
-        # Buscar usuarios que tienen activo este sensor
-        sensores_activos = db.query(models.SensoresActivos).filter(
-            getattr(models.SensoresActivos, f"{lectura.sensor_codigo}_activo") == True
-        ).all()
-        
-        if not sensores_activos:
-            continue
-
-        # Filtrar por usuarios que tengan ASIGNADO este sensor
-        sensor_obj = db.query(models.Sensor).filter(models.Sensor.codigo == lectura.sensor_codigo).first()
-        if not sensor_obj:
-            continue
-        usuarios_con_permiso = []
-        for sensor_activo in sensores_activos:
-            asignacion = db.query(models.UsuarioSensor).filter(
-                models.UsuarioSensor.usuario_id == sensor_activo.usuario_id,
-                models.UsuarioSensor.sensor_id == sensor_obj.id
-            ).first()
-            if asignacion:
-                usuarios_con_permiso.append(sensor_activo)
-
-        if not usuarios_con_permiso:
-            continue
-
-        # Guardar lectura en la tabla correspondiente para cada usuario activo con permiso
-        for sensor_activo in usuarios_con_permiso:
-            if lectura.sensor_codigo == 'mq135':
-                nueva = models.LecturaMQ135(
-                    usuario_id=sensor_activo.usuario_id,
-                    valor=float(lectura.valor),
-                    estado=models.EstadoLecturaEnum(lectura.estado.value)
-                )
-            elif lectura.sensor_codigo == 'mq4':
-                nueva = models.LecturaMQ4(
-                    usuario_id=sensor_activo.usuario_id,
-                    valor=float(lectura.valor),
-                    estado=models.EstadoLecturaEnum(lectura.estado.value)
-                )
-            elif lectura.sensor_codigo == 'mq7':
-                nueva = models.LecturaMQ7(
-                    usuario_id=sensor_activo.usuario_id,
-                    valor=float(lectura.valor),
-                    estado=models.EstadoLecturaEnum(lectura.estado.value)
-                )
-            
-            db.add(nueva)
-            db.flush()  # Para obtener el ID de la lectura recién creada
-            usuarios_afectados.add(sensor_activo.usuario_id)
-            total_guardadas += 1
-            
-            # Crear notificación si el usuario la tiene configurada
-            crear_notificacion_si_necesario(
-                db, 
-                sensor_activo.usuario_id, 
-                lectura.sensor_codigo, 
-                float(lectura.valor), 
-                lectura.estado.value
-            )
-
-            # Evaluar y persistir alerta personalizada (si aplica)
+    # JSON (por defecto) o formato binario compacto según Content-Type
+    cuerpo = await request.body()
+    if request.headers.get("content-type", "").startswith(formato_binario.CONTENT_TYPE):
+        try:
+            lecturas = await _decodificar_binario(cuerpo, dispositivo, x_temperatura)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+    else:
+        try:
+            lecturas = validacion.lote_device(cuerpo)
+        except ValidationError as e:
+            raise RequestValidationError(validacion.errores_cuerpo(e))
+
+    lote = (dispositivo, x_lote_id) if dispositivo and x_lote_id else None
+    muestreo.observar(dispositivo, lecturas)
+    try:
+        codigo, contenido = await _ingestar_lote(lecturas, lote)
+    except escritor.ColaLlena as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    contenido["muestreo"] = _muestreo(dispositivo)
+    if codigo == 202:
+        return JSONResponse(status_code=202, content=contenido)
+    return contenido
+
+
+async def _ingestar_lote(lecturas: list, lote: tuple | None) -> tuple[int, dict]:
+    """Pipeline común de HTTP y WebSocket: idempotencia y luego spool, cola o escritura directa.
+
+    Devuelve (código HTTP, cuerpo). Propaga escritor.ColaLlena si la cola está llena.
+    """
+    # Reintento de un lote ya recibido: confirmar sin volver a guardarlo
+    if lote is not None:
+        if not idempotencia.cargado(lote[0]):
+            await run_in_threadpool(idempotencia.precargar, lote[0])
+        if not idempotencia.reservar(*lote):
+            return 200, {"mensaje": "Lote duplicado, ya procesado", "duplicado": True, "lecturas_procesadas": 0}
+
+    # Modo spool: durable en disco local antes de responder; la BD se alimenta después
+    if INGESTA_SPOOL:
+        try:
+            await run_in_threadpool(spool.agregar, lecturas, lote)
+        except Exception:
+            if lote is not None:
+                idempotencia.liberar(*lote)
+            raise
+        return 202, {"mensaje": "Lecturas aceptadas", "lecturas_procesadas": len(lecturas)}
+
+    # Modo asíncrono: encolar y responder sin esperar el commit en MySQL
+    if escritor.INGESTA_ASINCRONA:
+        try:
+            escritor.escritor.encolar(lecturas, lote)
+        except escritor.ColaLlena:
+            if lote is not None:
+                idempotencia.liberar(*lote)
+            raise
+        return 202, {"mensaje": "Lecturas aceptadas", "lecturas_procesadas": len(lecturas)}
+
+    # Procesar todo el array como un único lote (un JOIN, INSERT multi-fila y un commit)
+    inicio = time.monotonic()
+    try:
+        resultado = await run_in_threadpool(procesar_peticiones_en_sesion, [(lecturas, lote)])
+        limitador.registrar_latencia((time.monotonic() - inicio) * 1000, len(lecturas))
+    except Exception as e:
+        if lote is not None and isinstance(e, IntegrityError) and idempotencia.es_lote_repetido(e):
+            # Otro worker guardó el mismo lote en paralelo
+            return 200, {"mensaje": "Lote duplicado, ya procesado", "duplicado": True, "lecturas_procesadas": 0}
+        if lote is not None:
+            idempotencia.liberar(*lote)
+        raise
+    return 200, {
+        "mensaje": f"Lecturas guardadas: {resultado['total_guardadas']} para {len(resultado['usuarios'])} usuarios",
+        "usuarios": resultado["usuarios"],
+        "lecturas_procesadas": len(lecturas)
+    }
+
+
+@app.get("/lecturas/device/config")
+async def configuracion_device(
+    x_api_key: str | None = Header(default=None, alias="X-API-KEY"),
+    x_dispositivo: str | None = Header(default=None, alias="X-Dispositivo", max_length=64),
+):
+    """Recomendación de muestreo para placas que la consultan al arrancar o periódicamente."""
+    dispositivo = await _autenticar_dispositivo(x_api_key, x_dispositivo)
+    if not reglas.version():
+        await run_in_threadpool(reglas.obtener_en_sesion)
+    return {"muestreo": _muestreo(dispositivo)}
+
+
+BACKFILL_TOLERANCIA_FUTURO = int(os.getenv("BACKFILL_TOLERANCIA_FUTURO", "300"))  # segundos de desfase de reloj admitidos
+
+
+@app.post(
+    "/lecturas/device/backfill",
+    openapi_extra={"requestBody": {"content": {
+        "application/json": {"schema": schemas.LecturaBackfillDevice.model_json_schema()},
+        formato_binario.CONTENT_TYPE: {"schema": {"type": "string", "format": "binary"}},
+    }, "required": True}},
+)
+async def backfill_lecturas_device(
+    request: Request,
+    x_api_key: str | None = Header(default=None, alias="X-API-KEY"),
+    x_dispositivo: str | None = Header(default=None, alias="X-Dispositivo", max_length=64),
+    x_lote_id: str | None = Header(default=None, alias="X-Lote-Id", max_length=64),
+    x_temperatura: float | None = Header(default=None, alias="X-Temperatura")
+):
+    """Carga lecturas acumuladas sin conexión con su timestamp original.
+
+    Cada lectura se guarda para los usuarios que tenían una sesión de captura
+    de ese sensor abierta en ese momento (no los activos ahora). Acepta JSON o
+    binario con timestamps; el orden de las lecturas no importa. Siempre
+    escribe en línea: un backfill grande no debe ocupar la cola del escritor.
+    """
+    dispositivo = await _autenticar_dispositivo(x_api_key, x_dispositivo)
+    espera = await _admitir(dispositivo, _cliente(request))
+    if espera:
+        raise HTTPException(status_code=429, detail="Demasiadas peticiones", headers={"Retry-After": str(espera)})
+
+    cuerpo = await request.body()
+    if request.headers.get("content-type", "").startswith(formato_binario.CONTENT_TYPE):
+        try:
+            lecturas = await _decodificar_binario(cuerpo, dispositivo, x_temperatura)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        if lecturas and lecturas[0][3] is None:
+            raise HTTPException(status_code=422, detail="El backfill binario requiere timestamps (flag 0x01)")
+    else:
+        try:
+            lecturas = validacion.lote_backfill(cuerpo)
+        except ValidationError as e:
+            raise RequestValidationError(validacion.errores_cuerpo(e))
+
+    # Un reloj adelantado dejaría lecturas "del futuro" en los reportes
+    limite = datetime.now().timestamp() + BACKFILL_TOLERANCIA_FUTURO
+    if any(l[3].timestamp() > limite for l in lecturas):
+        raise HTTPException(status_code=422, detail="Hay lecturas con timestamp en el futuro")
+
+    lote = (dispositivo, x_lote_id) if dispositivo and x_lote_id else None
+    if lote is not None:
+        if not idempotencia.cargado(lote[0]):
+            await run_in_threadpool(idempotencia.precargar, lote[0])
+        if not idempotencia.reservar(*lote):
+            return {"mensaje": "Lote duplicado, ya procesado", "duplicado": True, "lecturas_procesadas": 0}
+
+    try:
+        # No alimenta la latencia del limitador: un backfill grande tarda por su tamaño, no por la BD
+        resultado = await run_in_threadpool(procesar_backfill_en_sesion, lecturas, lote)
+    except Exception as e:
+        if lote is not None and isinstance(e, IntegrityError) and idempotencia.es_lote_repetido(e):
+            return {"mensaje": "Lote duplicado, ya procesado", "duplicado": True, "lecturas_procesadas": 0}
+        if lote is not None:
+            idempotencia.liberar(*lote)
+        raise
+    if resultado.get("duplicado"):
+        return {"mensaje": "Lote duplicado, ya procesado", "duplicado": True, "lecturas_procesadas": 0}
+    return {
+        "mensaje": f"Lecturas guardadas: {resultado['total_guardadas']} para {len(resultado['usuarios'])} usuarios",
+        "usuarios": resultado["usuarios"],
+        "lecturas_procesadas": len(lecturas),
+        "descartadas": resultado["descartadas"],
+    }
+
+
+@app.websocket("/ws/lecturas/device")
+async def stream_lecturas_device(websocket: WebSocket):
+    """Canal persistente para dispositivos siempre encendidos.
+
+    Autenticación en el handshake: cabeceras X-API-KEY / X-Dispositivo (o
+    parámetros api_key / dispositivo). Cada trama es un lote: texto JSON
+    {"seq": n, "lecturas": [...]} o binaria (u32 seq + cuerpo de formato_binario).
+    El servidor responde {"ack": n, "lecturas": total}, donde ack es el último
+    seq confirmado: todo lo anterior ya puede descartarse. Con X-Dispositivo,
+    (dispositivo, seq) se usa como lote idempotente (el mismo espacio que
+    X-Lote-Id), así que reenviar lo no confirmado tras reconectar no duplica
+    lecturas. Sin seq en JSON, se numera desde el último ack y no hay idempotencia.
+    Cada ack lleva además la recomendación de muestreo (muestreo.py).
+    """
+    api_key = websocket.headers.get("x-api-key") or websocket.query_params.get("api_key")
+    declarado = (websocket.headers.get("x-dispositivo") or websocket.query_params.get("dispositivo") or "")[:64] or None
+    try:
+        dispositivo = await _autenticar_dispositivo(api_key, declarado)
+    except HTTPException:
+        await websocket.close(code=1008, reason="API key inválida")
+        return
+
+    await websocket.accept()
+    ultimo_seq = 0
+    total = 0
+    try:
+        while True:
+            mensaje = await websocket.receive()
+            if mensaje["type"] == "websocket.disconnect":
+                break
             try:
-                evaluar_alerta_personalizada(db, sensor_activo.usuario_id, lectura.sensor_codigo, float(lectura.valor))
-            except Exception:
-                pass
-            
-            # Actualizar contador de lecturas en sesión activa
-            sesion_activa = db.query(models.SesionCaptura).filter(
-                models.SesionCaptura.usuario_id == sensor_activo.usuario_id,
-                models.SesionCaptura.sensor_codigo == lectura.sensor_codigo,
-                models.SesionCaptura.activo == True
-            ).first()
-            
-            if sesion_activa:
-                sesion_activa.total_lecturas += 1
-    
+                if mensaje.get("bytes") is not None:
+                    seq, cuerpo = formato_binario.separar_trama(mensaje["bytes"])
+                    lecturas = await _decodificar_binario(cuerpo, dispositivo)
+                    con_seq = True
+                else:
+                    seq, lecturas = validacion.trama_device(mensaje.get("text") or "")
+                    con_seq = seq is not None
+                    seq = seq if con_seq else ultimo_seq + 1
+            except (ValueError, ValidationError) as e:
+                # ValidationError hereda de ValueError; la trama se descarta sin cerrar el canal
+                await websocket.send_json({"error": "Trama inválida", "detalle": str(e)[:500], "ack": ultimo_seq})
+                continue
+
+            espera = await _admitir(dispositivo, _cliente(websocket))
+            if espera:
+                await websocket.send_json({"error": "Demasiadas peticiones", "retry_after": espera, "ack": ultimo_seq})
+                continue
+
+            lote = (dispositivo, str(seq)) if dispositivo and con_seq else None
+            muestreo.observar(dispositivo, lecturas)
+            try:
+                _, contenido = await _ingestar_lote(lecturas, lote)
+            except escritor.ColaLlena as e:
+                await websocket.send_json({"error": str(e), "retry_after": e.retry_after, "ack": ultimo_seq})
+                continue
+            ultimo_seq = max(ultimo_seq, seq)
+            total += contenido.get("lecturas_procesadas", 0)
+            await websocket.send_json({"ack": ultimo_seq, "lecturas": total, "muestreo": _muestreo(dispositivo)})
+    except WebSocketDisconnect:
+        pass
+
+
+# ----------- REGISTRO DE DISPOSITIVOS (ADMIN) -----------
+
+@app.get("/admin/dispositivos", response_model=list[schemas.DispositivoOut])
+def listar_dispositivos(current_user: models.Usuario = Depends(auth.require_admin), db: Session = Depends(get_db)):
+    return db.query(models.Dispositivo).order_by(models.Dispositivo.codigo).all()
+
+
+@app.post("/admin/dispositivos", response_model=schemas.DispositivoConClave)
+def crear_dispositivo(payload: schemas.DispositivoCreate, current_user: models.Usuario = Depends(auth.require_admin), db: Session = Depends(get_db)):
+    """Registrar una placa. La API key se devuelve solo en esta respuesta."""
+    if db.query(models.Dispositivo).filter(models.Dispositivo.codigo == payload.codigo).first():
+        raise HTTPException(status_code=400, detail="El dispositivo ya existe")
+    api_key = dispositivos.generar_clave()
+    dispositivo = models.Dispositivo(codigo=payload.codigo, nombre=payload.nombre, clave_hash=dispositivos.hash_clave(api_key), activo=True)
+    db.add(dispositivo)
+    db.commit()
+    db.refresh(dispositivo)
+    dispositivos.registrar(dispositivo)
+    return {**schemas.DispositivoOut.model_validate(dispositivo).model_dump(), "api_key": api_key}
+
+
+@app.put("/admin/dispositivos/{dispositivo_id}", response_model=schemas.DispositivoOut)
+def actualizar_dispositivo(dispositivo_id: int, payload: schemas.DispositivoUpdate, current_user: models.Usuario = Depends(auth.require_admin), db: Session = Depends(get_db)):
+    dispositivo = db.query(models.Dispositivo).filter(models.Dispositivo.id == dispositivo_id).first()
+    if not dispositivo:
+        raise HTTPException(status_code=404, detail="Dispositivo no encontrado")
+    for k, v in payload.dict(exclude_unset=True).items():
+        setattr(dispositivo, k, v)
+    db.commit()
+    db.refresh(dispositivo)
+    dispositivos.registrar(dispositivo)
+    return dispositivo
+
+
+@app.post("/admin/dispositivos/{dispositivo_id}/rotar-clave", response_model=schemas.DispositivoConClave)
+def rotar_clave_dispositivo(dispositivo_id: int, current_user: models.Usuario = Depends(auth.require_admin), db: Session = Depends(get_db)):
+    """Genera una clave nueva; la anterior deja de valer de inmediato."""
+    dispositivo = db.query(models.Dispositivo).filter(models.Dispositivo.id == dispositivo_id).first()
+    if not dispositivo:
+        raise HTTPException(status_code=404, detail="Dispositivo no encontrado")
+    api_key = dispositivos.generar_clave()
+    dispositivo.clave_hash = dispositivos.hash_clave(api_key)
+    db.commit()
+    db.refresh(dispositivo)
+    dispositivos.registrar(dispositivo)
+    return {**schemas.DispositivoOut.model_validate(dispositivo).model_dump(), "api_key": api_key}
+
+
+@app.delete("/admin/dispositivos/{dispositivo_id}")
+def eliminar_dispositivo(dispositivo_id: int, current_user: models.Usuario = Depends(auth.require_admin), db: Session = Depends(get_db)):
+    dispositivo = db.query(models.Dispositivo).filter(models.Dispositivo.id == dispositivo_id).first()
+    if not dispositivo:
+        raise HTTPException(status_code=404, detail="Dispositivo no encontrado")
+    codigo = dispositivo.codigo
+    db.query(models.CalibracionSensor).filter(models.CalibracionSensor.dispositivo_id == dispositivo_id).delete()
+    db.delete(dispositivo)
+    db.commit()
+    dispositivos.olvidar(codigo)
+    calibracion.invalidar()
+    return {"mensaje": "Dispositivo eliminado correctamente"}
+
+
+@app.get("/admin/dispositivos/{dispositivo_id}/calibracion", response_model=list[schemas.CalibracionOut])
+def obtener_calibracion_dispositivo(dispositivo_id: int, current_user: models.Usuario = Depends(auth.require_admin), db: Session = Depends(get_db)):
+    """Curvas ADC -> ppm vigentes de cada sensor de la placa (modo de cuentas crudas)."""
+    if not db.query(models.Dispositivo).filter(models.Dispositivo.id == dispositivo_id).first():
+        raise HTTPException(status_code=404, detail="Dispositivo no encontrado")
+    personalizadas = db.query(models.CalibracionSensor).filter(models.CalibracionSensor.dispositivo_id == dispositivo_id).all()
+    return calibracion.curvas(personalizadas)
+
+
+@app.put("/admin/dispositivos/{dispositivo_id}/calibracion/{sensor_codigo}", response_model=schemas.CalibracionOut)
+def actualizar_calibracion_dispositivo(
+    dispositivo_id: int,
+    sensor_codigo: str,
+    payload: schemas.CalibracionUpdate,
+    current_user: models.Usuario = Depends(auth.require_admin),
+    db: Session = Depends(get_db)
+):
+    """Ajustar la curva de un sensor; los campos no enviados conservan su valor (o el de fábrica)."""
+    sensor_codigo = sensor_codigo.lower()
+    if sensor_codigo not in calibracion.CURVAS_DEFECTO:
+        raise HTTPException(status_code=400, detail="Sensor no válido")
+    if not db.query(models.Dispositivo).filter(models.Dispositivo.id == dispositivo_id).first():
+        raise HTTPException(status_code=404, detail="Dispositivo no encontrado")
+    cal = db.query(models.CalibracionSensor).filter(
+        models.CalibracionSensor.dispositivo_id == dispositivo_id,
+        models.CalibracionSensor.sensor_codigo == sensor_codigo
+    ).first()
+    if not cal:
+        cal = models.CalibracionSensor(dispositivo_id=dispositivo_id, sensor_codigo=sensor_codigo, **calibracion.CURVAS_DEFECTO[sensor_codigo])
+        db.add(cal)
+    for k, v in payload.dict(exclude_unset=True).items():
+        if v is not None:
+            setattr(cal, k, v)
+    db.commit()
+    db.refresh(cal)
+    calibracion.invalidar()
+    return calibracion.curva(cal)
+
+
+@app.delete("/admin/dispositivos/{dispositivo_id}/calibracion/{sensor_codigo}")
+def restablecer_calibracion_dispositivo(dispositivo_id: int, sensor_codigo: str, current_user: models.Usuario = Depends(auth.require_admin), db: Session = Depends(get_db)):
+    """Volver a la curva por defecto del sensor."""
+    db.query(models.CalibracionSensor).filter(
+        models.CalibracionSensor.dispositivo_id == dispositivo_id,
+        models.CalibracionSensor.sensor_codigo == sensor_codigo.lower()
+    ).delete()
     db.commit()
+    calibracion.invalidar()
+    return {"mensaje": "Calibración restablecida"}
+
+
+@app.get("/admin/ingesta/estado")
+def obtener_estado_ingesta(current_user: models.Usuario = Depends(auth.require_admin)):
+    """Estado del escritor asíncrono de ingesta (cola, ritmo, errores) y del spool"""
     return {
-        "mensaje": f"Lecturas guardadas: {total_guardadas} para {len(usuarios_afectados)} usuarios", 
-        "usuarios": list(usuarios_afectados),
-        "lecturas_procesadas": len(data.lecturas)
+        "asincrona": escritor.INGESTA_ASINCRONA,
+        **escritor.escritor.estado(),
+        "reglas_version": reglas.version(),
+        "spool": {"habilitado": INGESTA_SPOOL, **spool.estado()},
+        "limitador": limitador.estado(),
+        "deadband": deadband.estado(),
+        "muestreo": muestreo.estado(),
+        "calibracion": calibracion.estado(),
+        "retencion": retencion.estado(),
+        "archivo": {"habilitado": archivo.ARCHIVO_LECTURAS, "directorio": archivo.ARCHIVO_DIR},
+        "recientes": recientes.estado(),
+        "ultimos": ultimos.estado(),
     }
 
 
+@app.on_event("startup")
+def iniciar_escritor_ingesta():
+    if escritor.INGESTA_ASINCRONA:
+        escritor.escritor.iniciar()
+    if INGESTA_SPOOL:
+        spool.iniciar()
+    if RETENCION_LECTURAS_DIAS > 0:
+        retencion.iniciar()
+
+
+@app.on_event("shutdown")
+def detener_escritor_ingesta():
+    if escritor.INGESTA_ASINCRONA:
+        escritor.escritor.detener()
+    if INGESTA_SPOOL:
+        spool.detener()
+    if RETENCION_LECTURAS_DIAS > 0:
+        retencion.detener()
+
+
 # ----------- ACTUALIZAR LECTURA (ADMIN) -----------
 
 from datetime import datetime
@@ -807,30 +1134,34 @@ def actualizar_lectura(
 # ----------- OBTENER LECTURAS DEL USUARIO -----------
 
 @app.get("/lecturas/me")
-def obtener_mis_lecturas(current_user: models.Usuario = Depends(auth.get_current_user), limit: int | None = None, db: Session = Depends(get_db)):
+def obtener_mis_lecturas(current_user: models.Usuario = Depends(auth.get_current_user), limit: int | None = None, expandir: bool = False, db: Session = Depends(get_db)):
+    """Lecturas por sensor, de la más reciente a la más antigua.
+
+    Cada elemento trae conteo y ultimo_en (rachas de banda muerta); con
+    expandir=true cada racha se devuelve como conteo lecturas sueltas. Las
+    últimas RECIENTES_N filas de cada sensor salen de memoria (recientes.py).
+    """
     result = {
         "mq135": [],
         "mq4": [],
         "mq7": []
     }
     
-    # Obtener lecturas MQ-135
-    query_mq135 = db.query(models.LecturaMQ135).filter(models.LecturaMQ135.usuario_id == current_user.id).order_by(models.LecturaMQ135.creado_en.desc())
-    if limit:
-        query_mq135 = query_mq135.limit(limit)
-    result["mq135"] = [{"id": l.id, "valor": l.valor, "estado": l.estado.value, "creado_en": l.creado_en} for l in query_mq135.all()]
-    
-    # Obtener lecturas MQ-4
-    query_mq4 = db.query(models.LecturaMQ4).filter(models.LecturaMQ4.usuario_id == current_user.id).order_by(models.LecturaMQ4.creado_en.desc())
-    if limit:
-        query_mq4 = query_mq4.limit(limit)
-    result["mq4"] = [{"id": l.id, "valor": l.valor, "estado": l.estado.value, "creado_en": l.creado_en} for l in query_mq4.all()]
-    
-    # Obtener lecturas MQ-7
-    query_mq7 = db.query(models.LecturaMQ7).filter(models.LecturaMQ7.usuario_id == current_user.id).order_by(models.LecturaMQ7.creado_en.desc())
-    if limit:
-        query_mq7 = query_mq7.limit(limit)
-    result["mq7"] = [{"id": l.id, "valor": l.valor, "estado": l.estado.value, "creado_en": l.creado_en} for l in query_mq7.all()]
+    for sensor_codigo in result:
+        filas = recientes.ultimas(current_user.id, sensor_codigo, limit)
+        if filas is None:
+            version = recientes.version(current_user.id)
+            query, tabla = mediciones.consulta_lecturas(db, current_user.id, sensor_codigo)
+            query = query.order_by(tabla.creado_en.desc(), tabla.id.desc())
+            # Se pide al menos lo que cabe en el anillo para que las próximas consultas no vengan aquí
+            tope = max(limit, recientes.RECIENTES_N) if limit else None
+            if tope:
+                query = query.limit(tope)
+            filas = query.all()
+            recientes.cargar(current_user.id, sensor_codigo, filas, version, completo=tope is None or len(filas) < tope)
+            if limit:
+                filas = filas[:limit]
+        result[sensor_codigo] = mediciones.salida(filas, expandir, limite=limit)
     
     return result
 
@@ -838,67 +1169,55 @@ def obtener_mis_lecturas(current_user: models.Usuario = Depends(auth.get_current
 # ----------- LECTURAS PARA ADMIN (TODOS LOS USUARIOS) -----------
 
 @app.get("/lecturas/admin")
-def obtener_lecturas_admin(current_user: models.Usuario = Depends(auth.require_admin), limit: int | None = None, db: Session = Depends(get_db)):
-    """Obtener lecturas de todos los usuarios para administración"""
+def obtener_lecturas_admin(
+    current_user: models.Usuario = Depends(auth.require_admin),
+    limit: int | None = None,
+    desde: datetime | None = None,
+    hasta: datetime | None = None,
+    db: Session = Depends(get_db)
+):
+    """Obtener lecturas de todos los usuarios para administración.
+
+    Con desde/hasta se filtra por creado_en; si el rango empieza antes del
+    horizonte de retención también se leen las lecturas archivadas en Parquet.
+    Con LECTURAS_UNICAS cada medición aparece por cada usuario cuya sesión de
+    captura la cubre (mediciones.consulta_todas).
+    """
     result = {
         "mq135": [],
         "mq4": [],
         "mq7": []
     }
-    
-    # Obtener lecturas MQ-135 de todos los usuarios
-    query_mq135 = db.query(models.LecturaMQ135).order_by(models.LecturaMQ135.creado_en.desc())
-    if limit:
-        query_mq135 = query_mq135.limit(limit)
-    
-    for l in query_mq135.all():
-        # Obtener información del usuario
-        usuario = db.query(models.Usuario).filter(models.Usuario.id == l.usuario_id).first()
-        result["mq135"].append({
-            "id": l.id,
-            "usuario_id": l.usuario_id,
-            "usuario_nombre": usuario.nombre if usuario else "Usuario desconocido",
-            "valor": l.valor,
-            "estado": l.estado.value,
-            "creado_en": l.creado_en,
-            "fecha_lectura": l.creado_en.isoformat()
-        })
-    
-    # Obtener lecturas MQ-4 de todos los usuarios
-    query_mq4 = db.query(models.LecturaMQ4).order_by(models.LecturaMQ4.creado_en.desc())
-    if limit:
-        query_mq4 = query_mq4.limit(limit)
-    
-    for l in query_mq4.all():
-        # Obtener información del usuario
-        usuario = db.query(models.Usuario).filter(models.Usuario.id == l.usuario_id).first()
-        result["mq4"].append({
-            "id": l.id,
-            "usuario_id": l.usuario_id,
-            "usuario_nombre": usuario.nombre if usuario else "Usuario desconocido",
-            "valor": l.valor,
-            "estado": l.estado.value,
-            "creado_en": l.creado_en,
-            "fecha_lectura": l.creado_en.isoformat()
-        })
-    
-    # Obtener lecturas MQ-7 de todos los usuarios
-    query_mq7 = db.query(models.LecturaMQ7).order_by(models.LecturaMQ7.creado_en.desc())
-    if limit:
-        query_mq7 = query_mq7.limit(limit)
-    
-    for l in query_mq7.all():
-        # Obtener información del usuario
-        usuario = db.query(models.Usuario).filter(models.Usuario.id == l.usuario_id).first()
-        result["mq7"].append({
-            "id": l.id,
-            "usuario_id": l.usuario_id,
-            "usuario_nombre": usuario.nombre if usuario else "Usuario desconocido",
-            "valor": l.valor,
-            "estado": l.estado.value,
-            "creado_en": l.creado_en,
-            "fecha_lectura": l.creado_en.isoformat()
-        })
+    horizonte = retencion_horizonte()
+    nombres = {}
+
+    for sensor_codigo in mediciones.TABLAS_LECTURA:
+        query, tabla = mediciones.consulta_todas(db, sensor_codigo)
+        if desde is not None:
+            query = query.filter(tabla.creado_en >= desde)
+        if hasta is not None:
+            query = query.filter(tabla.creado_en <= hasta)
+        query = query.order_by(tabla.creado_en.desc())
+        if limit:
+            query = query.limit(limit)
+        filas = query.all()
+        if not mediciones.LECTURAS_UNICAS:
+            filas = archivo.completar(filas, horizonte, sensor_codigo, desde=desde, hasta=hasta, limite=limit)
+
+        for l in filas:
+            # Obtener información del usuario (una vez por usuario)
+            if l.usuario_id not in nombres:
+                usuario = db.query(models.Usuario).filter(models.Usuario.id == l.usuario_id).first()
+                nombres[l.usuario_id] = usuario.nombre if usuario else "Usuario desconocido"
+            result[sensor_codigo].append({
+                "id": l.id,
+                "usuario_id": l.usuario_id,
+                "usuario_nombre": nombres[l.usuario_id],
+                "valor": l.valor,
+                "estado": getattr(l.estado, "value", str(l.estado)),
+                "creado_en": l.creado_en,
+                "fecha_lectura": l.creado_en.isoformat()
+            })
     
     return result
 
@@ -923,9 +1242,9 @@ def obtener_analitica_temporal(
         desde = ahora.replace(hour=0, minute=0, second=0, microsecond=0)
         label = "Hoy"
 
-    c135 = db.query(models.LecturaMQ135).filter(models.LecturaMQ135.creado_en >= desde).count()
-    c4 = db.query(models.LecturaMQ4).filter(models.LecturaMQ4.creado_en >= desde).count()
-    c7 = db.query(models.LecturaMQ7).filter(models.LecturaMQ7.creado_en >= desde).count()
+    # Desde los agregados por minuto/hora/día: el costo no depende del rango
+    resumen = agregados.resumen(db, desde, ahora)
+    c135, c4, c7 = (resumen[c]["conteo"] for c in ("mq135", "mq4", "mq7"))
     total = c135 + c4 + c7
     return {"label": label, "desde": desde.isoformat(), "hasta": ahora.isoformat(), "totales": {"mq135": c135, "mq4": c4, "mq7": c7, "total": total}}
 
@@ -949,15 +1268,38 @@ def eliminar_lectura(
     else:
         raise HTTPException(status_code=400, detail="Sensor ID inválido")
     
+    sensor_codigo = tabla.__tablename__.removeprefix("lecturas_")
+    if mediciones.LECTURAS_UNICAS:
+        # La medición es de todos los usuarios cuya sesión la cubre
+        tabla = models.Medicion
+
     # Buscar la lectura
-    lectura = db.query(tabla).filter(tabla.id == lectura_id).first()
+    query = db.query(tabla).filter(tabla.id == lectura_id)
+    if mediciones.LECTURAS_UNICAS:
+        query = query.filter(tabla.sensor_codigo == sensor_codigo)
+    lectura = query.first()
     
     if not lectura:
         raise HTTPException(status_code=404, detail="Lectura no encontrada")
     
-    # Eliminar la lectura
+    # Eliminar la lectura (y restarla de los agregados y del último valor)
+    if mediciones.LECTURAS_UNICAS:
+        usuarios_ids = mediciones.usuarios_de(db, sensor_codigo, lectura.creado_en)
+    else:
+        usuarios_ids = [lectura.usuario_id]
+    for usuario_id in usuarios_ids:
+        agregados.descontar(
+            db, usuario_id, sensor_codigo, lectura.valor,
+            lectura.estado.value, lectura.creado_en, lectura.conteo or 1, lectura.ultimo_en,
+        )
     db.delete(lectura)
+    db.flush()
+    for usuario_id in usuarios_ids or [None]:
+        ultimos.recalcular(db, sensor_codigo, usuario_id)
     db.commit()
+    ultimos.invalidar()
+    for usuario_id in usuarios_ids:
+        recientes.invalidar(usuario_id, sensor_codigo)
     
     return {"message": "Lectura eliminada correctamente"}
 
@@ -1010,12 +1352,15 @@ def obtener_mis_sensores(current_user: models.Usuario = Depends(auth.get_current
     for asign in asignaciones:
         sensor = db.query(models.Sensor).filter(models.Sensor.id == asign.sensor_id).first()
         if sensor:
+            ultima_lectura = ultimos.obtener(db, sensor.codigo, current_user.id)
             sensores.append({
                 "id": sensor.id,
                 "codigo": sensor.codigo,
                 "nombre": sensor.nombre,
                 "descripcion": sensor.descripcion,
-                "asignado_en": asign.asignado_en
+                "asignado_en": asign.asignado_en,
+                "valor_actual": ultima_lectura["valor"] if ultima_lectura else None,
+                "ultima_actualizacion": ultima_lectura["ultimo_en"].isoformat() if ultima_lectura else None
             })
     return {"usuario_id": current_user.id, "sensores": sensores}
 
@@ -1057,6 +1402,7 @@ def asignar_sensor_usuario(
     db.add(nueva_asignacion)
     db.commit()
     db.refresh(nueva_asignacion)
+    ruteo.asignar(usuario_id, sensor.codigo)
     
     return {
         "message": "Sensor asignado correctamente",
@@ -1112,6 +1458,8 @@ def desasignar_sensor_usuario(
                 db.delete(sesion_activa)
 
     db.commit()
+    if sensor:
+        ruteo.desasignar(usuario_id, sensor.codigo)
     
     return {"message": "Sensor desasignado correctamente"}
 
@@ -1136,20 +1484,11 @@ def obtener_dashboard_reportes(current_user: models.Usuario = Depends(auth.requi
     # Obtener alertas activas (advertencia o malo) en las últimas 24h usando umbrales dinámicos
     from datetime import datetime, timedelta, timezone
     hace_24h = datetime.now() - timedelta(hours=24)
-    th = _get_thresholds(db)
-    # Cuenta todo lo que sea >= WARN (incluye advertencia y malo)
-    alertas_mq135 = db.query(models.LecturaMQ135).filter(
-        models.LecturaMQ135.creado_en >= hace_24h,
-        models.LecturaMQ135.valor >= th['mq135_warning']
-    ).count()
-    alertas_mq4 = db.query(models.LecturaMQ4).filter(
-        models.LecturaMQ4.creado_en >= hace_24h,
-        models.LecturaMQ4.valor >= th['mq4_warning']
-    ).count()
-    alertas_mq7 = db.query(models.LecturaMQ7).filter(
-        models.LecturaMQ7.creado_en >= hace_24h,
-        models.LecturaMQ7.valor >= th['mq7_warning']
-    ).count()
+    # Cuenta todo lo que sea >= WARN (incluye advertencia y malo), desde los agregados
+    resumen = agregados.resumen(db, hace_24h)
+    alertas_mq135, alertas_mq4, alertas_mq7 = (
+        resumen[c]["advertencia"] + resumen[c]["malo"] for c in ("mq135", "mq4", "mq7")
+    )
     
     total_alertas = alertas_mq135 + alertas_mq4 + alertas_mq7
     
@@ -1417,10 +1756,10 @@ def obtener_usuarios_reportes(current_user: models.Usuario = Depends(auth.requir
             ultima_conexion = None
         
         # Calcular total de lecturas reales del usuario (todas las tablas)
-        total_lecturas_mq135 = db.query(models.LecturaMQ135).filter(models.LecturaMQ135.usuario_id == usuario.id).count()
-        total_lecturas_mq4 = db.query(models.LecturaMQ4).filter(models.LecturaMQ4.usuario_id == usuario.id).count()
-        total_lecturas_mq7 = db.query(models.LecturaMQ7).filter(models.LecturaMQ7.usuario_id == usuario.id).count()
-        total_lecturas_usuario = total_lecturas_mq135 + total_lecturas_mq4 + total_lecturas_mq7
+        total_lecturas_usuario = 0
+        for sensor_codigo in mediciones.TABLAS_LECTURA:
+            query, tabla = mediciones.consulta_lecturas(db, usuario.id, sensor_codigo)
+            total_lecturas_usuario += query.with_entities(func.coalesce(func.sum(tabla.conteo), 0)).scalar()
 
         usuarios_actividad.append({
             "id": usuario.id,
@@ -1447,39 +1786,30 @@ def obtener_usuarios_reportes(current_user: models.Usuario = Depends(auth.requir
 
 @app.get("/reportes/sensores")
 def obtener_sensores_reportes(current_user: models.Usuario = Depends(auth.require_admin), db: Session = Depends(get_db)):
-    """Obtener estado detallado de sensores para reportes"""
+    """Obtener estado detallado de sensores para reportes.
+
+    El valor actual sale de la caché de últimos valores (ultimos.py) y las
+    sesiones activas de un solo conteo agrupado: no se recorren las lecturas.
+    """
     
     sensores_estado = []
     
     # Obtener todos los sensores
     sensores = db.query(models.Sensor).all()
+
+    # Sesiones activas por sensor (índice activo, sensor_codigo)
+    sesiones_activas = dict(db.query(models.SesionCaptura.sensor_codigo, func.count(models.SesionCaptura.id)).filter(
+        models.SesionCaptura.activo == True
+    ).group_by(models.SesionCaptura.sensor_codigo).all())
     
     for sensor in sensores:
         # Verificar si está activo (tiene sesiones activas)
-        sesiones_activas = db.query(models.SesionCaptura).filter(
-            models.SesionCaptura.sensor_codigo == sensor.codigo,
-            models.SesionCaptura.activo == True
-        ).count()
+        estado = "active" if sesiones_activas.get(sensor.codigo, 0) > 0 else "inactive"
         
-        estado = "active" if sesiones_activas > 0 else "inactive"
-        
-        # Obtener última lectura
-        ultima_lectura = None
-        if sensor.codigo == "mq135":
-            ultima_lectura = db.query(models.LecturaMQ135).order_by(
-                models.LecturaMQ135.creado_en.desc()
-            ).first()
-        elif sensor.codigo == "mq4":
-            ultima_lectura = db.query(models.LecturaMQ4).order_by(
-                models.LecturaMQ4.creado_en.desc()
-            ).first()
-        elif sensor.codigo == "mq7":
-            ultima_lectura = db.query(models.LecturaMQ7).order_by(
-                models.LecturaMQ7.creado_en.desc()
-            ).first()
-        
-        valor_actual = ultima_lectura.valor if ultima_lectura else 0.0
-        ultima_actualizacion = ultima_lectura.creado_en if ultima_lectura else None
+        # Última lectura
+        ultima_lectura = ultimos.obtener(db, sensor.codigo)
+        valor_actual = ultima_lectura["valor"] if ultima_lectura else 0.0
+        ultima_actualizacion = ultima_lectura["ultimo_en"] if ultima_lectura else None
         
         sensores_estado.append({
             "id": sensor.id,
@@ -1652,32 +1982,19 @@ def obtener_ultima_sesion_consolidada(current_user: models.Usuario = Depends(aut
 def obtener_estadisticas_sesion(db: Session, usuario_id: int, sensor_codigo: str, inicio, fin):
     """Obtener estadísticas de lecturas para una sesión específica"""
     
-    # Determinar qué tabla usar según el sensor
-    if sensor_codigo == 'mq135':
-        tabla = models.LecturaMQ135
-    elif sensor_codigo == 'mq4':
-        tabla = models.LecturaMQ4
-    elif sensor_codigo == 'mq7':
-        tabla = models.LecturaMQ7
-    else:
+    if sensor_codigo not in mediciones.TABLAS_LECTURA:
         return {"promedio": None, "maximo": None, "minimo": None}
     
-    # Obtener lecturas en el rango de tiempo de la sesión
-    lecturas = db.query(tabla).filter(
-        tabla.usuario_id == usuario_id,
-        tabla.creado_en >= inicio,
-        tabla.creado_en <= fin
-    ).all()
+    # Agregados del usuario en el rango de la sesión (resolución de un minuto en los bordes)
+    resumen = agregados.resumen(db, inicio, fin, usuario_id, (sensor_codigo,))[sensor_codigo]
     
-    if not lecturas:
+    if not resumen["conteo"]:
         return {"promedio": None, "maximo": None, "minimo": None}
     
-    valores = [l.valor for l in lecturas]
-    
     return {
-        "promedio": round(sum(valores) / len(valores), 2),
-        "maximo": max(valores),
-        "minimo": min(valores)
+        "promedio": resumen["promedio"],
+        "maximo": resumen["maximo"],
+        "minimo": resumen["minimo"]
     }
 
 
@@ -1854,6 +2171,7 @@ def obtener_configuracion_notificaciones(current_user: models.Usuario = Depends(
         db.add(config)
         db.commit()
         db.refresh(config)
+        reglas.actualizar_usuario(config.usuario_id, config)
     
     return config
 
@@ -1902,6 +2220,8 @@ def actualizar_configuracion_sistema(payload: schemas.ConfiguracionSistemaUpdate
         invalidate_config_cache()
     except Exception:
         pass
+    # umbrales y triggers nuevos para la ingesta
+    reglas.reconstruir(db)
     return cfg
 
 
@@ -2027,12 +2347,15 @@ def obtener_reportes_usuario(
     sensores: Optional[str] = None,  # csv: mq135,mq4,mq7
     severidades: Optional[str] = None,  # csv: bueno,advertencia,malo
     limit: Optional[int] = None,
+    expandir: bool = False,
     current_user: models.Usuario = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
     """Devuelve lecturas del usuario autenticado con filtros por rango de fechas,
     sensores seleccionados y severidades. Estructura por sensor.
     Fechas en ISO 8601 (ej: 2025-09-01T00:00:00 o 2025-09-01).
+    Las rachas de banda muerta que tocan el rango se incluyen con conteo y
+    ultimo_en, o como lecturas sueltas con expandir=true.
     """
     from datetime import datetime
 
@@ -2058,10 +2381,10 @@ def obtener_reportes_usuario(
     fecha_desde = parse_fecha(desde)
     fecha_hasta = parse_fecha(hasta)
 
-    def filtrar_query(tabla):
-        q = db.query(tabla).filter(tabla.usuario_id == current_user.id)
+    def filtrar_query(sensor_codigo):
+        q, tabla = mediciones.consulta_lecturas(db, current_user.id, sensor_codigo)
         if fecha_desde is not None:
-            q = q.filter(tabla.creado_en >= fecha_desde)
+            q = q.filter(mediciones.desde_racha(db, tabla, fecha_desde))
         if fecha_hasta is not None:
             q = q.filter(tabla.creado_en <= fecha_hasta)
         # Filtro de severidades (compat con Enum)
@@ -2070,39 +2393,25 @@ def obtener_reportes_usuario(
             q = q.filter(tabla.estado.in_(estados))
         except Exception:
             raise HTTPException(status_code=400, detail="Severidad inválida")
-        q = q.order_by(tabla.creado_en.desc())
+        q = q.order_by(tabla.creado_en.desc(), tabla.id.desc())
         if limit and limit > 0:
             q = q.limit(limit)
         return q
 
     resultado = {"mq135": [], "mq4": [], "mq7": []}
-
-    if "mq135" in sensores_req:
-        for l in filtrar_query(models.LecturaMQ135).all():
-            resultado["mq135"].append({
-                "id": l.id,
-                "valor": l.valor,
-                "estado": getattr(l.estado, "value", str(l.estado)),
-                "creado_en": l.creado_en
-            })
-
-    if "mq4" in sensores_req:
-        for l in filtrar_query(models.LecturaMQ4).all():
-            resultado["mq4"].append({
-                "id": l.id,
-                "valor": l.valor,
-                "estado": getattr(l.estado, "value", str(l.estado)),
-                "creado_en": l.creado_en
-            })
-
-    if "mq7" in sensores_req:
-        for l in filtrar_query(models.LecturaMQ7).all():
-            resultado["mq7"].append({
-                "id": l.id,
-                "valor": l.valor,
-                "estado": getattr(l.estado, "value", str(l.estado)),
-                "creado_en": l.creado_en
-            })
+    limite = limit if limit and limit > 0 else None
+    horizonte = retencion_horizonte()
+
+    for sensor_codigo in resultado:
+        if sensor_codigo in sensores_req:
+            filas = filtrar_query(sensor_codigo).all()
+            if not mediciones.LECTURAS_UNICAS:
+                # Rango anterior al horizonte de retención: sumar las lecturas archivadas en Parquet
+                filas = archivo.completar(
+                    filas, horizonte, sensor_codigo, current_user.id, fecha_desde, fecha_hasta,
+                    [models.EstadoLecturaEnum(s) for s in severidades_req], limite,
+                )
+            resultado[sensor_codigo] = mediciones.salida(filas, expandir, fecha_desde, fecha_hasta, limite)
 
     return resultado
 @app.put("/configuracion-notificaciones/me", response_model=schemas.ConfiguracionNotificacionesOut)
@@ -2129,6 +2438,7 @@ def actualizar_configuracion_notificaciones(
     config.actualizado_en = func.now()
     db.commit()
     db.refresh(config)
+    reglas.actualizar_usuario(config.usuario_id, config)
     
     return config
 
@@ -2167,6 +2477,7 @@ def obtener_configuracion_notificaciones_usuario(
         db.add(config)
         db.commit()
         db.refresh(config)
+        reglas.actualizar_usuario(config.usuario_id, config)
 
     return config
 
@@ -2199,143 +2510,9 @@ def actualizar_configuracion_notificaciones_usuario(
     config.actualizado_en = func.now()
     db.commit()
     db.refresh(config)
+    reglas.actualizar_usuario(config.usuario_id, config)
     return config
 
-def crear_notificacion_si_necesario(db: Session, usuario_id: int, sensor_codigo: str, valor: float, estado: str):
-    """Función para crear notificación si el usuario la tiene configurada"""
-    
-    # Obtener configuración del usuario
-    config = db.query(models.ConfiguracionNotificaciones).filter(
-        models.ConfiguracionNotificaciones.usuario_id == usuario_id
-    ).first()
-    
-    if not config:
-        return  # No hay configuración, no crear notificación
-    
-    # Determinar si debe crear notificación según la configuración
-    should_notify = False
-    tipo = "info"
-    titulo = ""
-    mensaje = ""
-    
-    if sensor_codigo == "mq135":
-        estado = calcular_severidad_dinamica(sensor_codigo, valor, db)
-        if estado == "bueno" and config.notify_mq135_good:
-            should_notify = True
-            tipo = "info"
-            titulo = "Calidad del aire buena"
-            mensaje = "Los niveles de CO₂ están en rango normal"
-        elif estado == "advertencia" and config.notify_mq135_warning:
-            should_notify = True
-            tipo = "warning"
-            titulo = "Advertencia de calidad del aire"
-            mensaje = "Los niveles de CO₂ están elevados"
-        elif estado == "malo" and config.notify_mq135_bad:
-            should_notify = True
-            tipo = "danger"
-            titulo = "Alerta de calidad del aire"
-            mensaje = "Los niveles de CO₂ son peligrosos"
-    
-    elif sensor_codigo == "mq7":
-        estado = calcular_severidad_dinamica(sensor_codigo, valor, db)
-        if estado == "bueno" and config.notify_mq7_good:
-            should_notify = True
-            tipo = "info"
-            titulo = "Monóxido de carbono normal"
-            mensaje = "Los niveles de CO están en rango seguro"
-        elif estado == "advertencia" and config.notify_mq7_warning:
-            should_notify = True
-            tipo = "warning"
-            titulo = "Advertencia de monóxido de carbono"
-            mensaje = "Los niveles de CO están elevados"
-        elif estado == "malo" and config.notify_mq7_bad:
-            should_notify = True
-            tipo = "danger"
-            titulo = "Alerta de monóxido de carbono"
-            mensaje = "Los niveles de CO son peligrosos"
-    
-    elif sensor_codigo == "mq4":
-        estado = calcular_severidad_dinamica(sensor_codigo, valor, db)
-        if estado == "bueno" and config.notify_mq4_good:
-            should_notify = True
-            tipo = "info"
-            titulo = "Metano normal"
-            mensaje = "Los niveles de metano están en rango seguro"
-        elif estado == "advertencia" and config.notify_mq4_warning:
-            should_notify = True
-            tipo = "warning"
-            titulo = "Advertencia de metano"
-            mensaje = "Los niveles de metano están elevados"
-        elif estado == "malo" and config.notify_mq4_bad:
-            should_notify = True
-            tipo = "danger"
-            titulo = "Alerta de metano"
-            mensaje = "Los niveles de metano son peligrosos"
-    
-    if should_notify:
-        # Crear la notificación
-        notificacion = models.Notificacion(
-            usuario_id=usuario_id,
-            sensor_codigo=sensor_codigo,
-            valor=valor,
-            estado=estado,
-            titulo=titulo,
-            mensaje=mensaje,
-            tipo=tipo,
-            leida=False
-        )
-        db.add(notificacion)
-        db.commit()
-
-
-# ---------- ALERTAS PERSONALIZADAS: evaluación de triggers ----------
-def _trigger_matches(valor: float, umbral: float | None, tipo: str) -> bool:
-    if umbral is None:
-        return False
-    try:
-        v = float(valor)
-        u = float(umbral)
-    except Exception:
-        return False
-    t = (tipo or 'igual').lower()
-    if t == 'igual':
-        return v == u
-    if t == 'mayor_igual':
-        return v >= u
-    if t == 'menor_igual':
-        return v <= u
-    return False
-
-def evaluar_alerta_personalizada(db: Session, usuario_id: int, sensor_codigo: str, valor: float):
-    cfg = db.query(models.ConfiguracionSistema).first()
-    if not cfg:
-        return
-    if sensor_codigo == 'mq135':
-        umbral, tipo = getattr(cfg, 'mq135_trigger_valor', None), getattr(cfg, 'mq135_trigger_tipo', 'igual')
-    elif sensor_codigo == 'mq4':
-        umbral, tipo = getattr(cfg, 'mq4_trigger_valor', None), getattr(cfg, 'mq4_trigger_tipo', 'igual')
-    elif sensor_codigo == 'mq7':
-        umbral, tipo = getattr(cfg, 'mq7_trigger_valor', None), getattr(cfg, 'mq7_trigger_tipo', 'igual')
-    else:
-        return
-
-    if not _trigger_matches(valor, umbral, tipo):
-        return
-
-    # Calcular severidad con umbrales dinámicos
-    sev = calcular_severidad_dinamica(sensor_codigo, valor, db)
-    alerta = models.AlertaPersonalizada(
-        usuario_id=usuario_id,
-        sensor_codigo=sensor_codigo,
-        valor=float(valor),
-        umbral_usado=float(umbral) if umbral is not None else None,
-        tipo_trigger=str(tipo or 'igual'),
-        severidad_calculada=sev
-    )
-    db.add(alerta)
-    db.commit()
-
-
 # ----------- DASHBOARD STATISTICS -----------
 
 @app.get("/admin/dashboard/stats")
@@ -2348,11 +2525,8 @@ def get_dashboard_stats(current_user: models.Usuario = Depends(auth.require_admi
     # Contar sensores (asumiendo 3 sensores: MQ135, MQ4, MQ7)
     total_sensors = 3
     
-    # Contar total de datos recopilados (suma de todas las lecturas)
-    total_mq135 = db.query(models.LecturaMQ135).count()
-    total_mq4 = db.query(models.LecturaMQ4).count()
-    total_mq7 = db.query(models.LecturaMQ7).count()
-    total_data_points = total_mq135 + total_mq4 + total_mq7
+    # Contar total de datos recopilados (agregados diarios de todo el historial)
+    total_data_points = sum(r["conteo"] for r in agregados.resumen(db).values())
     
     # Contar notificaciones activas (no leídas)
     active_notifications = db.query(models.Notificacion).filter(models.Notificacion.leida == False).count()
@@ -0,0 +1,146 @@
+"""Lecturas visibles para un usuario, en cualquiera de los dos modos de almacenamiento.
+
+Por defecto cada lectura de dispositivo se copia en lecturas_mqXX una vez por
+usuario destinatario. Con LECTURAS_UNICAS=1 se guarda una sola fila en
+mediciones y el usuario ve las que caen dentro de alguna de sus sesiones de
+captura de ese sensor (iniciado_en <= creado_en <= finalizado_en, o sin fin si
+sigue activa). El cambio de modo no migra filas: cada modo lee su propia tabla.
+
+Con banda muerta (deadband.py) una fila puede representar conteo lecturas
+entre creado_en y ultimo_en; desde_racha(), fin_racha() y expandir() permiten
+filtrar y devolver esas rachas como si fueran lecturas sueltas.
+"""
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm import Session
+
+import deadband
+import models
+import reglas
+
+LECTURAS_UNICAS = os.getenv("LECTURAS_UNICAS", "0") == "1"
+
+TABLAS_LECTURA = {
+    "mq135": models.LecturaMQ135,
+    "mq4": models.LecturaMQ4,
+    "mq7": models.LecturaMQ7,
+}
+
+
+def consulta_lecturas(db: Session, usuario_id: int, sensor_codigo: str):
+    """(query, tabla) con las lecturas del usuario para el sensor.
+
+    La query devuelve filas (id, valor, estado, creado_en, conteo, ultimo_en);
+    tabla expone las columnas valor, estado y creado_en para seguir filtrando u
+    ordenando.
+    """
+    if not LECTURAS_UNICAS:
+        tabla = TABLAS_LECTURA[sensor_codigo]
+        q = db.query(tabla.id, tabla.valor, tabla.estado, tabla.creado_en, tabla.conteo, tabla.ultimo_en).filter(
+            tabla.usuario_id == usuario_id
+        )
+        return q, tabla
+
+    M, S = models.Medicion, models.SesionCaptura
+    q = db.query(M.id, M.valor, M.estado, M.creado_en, M.conteo, M.ultimo_en).join(S, and_(
+        S.usuario_id == usuario_id,
+        S.sensor_codigo == M.sensor_codigo,
+        M.creado_en >= S.iniciado_en,
+        or_(S.finalizado_en.is_(None), M.creado_en <= S.finalizado_en),
+    )).filter(M.sensor_codigo == sensor_codigo)
+    return q, M
+
+
+def consulta_todas(db: Session, sensor_codigo: str):
+    """(query, tabla) con las lecturas de todos los usuarios para el sensor (vistas de administración).
+
+    Filas (id, usuario_id, valor, estado, creado_en, conteo, ultimo_en). Con
+    LECTURAS_UNICAS una medición aparece una vez por usuario cuya sesión de
+    captura la cubre, igual que la copia por usuario.
+    """
+    if not LECTURAS_UNICAS:
+        tabla = TABLAS_LECTURA[sensor_codigo]
+        q = db.query(tabla.id, tabla.usuario_id, tabla.valor, tabla.estado, tabla.creado_en, tabla.conteo, tabla.ultimo_en)
+        return q, tabla
+
+    M, S = models.Medicion, models.SesionCaptura
+    q = db.query(M.id, S.usuario_id, M.valor, M.estado, M.creado_en, M.conteo, M.ultimo_en).join(S, and_(
+        S.sensor_codigo == M.sensor_codigo,
+        M.creado_en >= S.iniciado_en,
+        or_(S.finalizado_en.is_(None), M.creado_en <= S.finalizado_en),
+    )).filter(M.sensor_codigo == sensor_codigo)
+    return q, M
+
+
+def usuarios_de(db: Session, sensor_codigo: str, momento: datetime) -> list[int]:
+    """Con LECTURAS_UNICAS: usuarios cuya sesión de captura del sensor cubre momento."""
+    S = models.SesionCaptura
+    return [u for (u,) in db.query(S.usuario_id).filter(
+        S.sensor_codigo == sensor_codigo,
+        S.iniciado_en <= momento,
+        or_(S.finalizado_en.is_(None), S.finalizado_en >= momento),
+    ).distinct().all()]
+
+
+def fin_racha(tabla):
+    """Última lectura que representa la fila: ultimo_en, o creado_en si no es una racha."""
+    return func.coalesce(tabla.ultimo_en, tabla.creado_en)
+
+
+def desde_racha(db: Session, tabla, desde, inicio_min=None):
+    """Filtro "la fila tiene lecturas en desde o después" que usa el índice por creado_en.
+
+    Sin banda muerta configurada es creado_en >= desde. Con ella también entra
+    una racha empezada antes de desde que sigue después: fin_racha >= desde,
+    con creado_en acotado por el largo máximo de una racha (inicio_min, a pasar
+    si desde es una expresión SQL).
+    """
+    if not any(e > 0 for e in reglas.obtener(db).deadband.values()):
+        return tabla.creado_en >= desde
+    if inicio_min is None:
+        inicio_min = desde - timedelta(seconds=deadband.DEADBAND_RACHA_MAX_SEGUNDOS)
+    return and_(tabla.creado_en >= inicio_min, fin_racha(tabla) >= desde)
+
+
+def _sin_tz(momento):
+    return momento.astimezone().replace(tzinfo=None) if momento is not None and momento.tzinfo else momento
+
+
+def salida(filas, expandir: bool = False, desde: datetime | None = None, hasta: datetime | None = None, limite: int | None = None) -> list[dict]:
+    """Filas de consulta_lecturas (ordenadas de la más reciente a la más antigua) a dicts de respuesta.
+
+    Sin expandir, cada racha es un elemento con conteo y ultimo_en. Con
+    expandir, se devuelven conteo lecturas por racha, repartidas a intervalos
+    iguales entre creado_en y ultimo_en (el valor guardado está a menos de
+    epsilon de cada una), recortadas a [desde, hasta] y a limite.
+    """
+    if not expandir:
+        return [
+            {
+                "id": l.id,
+                "valor": l.valor,
+                "estado": getattr(l.estado, "value", str(l.estado)),
+                "creado_en": l.creado_en,
+                "conteo": l.conteo or 1,
+                "ultimo_en": l.ultimo_en or l.creado_en,
+            }
+            for l in filas
+        ]
+
+    desde, hasta = _sin_tz(desde), _sin_tz(hasta)
+    resultado = []
+    for l in filas:
+        estado = getattr(l.estado, "value", str(l.estado))
+        conteo = l.conteo or 1
+        inicio = _sin_tz(l.creado_en)
+        paso = (_sin_tz(l.ultimo_en) - inicio) / (conteo - 1) if conteo > 1 and l.ultimo_en and inicio else None
+        for i in range(conteo - 1, -1, -1):
+            momento = inicio + paso * i if paso is not None else inicio
+            if momento is not None and ((desde and momento < desde) or (hasta and momento > hasta)):
+                continue
+            resultado.append({"id": l.id, "valor": l.valor, "estado": estado, "creado_en": momento})
+            if limite and len(resultado) >= limite:
+                return resultado
+    return resultado
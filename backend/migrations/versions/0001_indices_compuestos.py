@@ -0,0 +1,52 @@
+"""Índices compuestos por usuario y tiempo en las tablas calientes
+
+Las tablas de lecturas solo tenían índice en id (y el implícito de la FK), así
+que /lecturas/me, /reportes/me, el conteo de lecturas recientes de
+activar_captura y las estadísticas de sesión ordenaban o filtraban por
+creado_en recorriendo todas las filas del usuario. (usuario_id, creado_en)
+sirve el filtro y el orden creado_en DESC, id DESC sin ordenar en memoria
+(InnoDB agrega id al final de cada índice secundario).
+
+Las bases creadas con create_all después de este cambio ya tienen los índices
+(están en models.py): la migración solo crea los que faltan.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 10:00:00
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0001"
+down_revision: Union[str, Sequence[str], None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+INDICES = [
+    ("lecturas_mq135", "ix_lecturas_mq135_usuario_creado", ["usuario_id", "creado_en"]),
+    ("lecturas_mq4", "ix_lecturas_mq4_usuario_creado", ["usuario_id", "creado_en"]),
+    ("lecturas_mq7", "ix_lecturas_mq7_usuario_creado", ["usuario_id", "creado_en"]),
+    ("notificaciones", "ix_notificaciones_usuario_leida_creado", ["usuario_id", "leida", "creado_en"]),
+    ("sesiones_captura", "ix_sesiones_captura_usuario_sensor_activo", ["usuario_id", "sensor_codigo", "activo"]),
+]
+
+
+def _existentes(tabla: str) -> set[str]:
+    return {i["name"] for i in sa.inspect(op.get_bind()).get_indexes(tabla)}
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    for tabla, nombre, columnas in INDICES:
+        if op.get_context().as_sql or nombre not in _existentes(tabla):
+            op.create_index(nombre, tabla, columnas)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for tabla, nombre, _ in reversed(INDICES):
+        op.drop_index(nombre, table_name=tabla)
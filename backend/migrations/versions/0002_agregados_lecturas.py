@@ -0,0 +1,52 @@
+"""Agregados de lecturas por minuto, hora y día
+
+Tabla que mantiene la ingesta (agregados.py) para responder reportes y
+estadísticas sin recorrer las tablas de lecturas. Tras aplicarla, cargar el
+historial con `python agregados.py reconstruir` (con la ingesta detenida).
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 12:00:00
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0002"
+down_revision: Union[str, Sequence[str], None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # create_all de la aplicación ya pudo crearla (models.AgregadoLectura)
+    if not op.get_context().as_sql and sa.inspect(op.get_bind()).has_table("agregados_lecturas"):
+        return
+    op.create_table(
+        "agregados_lecturas",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("periodo", sa.String(6), nullable=False),
+        sa.Column("usuario_id", sa.Integer(), sa.ForeignKey("usuarios.id", ondelete="CASCADE"), nullable=False),
+        sa.Column("sensor_codigo", sa.String(10), nullable=False),
+        sa.Column("inicio", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("conteo", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("suma", sa.Double(), nullable=False, server_default="0"),
+        sa.Column("suma_cuadrados", sa.Double(), nullable=False, server_default="0"),
+        sa.Column("minimo", sa.Float(), nullable=True),
+        sa.Column("maximo", sa.Float(), nullable=True),
+        sa.Column("n_bueno", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("n_advertencia", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("n_malo", sa.Integer(), nullable=False, server_default="0"),
+        sa.UniqueConstraint("periodo", "usuario_id", "sensor_codigo", "inicio", name="uq_agregado_periodo_usuario_sensor_inicio"),
+    )
+    op.create_index("ix_agregados_lecturas_id", "agregados_lecturas", ["id"])
+    op.create_index("ix_agregados_periodo_inicio", "agregados_lecturas", ["periodo", "inicio"])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table("agregados_lecturas")
@@ -0,0 +1,49 @@
+"""Último valor por sensor y por usuario y sensor
+
+Tabla que mantiene la ingesta (ultimos.py) para que /reportes/sensores y
+/mis-sensores no busquen la última lectura en las tablas de lecturas, y un
+índice (activo, sensor_codigo) para contar las sesiones activas por sensor.
+Tras aplicarla, cargar los valores actuales con `python ultimos.py reconstruir`.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 14:00:00
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0003"
+down_revision: Union[str, Sequence[str], None] = "0002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    en_sql = op.get_context().as_sql
+    inspector = None if en_sql else sa.inspect(op.get_bind())
+    # create_all de la aplicación ya pudo crearlos (models.py)
+    if en_sql or not inspector.has_table("sensor_ultimo_valor"):
+        op.create_table(
+            "sensor_ultimo_valor",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("usuario_id", sa.Integer(), nullable=False, server_default="0"),
+            sa.Column("sensor_codigo", sa.String(10), nullable=False),
+            sa.Column("valor", sa.Float(), nullable=False),
+            sa.Column("estado", sa.Enum("bueno", "advertencia", "malo", name="estadolecturaenum"), nullable=False),
+            sa.Column("ultimo_en", sa.DateTime(timezone=True), nullable=False),
+            sa.UniqueConstraint("usuario_id", "sensor_codigo", name="uq_ultimo_valor_usuario_sensor"),
+        )
+        op.create_index("ix_sensor_ultimo_valor_id", "sensor_ultimo_valor", ["id"])
+    if en_sql or "ix_sesiones_captura_activo_sensor" not in {i["name"] for i in inspector.get_indexes("sesiones_captura")}:
+        op.create_index("ix_sesiones_captura_activo_sensor", "sesiones_captura", ["activo", "sensor_codigo"])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_sesiones_captura_activo_sensor", table_name="sesiones_captura")
+    op.drop_table("sensor_ultimo_valor")
@@ -0,0 +1,147 @@
+"""Tablas de dispositivos y columnas de agrupación de notificaciones, límite de ingesta y banda muerta
+
+Cambios que hasta ahora solo creaba create_all o se aplicaban a mano
+(DEVELOPMENT.md): las tablas dispositivos, lotes_procesados, mediciones y
+calibraciones_sensor, notificaciones.conteo/primera_en/ultima_en, ingesta_* y
+mqXX_deadband en configuracion_sistema y conteo/ultimo_en en las tablas de
+lecturas. Las bases que ya los tienen (create_all o el SQL manual) solo
+reciben lo que falta.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 16:00:00
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0004"
+down_revision: Union[str, Sequence[str], None] = "0003"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def _racha() -> list:
+    return [
+        sa.Column("conteo", sa.Integer(), nullable=False, server_default="1"),
+        sa.Column("ultimo_en", sa.DateTime(timezone=True), nullable=True),
+    ]
+
+
+COLUMNAS = [
+    ("notificaciones", [
+        sa.Column("conteo", sa.Integer(), nullable=False, server_default="1"),
+        sa.Column("primera_en", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("ultima_en", sa.DateTime(timezone=True), nullable=True),
+    ]),
+    ("configuracion_sistema", [
+        sa.Column("ingesta_peticiones_por_seg", sa.Float(), nullable=False, server_default="2"),
+        sa.Column("ingesta_rafaga", sa.Integer(), nullable=False, server_default="20"),
+        sa.Column("mq135_deadband", sa.Float(), nullable=False, server_default="0"),
+        sa.Column("mq4_deadband", sa.Float(), nullable=False, server_default="0"),
+        sa.Column("mq7_deadband", sa.Float(), nullable=False, server_default="0"),
+    ]),
+    ("lecturas_mq135", _racha()),
+    ("lecturas_mq4", _racha()),
+    ("lecturas_mq7", _racha()),
+    ("mediciones", _racha()),
+]
+
+
+def _crear_tablas(en_sql: bool, inspector) -> set[str]:
+    """Crea las tablas que faltan (en el orden de sus FK). Devuelve las creadas."""
+    creadas = set()
+    if en_sql or not inspector.has_table("dispositivos"):
+        op.create_table(
+            "dispositivos",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("codigo", sa.String(64), nullable=False, unique=True),
+            sa.Column("nombre", sa.String(100), nullable=True),
+            sa.Column("clave_hash", sa.String(64), nullable=False, unique=True),
+            sa.Column("activo", sa.Boolean(), nullable=False, server_default="1"),
+            sa.Column("creado_en", sa.DateTime(timezone=True), server_default=sa.func.now()),
+        )
+        op.create_index("ix_dispositivos_id", "dispositivos", ["id"])
+        creadas.add("dispositivos")
+    if en_sql or not inspector.has_table("lotes_procesados"):
+        op.create_table(
+            "lotes_procesados",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("dispositivo", sa.String(64), nullable=False),
+            sa.Column("lote_id", sa.String(64), nullable=False),
+            sa.Column("creado_en", sa.DateTime(timezone=True), server_default=sa.func.now()),
+            sa.UniqueConstraint("dispositivo", "lote_id", name="uq_dispositivo_lote"),
+        )
+        op.create_index("ix_lotes_procesados_id", "lotes_procesados", ["id"])
+        creadas.add("lotes_procesados")
+    if en_sql or not inspector.has_table("mediciones"):
+        op.create_table(
+            "mediciones",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("sensor_codigo", sa.String(10), nullable=False),
+            sa.Column("valor", sa.Float(), nullable=False),
+            sa.Column("estado", sa.Enum("bueno", "advertencia", "malo", name="estadolecturaenum"), nullable=False),
+            sa.Column("creado_en", sa.DateTime(timezone=True), server_default=sa.func.now()),
+            *_racha(),
+        )
+        op.create_index("ix_mediciones_id", "mediciones", ["id"])
+        op.create_index("ix_mediciones_sensor_creado", "mediciones", ["sensor_codigo", "creado_en"])
+        creadas.add("mediciones")
+    return creadas
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    en_sql = op.get_context().as_sql
+    inspector = None if en_sql else sa.inspect(op.get_bind())
+    creadas = _crear_tablas(en_sql, inspector)
+    for tabla, columnas in COLUMNAS:
+        if tabla in creadas:
+            continue
+        existentes = set() if en_sql else {c["name"] for c in inspector.get_columns(tabla)}
+        for columna in columnas:
+            if columna.name not in existentes:
+                op.add_column(tabla, columna)
+    if en_sql or "ix_notificaciones_usuario_ultima" not in {i["name"] for i in inspector.get_indexes("notificaciones")}:
+        op.create_index("ix_notificaciones_usuario_ultima", "notificaciones", ["usuario_id", "ultima_en"])
+    if en_sql or not inspector.has_table("calibraciones_sensor"):
+        op.create_table(
+            "calibraciones_sensor",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("dispositivo_id", sa.Integer(), sa.ForeignKey("dispositivos.id", ondelete="CASCADE"), nullable=False),
+            sa.Column("sensor_codigo", sa.String(10), nullable=False),
+            sa.Column("adc_max", sa.Integer(), nullable=False, server_default="4095"),
+            sa.Column("vref", sa.Float(), nullable=False, server_default="3.3"),
+            sa.Column("vc", sa.Float(), nullable=False, server_default="5"),
+            sa.Column("rl", sa.Float(), nullable=False, server_default="10"),
+            sa.Column("r0", sa.Float(), nullable=False),
+            sa.Column("a", sa.Float(), nullable=False),
+            sa.Column("b", sa.Float(), nullable=False),
+            sa.Column("coef_temp", sa.Float(), nullable=False, server_default="0"),
+            sa.Column("temp_ref", sa.Float(), nullable=False, server_default="20"),
+            sa.Column("actualizado_en", sa.DateTime(timezone=True), server_default=sa.func.now()),
+            sa.UniqueConstraint("dispositivo_id", "sensor_codigo", name="uq_calibracion_dispositivo_sensor"),
+        )
+        op.create_index("ix_calibraciones_sensor_id", "calibraciones_sensor", ["id"])
+
+
+def downgrade() -> None:
+    """Downgrade schema.
+
+    dispositivos, lotes_procesados y mediciones se conservan: create_all pudo
+    crearlas (con datos) antes que esta migración.
+    """
+    en_sql = op.get_context().as_sql
+    inspector = None if en_sql else sa.inspect(op.get_bind())
+    op.drop_table("calibraciones_sensor")
+    op.drop_index("ix_notificaciones_usuario_ultima", table_name="notificaciones")
+    for tabla, columnas in reversed(COLUMNAS):
+        if not en_sql and not inspector.has_table(tabla):
+            continue
+        existentes = None if en_sql else {c["name"] for c in inspector.get_columns(tabla)}
+        for columna in reversed(columnas):
+            if existentes is None or columna.name in existentes:
+                op.drop_column(tabla, columna.name)
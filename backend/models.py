@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Enum, DateTime, func, ForeignKey, Float, UniqueConstraint, Boolean
+from sqlalchemy import Column, Integer, String, Enum, DateTime, func, ForeignKey, Float, Double, UniqueConstraint, Boolean, Index
 from sqlalchemy.orm import relationship
 from database import Base
 import enum
@@ -63,6 +63,12 @@ class LecturaMQ135(Base):
     valor = Column(Float, nullable=False)
     estado = Column(Enum(EstadoLecturaEnum), nullable=False)
     creado_en = Column(DateTime(timezone=True), server_default=func.now())
+    # Banda muerta: la fila representa conteo lecturas entre creado_en y ultimo_en
+    conteo = Column(Integer, nullable=False, default=1, server_default="1")
+    ultimo_en = Column(DateTime(timezone=True), nullable=True)
+
+    # /lecturas/me, /reportes/me, estadísticas de sesión y lecturas recientes
+    __table_args__ = (Index("ix_lecturas_mq135_usuario_creado", "usuario_id", "creado_en"),)
 
 
 class LecturaMQ4(Base):
@@ -73,6 +79,12 @@ class LecturaMQ4(Base):
     valor = Column(Float, nullable=False)
     estado = Column(Enum(EstadoLecturaEnum), nullable=False)
     creado_en = Column(DateTime(timezone=True), server_default=func.now())
+    # Banda muerta: la fila representa conteo lecturas entre creado_en y ultimo_en
+    conteo = Column(Integer, nullable=False, default=1, server_default="1")
+    ultimo_en = Column(DateTime(timezone=True), nullable=True)
+
+    # /lecturas/me, /reportes/me, estadísticas de sesión y lecturas recientes
+    __table_args__ = (Index("ix_lecturas_mq4_usuario_creado", "usuario_id", "creado_en"),)
 
 
 class LecturaMQ7(Base):
@@ -83,6 +95,67 @@ class LecturaMQ7(Base):
     valor = Column(Float, nullable=False)
     estado = Column(Enum(EstadoLecturaEnum), nullable=False)
     creado_en = Column(DateTime(timezone=True), server_default=func.now())
+    # Banda muerta: la fila representa conteo lecturas entre creado_en y ultimo_en
+    conteo = Column(Integer, nullable=False, default=1, server_default="1")
+    ultimo_en = Column(DateTime(timezone=True), nullable=True)
+
+    # /lecturas/me, /reportes/me, estadísticas de sesión y lecturas recientes
+    __table_args__ = (Index("ix_lecturas_mq7_usuario_creado", "usuario_id", "creado_en"),)
+
+
+class Medicion(Base):
+    """Lectura guardada una sola vez (LECTURAS_UNICAS=1); cada usuario la ve a
+    través de las ventanas de sus sesiones de captura."""
+    __tablename__ = "mediciones"
+
+    id = Column(Integer, primary_key=True, index=True)
+    sensor_codigo = Column(String(10), nullable=False)
+    valor = Column(Float, nullable=False)
+    estado = Column(Enum(EstadoLecturaEnum), nullable=False)
+    creado_en = Column(DateTime(timezone=True), server_default=func.now())
+    conteo = Column(Integer, nullable=False, default=1, server_default="1")
+    ultimo_en = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (Index("ix_mediciones_sensor_creado", "sensor_codigo", "creado_en"),)
+
+
+class AgregadoLectura(Base):
+    """Resumen de las lecturas de un usuario y sensor en un minuto, hora o día (agregados.py)."""
+    __tablename__ = "agregados_lecturas"
+
+    id = Column(Integer, primary_key=True, index=True)
+    periodo = Column(String(6), nullable=False)  # minuto | hora | dia
+    usuario_id = Column(Integer, ForeignKey("usuarios.id", ondelete="CASCADE"), nullable=False)
+    sensor_codigo = Column(String(10), nullable=False)
+    inicio = Column(DateTime(timezone=True), nullable=False)  # comienzo del período
+    conteo = Column(Integer, nullable=False, server_default="0")
+    suma = Column(Double, nullable=False, server_default="0")
+    suma_cuadrados = Column(Double, nullable=False, server_default="0")
+    minimo = Column(Float, nullable=True)
+    maximo = Column(Float, nullable=True)
+    # Lecturas por estado guardado
+    n_bueno = Column(Integer, nullable=False, server_default="0")
+    n_advertencia = Column(Integer, nullable=False, server_default="0")
+    n_malo = Column(Integer, nullable=False, server_default="0")
+
+    __table_args__ = (
+        UniqueConstraint("periodo", "usuario_id", "sensor_codigo", "inicio", name="uq_agregado_periodo_usuario_sensor_inicio"),
+        Index("ix_agregados_periodo_inicio", "periodo", "inicio"),
+    )
+
+
+class UltimoValorSensor(Base):
+    """Última lectura de un sensor por usuario (usuario_id 0: de cualquier usuario), que mantiene la ingesta (ultimos.py)."""
+    __tablename__ = "sensor_ultimo_valor"
+
+    id = Column(Integer, primary_key=True, index=True)
+    usuario_id = Column(Integer, nullable=False, server_default="0")  # sin FK por la fila 0
+    sensor_codigo = Column(String(10), nullable=False)
+    valor = Column(Float, nullable=False)
+    estado = Column(Enum(EstadoLecturaEnum), nullable=False)
+    ultimo_en = Column(DateTime(timezone=True), nullable=False)  # momento de la última lectura
+
+    __table_args__ = (UniqueConstraint("usuario_id", "sensor_codigo", name="uq_ultimo_valor_usuario_sensor"),)
 
 
 class SensoresActivos(Base):
@@ -107,6 +180,60 @@ class SesionCaptura(Base):
     activo = Column(Boolean, nullable=False, server_default="1")
     total_lecturas = Column(Integer, nullable=False, server_default="0")
 
+    __table_args__ = (
+        Index("ix_sesiones_captura_usuario_sensor_activo", "usuario_id", "sensor_codigo", "activo"),
+        # Sesiones activas por sensor (/reportes/sensores)
+        Index("ix_sesiones_captura_activo_sensor", "activo", "sensor_codigo"),
+    )
+
+
+class Dispositivo(Base):
+    """Placa registrada; la API key solo se guarda como hash SHA-256."""
+    __tablename__ = "dispositivos"
+
+    id = Column(Integer, primary_key=True, index=True)
+    codigo = Column(String(64), unique=True, nullable=False)  # se usa como X-Dispositivo
+    nombre = Column(String(100), nullable=True)
+    clave_hash = Column(String(64), unique=True, nullable=False)
+    activo = Column(Boolean, nullable=False, server_default="1")
+    creado_en = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class CalibracionSensor(Base):
+    """Curva ADC -> ppm de un sensor de una placa (modo de cuentas crudas, calibracion.py)."""
+    __tablename__ = "calibraciones_sensor"
+
+    id = Column(Integer, primary_key=True, index=True)
+    dispositivo_id = Column(Integer, ForeignKey("dispositivos.id", ondelete="CASCADE"), nullable=False)
+    sensor_codigo = Column(String(10), nullable=False)
+    # Circuito: cuentas -> voltaje -> Rs
+    adc_max = Column(Integer, nullable=False, server_default="4095")
+    vref = Column(Float, nullable=False, server_default="3.3")         # referencia del ADC (V)
+    vc = Column(Float, nullable=False, server_default="5")             # alimentación del divisor (V)
+    rl = Column(Float, nullable=False, server_default="10")            # resistencia de carga (kΩ)
+    # Sensor: ppm = a * (Rs/R0)^b
+    r0 = Column(Float, nullable=False)                                  # Rs en aire limpio (kΩ)
+    a = Column(Float, nullable=False)
+    b = Column(Float, nullable=False)
+    # Compensación de temperatura: Rs/R0 se divide por 1 + coef_temp * (T - temp_ref)
+    coef_temp = Column(Float, nullable=False, server_default="0")
+    temp_ref = Column(Float, nullable=False, server_default="20")
+    actualizado_en = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (UniqueConstraint("dispositivo_id", "sensor_codigo", name="uq_calibracion_dispositivo_sensor"),)
+
+
+class LoteProcesado(Base):
+    """Lotes de dispositivo ya guardados, para descartar reintentos duplicados."""
+    __tablename__ = "lotes_procesados"
+
+    id = Column(Integer, primary_key=True, index=True)
+    dispositivo = Column(String(64), nullable=False)
+    lote_id = Column(String(64), nullable=False)
+    creado_en = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (UniqueConstraint("dispositivo", "lote_id", name="uq_dispositivo_lote"),)
+
 
 class SesionUsuario(Base):
     __tablename__ = "sesiones_usuario"
@@ -135,10 +262,19 @@ class Notificacion(Base):
     leida = Column(Boolean, default=False)
     creado_en = Column(DateTime(timezone=True), server_default=func.now())
     leido_en = Column(DateTime(timezone=True), nullable=True)
+    # Eventos repetidos (mismo sensor y estado) agrupados en esta notificación
+    conteo = Column(Integer, nullable=False, default=1, server_default="1")
+    primera_en = Column(DateTime(timezone=True), nullable=True)
+    ultima_en = Column(DateTime(timezone=True), nullable=True)
     
     # Relación con usuario
     usuario = relationship("Usuario", back_populates="notificaciones")
 
+    __table_args__ = (
+        Index("ix_notificaciones_usuario_ultima", "usuario_id", "ultima_en"),
+        Index("ix_notificaciones_usuario_leida_creado", "usuario_id", "leida", "creado_en"),
+    )
+
 
 class ConfiguracionNotificaciones(Base):
     __tablename__ = "configuracion_notificaciones"
@@ -192,6 +328,15 @@ class ConfiguracionSistema(Base):
     mq7_trigger_valor = Column(Float, nullable=True)
     mq7_trigger_tipo = Column(String(20), nullable=False, server_default="igual")
 
+    # Límite de ingesta por dispositivo (cubeta de tokens); 0 desactiva el límite
+    ingesta_peticiones_por_seg = Column(Float, nullable=False, server_default="2")
+    ingesta_rafaga = Column(Integer, nullable=False, server_default="20")
+
+    # Banda muerta por sensor: lecturas a menos de epsilon de la fila anterior se acumulan en ella; 0 desactiva
+    mq135_deadband = Column(Float, nullable=False, server_default="0")
+    mq4_deadband = Column(Float, nullable=False, server_default="0")
+    mq7_deadband = Column(Float, nullable=False, server_default="0")
+
 
 class AlertaPersonalizada(Base):
     __tablename__ = "alertas_personalizadas"
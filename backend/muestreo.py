@@ -0,0 +1,112 @@
+"""Muestreo adaptativo: intervalo y tamaño de lote recomendados a cada dispositivo.
+
+Las placas envían a ritmo fijo sin importar la carga del servidor ni cuánto
+cambia la señal. Aquí se lleva, por (dispositivo, sensor), una media y
+varianza móviles de las lecturas recibidas y con ellas más la carga de la
+ingesta (limitador.carga) se recomienda:
+
+- intervalo_s: cada cuánto medir/reportar ese sensor. Una señal estable
+  (desviación pequeña frente a su umbral de advertencia) se espacia hasta
+  MUESTREO_INTERVALO_MAX_S; una que varía se acerca al base. Si el valor está
+  cerca del umbral de advertencia (MUESTREO_CERCANIA) o por encima, se usa
+  MUESTREO_INTERVALO_MIN_S sin importar la carga, para no perder detalle
+  donde importa. El resto se alarga proporcionalmente a la carga.
+- lote: cuántas lecturas juntar por petición para enviar cada
+  MUESTREO_ENVIO_S segundos (más con carga), así bajan las peticiones sin
+  perder lecturas.
+
+La recomendación viaja en la respuesta de /lecturas/device, en los acks del
+WebSocket y en GET /lecturas/device/config. Es solo un consejo: el firmware
+puede ignorarla.
+"""
+import math
+import os
+import threading
+import time
+
+from reglas import SENSORES
+
+MUESTREO_INTERVALO_BASE_S = float(os.getenv("MUESTREO_INTERVALO_BASE_S", "10"))
+MUESTREO_INTERVALO_MIN_S = float(os.getenv("MUESTREO_INTERVALO_MIN_S", "2"))
+MUESTREO_INTERVALO_MAX_S = float(os.getenv("MUESTREO_INTERVALO_MAX_S", "120"))
+MUESTREO_ENVIO_S = float(os.getenv("MUESTREO_ENVIO_S", "30"))
+MUESTREO_LOTE_MAX = int(os.getenv("MUESTREO_LOTE_MAX", "500"))
+MUESTREO_CERCANIA = float(os.getenv("MUESTREO_CERCANIA", "0.8"))     # fracción del umbral de advertencia
+MUESTREO_DISPOSITIVOS_MAX = int(os.getenv("MUESTREO_DISPOSITIVOS_MAX", "10000"))
+
+# Peso de cada lectura nueva en la media/varianza móvil
+_ALFA = 0.1
+# Desviación relativa al umbral de advertencia que se considera "señal normal":
+# por debajo el intervalo se alarga, por encima se acorta
+_DESVIACION_REFERENCIA = 0.02
+_OLVIDO_SEGUNDOS = 3600
+
+_lock = threading.Lock()
+_series: dict[str, dict] = {}  # dispositivo -> sensor -> [media, varianza, último valor, monotonic]
+
+
+def observar(dispositivo: str | None, lecturas):
+    """Actualiza las estadísticas móviles con un lote recibido en vivo."""
+    ahora = time.monotonic()
+    dispositivo = dispositivo or "legado"
+    with _lock:
+        por_sensor = _series.get(dispositivo)
+        if por_sensor is None:
+            if len(_series) >= MUESTREO_DISPOSITIVOS_MAX:
+                # Olvidar dispositivos que no reportan hace rato
+                for d in [d for d, ss in _series.items() if all(ahora - s[3] > _OLVIDO_SEGUNDOS for s in ss.values())]:
+                    del _series[d]
+            por_sensor = _series[dispositivo] = {}
+        for lectura in lecturas:
+            if lectura[0] not in SENSORES:
+                continue
+            valor = float(lectura[1])
+            if not math.isfinite(valor):
+                # Un NaN/inf dejaría la media y la varianza en NaN para siempre
+                continue
+            serie = por_sensor.get(lectura[0])
+            if serie is None:
+                por_sensor[lectura[0]] = [valor, 0.0, valor, ahora]
+                continue
+            # Media y varianza exponenciales (West, 1979)
+            diferencia = valor - serie[0]
+            incremento = _ALFA * diferencia
+            serie[0] += incremento
+            serie[1] = (1 - _ALFA) * (serie[1] + diferencia * incremento)
+            serie[2] = valor
+            serie[3] = ahora
+
+
+def _intervalo(serie: list, advertencia: float, carga: float) -> tuple[float, bool]:
+    """(intervalo en segundos, si el valor está cerca del umbral de advertencia)."""
+    media, varianza, ultimo, _ = serie
+    if advertencia > 0 and max(media, ultimo) >= advertencia * MUESTREO_CERCANIA:
+        return MUESTREO_INTERVALO_MIN_S, True
+    relativa = math.sqrt(varianza) / advertencia if advertencia > 0 else _DESVIACION_REFERENCIA
+    factor = min(MUESTREO_INTERVALO_MAX_S / MUESTREO_INTERVALO_BASE_S, _DESVIACION_REFERENCIA / max(relativa, 1e-9))
+    intervalo = MUESTREO_INTERVALO_BASE_S * max(0.5, factor) * (1 + 3 * carga)
+    return max(MUESTREO_INTERVALO_MIN_S, min(MUESTREO_INTERVALO_MAX_S, intervalo)), False
+
+
+def recomendacion(dispositivo: str | None, limites: dict, carga: float) -> dict:
+    """{"sensores": {sensor: {"intervalo_s", "lote"}}, "carga"} para el dispositivo.
+
+    limites es reglas.Reglas.limites (sensor -> (advertencia, malo)); carga va de 0 a 1.
+    """
+    with _lock:
+        series = {s: list(v) for s, v in _series.get(dispositivo or "legado", {}).items()}
+    sensores = {}
+    for sensor, (advertencia, _) in limites.items():
+        serie = series.get(sensor)
+        intervalo, cerca = _intervalo(serie, advertencia, carga) if serie else (MUESTREO_INTERVALO_BASE_S, False)
+        # Con carga se envían lotes más grandes y menos seguido, salvo cerca del umbral
+        envio = MUESTREO_ENVIO_S if cerca else MUESTREO_ENVIO_S * (1 + 3 * carga)
+        sensores[sensor] = {
+            "intervalo_s": round(intervalo, 1),
+            "lote": max(1, min(MUESTREO_LOTE_MAX, math.ceil(envio / intervalo))),
+        }
+    return {"sensores": sensores, "carga": round(carga, 2)}
+
+
+def estado() -> dict:
+    return {"dispositivos": len(_series), "intervalo_base_s": MUESTREO_INTERVALO_BASE_S}
@@ -0,0 +1,271 @@
+"""Últimas lecturas de cada usuario y sensor en memoria, para /lecturas/me?limit=N.
+
+Los paneles de Angular y Flutter consultan /lecturas/me?limit=1/3/10 cada
+pocos segundos y cada consulta eran tres ORDER BY creado_en DESC sobre las
+tablas de lecturas. Aquí se guarda, por (usuario, sensor), un anillo con las
+últimas RECIENTES_N filas (id, valor, estado, creado_en, conteo, ultimo_en)
+en arreglos de tamaño fijo (array), sin objetos por lectura.
+
+- Un anillo se llena en la primera consulta del usuario (cargar()) con las
+  RECIENTES_N filas más recientes de la BD. Si hay menos, el anillo tiene
+  toda la historia y sirve también consultas sin limit.
+- La ingesta relee dentro de su transacción las filas que insertó (y las
+  rachas abiertas de banda muerta, que pudo extender) solo para los
+  sensores con anillos cargados, y las aplica tras el commit (aplicar()).
+- Una consulta con limit <= filas del anillo se responde sin tocar la BD; con
+  un limit mayor, o si el anillo no existe, se va a SQL como antes.
+- Todo lo que no sea agregar al final (backfill, lecturas fuera de orden,
+  borrados, retención) descarta los anillos afectados: la siguiente consulta
+  los vuelve a cargar.
+
+Los anillos son por proceso: con varios workers, cada uno solo ve las
+lecturas que ingirió él mismo y respondería datos viejos. Por eso está
+desactivado por defecto (RECIENTES_N=0) y solo conviene activarlo con un
+único worker (p.ej. RECIENTES_N=200); tampoco sirve con `python retencion.py
+purgar` contra un servidor en marcha. No se usa con LECTURAS_UNICAS, donde lo
+que ve cada usuario depende de las ventanas de sus sesiones de captura.
+"""
+import os
+import threading
+from array import array
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session
+
+import deadband
+import models
+from mediciones import LECTURAS_UNICAS, TABLAS_LECTURA
+
+RECIENTES_N = int(os.getenv("RECIENTES_N", "0"))   # filas por usuario y sensor; 0 = desactivado (solo un worker)
+
+ACTIVO = RECIENTES_N > 0 and not LECTURAS_UNICAS
+
+_ESTADOS = list(models.EstadoLecturaEnum)
+_INDICE_ESTADO = {e: i for i, e in enumerate(_ESTADOS)}
+_EPOCA = datetime(1970, 1, 1)
+_MICRO = timedelta(microseconds=1)
+_NULO = -(2 ** 63)   # ultimo_en vacío
+
+
+def _a_micro(momento: datetime | None) -> int:
+    if momento is None:
+        return _NULO
+    if momento.tzinfo:
+        momento = momento.astimezone().replace(tzinfo=None)
+    return (momento - _EPOCA) // _MICRO
+
+
+def _de_micro(us: int) -> datetime | None:
+    return None if us == _NULO else _EPOCA + us * _MICRO
+
+
+class Fila:
+    """Lectura del anillo con la misma forma que las filas de mediciones.consulta_lecturas."""
+
+    __slots__ = ("id", "valor", "estado", "creado_en", "conteo", "ultimo_en")
+
+    def __init__(self, id, valor, estado, creado_en, conteo, ultimo_en):
+        self.id = id
+        self.valor = valor
+        self.estado = estado
+        self.creado_en = creado_en
+        self.conteo = conteo
+        self.ultimo_en = ultimo_en
+
+
+class _Anillo:
+    """Últimas filas de un usuario y sensor; la más reciente está en (inicio + n - 1) % capacidad."""
+
+    __slots__ = ("ids", "valores", "estados", "creados", "conteos", "ultimos", "inicio", "n", "completo")
+
+    def __init__(self, capacidad: int):
+        self.ids = array("q", bytes(8 * capacidad))
+        self.valores = array("d", bytes(8 * capacidad))
+        self.estados = array("b", bytes(capacidad))
+        self.creados = array("q", bytes(8 * capacidad))
+        self.conteos = array("l", [0]) * capacidad
+        self.ultimos = array("q", bytes(8 * capacidad))
+        self.inicio = 0
+        self.n = 0
+        self.completo = False   # True si no hay filas más antiguas que las del anillo
+
+    def _poner(self, i: int, f):
+        self.ids[i] = f.id
+        self.valores[i] = f.valor
+        self.estados[i] = _INDICE_ESTADO[f.estado]
+        self.creados[i] = _a_micro(f.creado_en)
+        self.conteos[i] = f.conteo or 1
+        self.ultimos[i] = _a_micro(f.ultimo_en)
+
+    def _ultimo(self) -> int:
+        return (self.inicio + self.n - 1) % len(self.ids)
+
+    def _buscar(self, id_: int) -> int | None:
+        capacidad = len(self.ids)
+        for k in range(1, self.n + 1):
+            i = (self.inicio + self.n - k) % capacidad
+            if self.ids[i] == id_:
+                return i
+        return None
+
+    def agregar(self, f) -> bool:
+        """Agrega f como la más reciente, o la reemplaza si ya está (racha extendida).
+
+        False si f queda en medio del anillo sin estar en él: el anillo ya no
+        coincide con la BD.
+        """
+        capacidad = len(self.ids)
+        if self.n:
+            i = self._buscar(f.id)
+            if i is not None:
+                self._poner(i, f)
+                return True
+            orden = (_a_micro(f.creado_en), f.id)
+            if orden <= (self.creados[self._ultimo()], self.ids[self._ultimo()]):
+                # Anterior a todo el anillo: ya no entraba en él
+                return not self.completo and orden < (self.creados[self.inicio], self.ids[self.inicio])
+        if self.n < capacidad:
+            self._poner((self.inicio + self.n) % capacidad, f)
+            self.n += 1
+        else:
+            # Lleno: pisa la más antigua
+            self._poner(self.inicio, f)
+            self.inicio = (self.inicio + 1) % capacidad
+            self.completo = False
+        return True
+
+    def ultimas(self, limite: int) -> list[Fila]:
+        capacidad = len(self.ids)
+        filas = []
+        for k in range(1, min(limite, self.n) + 1):
+            i = (self.inicio + self.n - k) % capacidad
+            filas.append(Fila(
+                self.ids[i], self.valores[i], _ESTADOS[self.estados[i]],
+                _de_micro(self.creados[i]), self.conteos[i], _de_micro(self.ultimos[i]),
+            ))
+        return filas
+
+
+_lock = threading.Lock()
+_anillos = {}    # (usuario_id, sensor_codigo) -> _Anillo
+_versiones = {}  # usuario_id -> cambios aplicados (para no cargar un anillo con una consulta vieja)
+_generacion = 0  # invalidaciones globales
+_aciertos = 0
+_fallos = 0
+
+
+# ----------- CONSULTAS -----------
+
+def ultimas(usuario_id: int, sensor_codigo: str, limite: int | None) -> list[Fila] | None:
+    """Las limite filas más recientes (todas sin limite), o None si hay que ir a la BD."""
+    global _aciertos, _fallos
+    if not ACTIVO:
+        return None
+    with _lock:
+        anillo = _anillos.get((usuario_id, sensor_codigo))
+        if anillo is None or ((limite is None or limite > anillo.n) and not anillo.completo):
+            _fallos += 1
+            return None
+        _aciertos += 1
+        return anillo.ultimas(limite or anillo.n)
+
+
+def version(usuario_id: int) -> tuple:
+    """Tomarla antes de la consulta SQL que se pasa a cargar()."""
+    return _generacion, _versiones.get(usuario_id, 0)
+
+
+def cargar(usuario_id: int, sensor_codigo: str, filas: list, version_previa: tuple, completo: bool):
+    """Llena el anillo con filas de la BD (de la más reciente a la más antigua).
+
+    completo indica que la consulta no tenía límite o devolvió menos filas que
+    él. Si entre version() y aquí se aplicó una ingesta para el usuario, la
+    consulta puede no incluirla y no se carga nada.
+    """
+    if not ACTIVO:
+        return
+    anillo = _Anillo(RECIENTES_N)
+    if not all(anillo.agregar(f) for f in reversed(filas[:RECIENTES_N])):
+        return
+    anillo.completo = completo and len(filas) <= RECIENTES_N
+    with _lock:
+        if version(usuario_id) == version_previa:
+            _anillos[(usuario_id, sensor_codigo)] = anillo
+
+
+# ----------- INGESTA -----------
+
+def marcar(db: Session, destinatarios: dict) -> dict:
+    """Antes de insertar, para los sensores con anillos cargados: sensor -> (máximo id, ids a releer).
+
+    Los ids a releer son las rachas abiertas de banda muerta de los
+    destinatarios, que la ingesta puede extender sin crear fila.
+    """
+    if not ACTIVO:
+        return {}
+    with _lock:
+        cargados = {s for _, s in _anillos}
+    return {
+        s: (db.query(func.max(TABLAS_LECTURA[s].id)).scalar() or 0, deadband.abiertas(TABLAS_LECTURA[s], usuarios))
+        for s, usuarios in destinatarios.items() if s in cargados
+    }
+
+
+def leer(db: Session, marcas: dict, destinatarios: dict) -> dict:
+    """Después de insertar, en la misma transacción: sensor -> filas nuevas o extendidas de los destinatarios."""
+    nuevas = {}
+    for sensor_codigo, (maximo, abiertas) in marcas.items():
+        t = TABLAS_LECTURA[sensor_codigo]
+        condicion = t.id > maximo
+        if abiertas:
+            condicion = or_(condicion, t.id.in_(abiertas))
+        nuevas[sensor_codigo] = db.query(
+            t.id, t.usuario_id, t.valor, t.estado, t.creado_en, t.conteo, t.ultimo_en
+        ).filter(t.usuario_id.in_(list(destinatarios[sensor_codigo])), condicion).order_by(t.id).all()
+    return nuevas
+
+
+def aplicar(nuevas: dict, destinatarios: dict):
+    """Tras el commit: agrega las filas leídas a los anillos cargados.
+
+    Los anillos de destinatarios sin filas leídas (el sensor no estaba marcado)
+    o con filas fuera de orden se descartan.
+    """
+    if not ACTIVO:
+        return
+    with _lock:
+        for sensor_codigo, usuarios in destinatarios.items():
+            por_usuario = {}
+            for f in nuevas.get(sensor_codigo, ()):
+                por_usuario.setdefault(f.usuario_id, []).append(f)
+            for usuario_id in usuarios:
+                _versiones[usuario_id] = _versiones.get(usuario_id, 0) + 1
+                clave = (usuario_id, sensor_codigo)
+                anillo = _anillos.get(clave)
+                if anillo is None:
+                    continue
+                if sensor_codigo not in nuevas or not all(anillo.agregar(f) for f in por_usuario.get(usuario_id, ())):
+                    del _anillos[clave]
+
+
+def invalidar(usuario_id: int | None = None, sensor_codigo: str | None = None):
+    """Descarta los anillos del usuario y/o sensor (todos sin argumentos) tras cambios que no son agregar al final."""
+    global _generacion
+    with _lock:
+        for clave in [c for c in _anillos if usuario_id in (None, c[0]) and sensor_codigo in (None, c[1])]:
+            del _anillos[clave]
+        if usuario_id is None:
+            _generacion += 1
+        else:
+            _versiones[usuario_id] = _versiones.get(usuario_id, 0) + 1
+
+
+def estado() -> dict:
+    return {
+        "activo": ACTIVO,
+        "filas_por_anillo": RECIENTES_N,
+        "anillos": len(_anillos),
+        "aciertos": _aciertos,
+        "fallos": _fallos,
+    }
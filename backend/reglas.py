@@ -0,0 +1,178 @@
+"""Reglas de ingesta precompiladas: umbrales, triggers y preferencias de notificación.
+
+La ingesta necesitaba por cada lectura la ConfiguracionSistema (umbrales y
+triggers) y la ConfiguracionNotificaciones del usuario. Aquí se compila todo en
+una instantánea inmutable y versionada que se reconstruye solo cuando escriben
+/configuracion-sistema o los endpoints de configuración de notificaciones, de
+modo que clasificar la severidad y decidir si notificar no consultan la BD.
+
+Las preferencias de cada usuario se guardan como máscara de bits: el bit
+(sensor * 3 + estado) indica si quiere notificaciones de ese sensor/estado.
+La instantánea también lleva el límite de ingesta por dispositivo (limitador.py)
+y el epsilon de banda muerta de cada sensor (deadband.py).
+"""
+import threading
+
+from sqlalchemy.orm import Session
+
+import models
+from database import SessionLocal
+
+SENSORES = ("mq135", "mq4", "mq7")
+ESTADOS = ("bueno", "advertencia", "malo")
+
+# Campo de ConfiguracionNotificaciones que corresponde a cada estado
+_SUFIJO_FLAG = {"bueno": "good", "advertencia": "warning", "malo": "bad"}
+
+BITS = {
+    (sensor, estado): 1 << (i * len(ESTADOS) + j)
+    for i, sensor in enumerate(SENSORES)
+    for j, estado in enumerate(ESTADOS)
+}
+
+
+def _get_thresholds(db: Session) -> dict:
+    """Obtiene umbrales globales configurados; si no existen, usa defaults."""
+    cfg = db.query(models.ConfiguracionSistema).first()
+    return {
+        "mq135_warning": float(getattr(cfg, "mq135_warning_threshold", 400) or 400),
+        "mq135_bad": float(getattr(cfg, "mq135_bad_threshold", 1000) or 1000),
+        "mq4_warning": float(getattr(cfg, "mq4_warning_threshold", 1000) or 1000),
+        "mq4_bad": float(getattr(cfg, "mq4_bad_threshold", 5000) or 5000),
+        "mq7_warning": float(getattr(cfg, "mq7_warning_threshold", 9) or 9),
+        "mq7_bad": float(getattr(cfg, "mq7_bad_threshold", 35) or 35),
+        # volumen
+        "mq135_win_h": int(getattr(cfg, "mq135_min_count_window_hours", 1) or 1),
+        "mq135_min_count": int(getattr(cfg, "mq135_min_count_threshold", 1) or 1),
+        "mq4_win_h": int(getattr(cfg, "mq4_min_count_window_hours", 1) or 1),
+        "mq4_min_count": int(getattr(cfg, "mq4_min_count_threshold", 1) or 1),
+        "mq7_win_h": int(getattr(cfg, "mq7_min_count_window_hours", 1) or 1),
+        "mq7_min_count": int(getattr(cfg, "mq7_min_count_threshold", 1) or 1),
+    }
+
+
+def mascara_notificaciones(config) -> int:
+    """Máscara de bits con las notificaciones activadas en una ConfiguracionNotificaciones."""
+    if config is None:
+        return 0
+    mascara = 0
+    for (sensor, estado), bit in BITS.items():
+        if getattr(config, f"notify_{sensor}_{_SUFIJO_FLAG[estado]}", False):
+            mascara |= bit
+    return mascara
+
+
+class Reglas:
+    """Instantánea inmutable; quien la obtiene puede usarla sin bloqueo."""
+
+    __slots__ = ("version", "umbrales", "limites", "triggers", "notificar", "ingesta", "deadband")
+
+    def __init__(self, version: int, umbrales: dict, triggers: dict, notificar: dict, ingesta: tuple = (2.0, 20), deadband: dict | None = None):
+        self.version = version
+        self.umbrales = umbrales
+        # sensor -> (advertencia, malo)
+        self.limites = {s: (umbrales[f"{s}_warning"], umbrales[f"{s}_bad"]) for s in SENSORES}
+        # sensor -> (umbral | None, tipo)
+        self.triggers = triggers
+        # usuario_id -> máscara de bits
+        self.notificar = notificar
+        # (peticiones por segundo, ráfaga) por dispositivo
+        self.ingesta = ingesta
+        # sensor -> epsilon de banda muerta (0 = guardar cada lectura)
+        self.deadband = deadband or {s: 0.0 for s in SENSORES}
+
+    def severidad(self, sensor_codigo: str, valor: float) -> str:
+        limites = self.limites.get((sensor_codigo or "").lower())
+        if limites is None:
+            return "bueno"
+        try:
+            v = float(valor)
+        except Exception:
+            return "bueno"
+        return "bueno" if v < limites[0] else ("advertencia" if v < limites[1] else "malo")
+
+    def trigger(self, sensor_codigo: str):
+        return self.triggers.get(sensor_codigo, (None, "igual"))
+
+    def debe_notificar(self, usuario_id: int, sensor_codigo: str, estado: str) -> bool:
+        bit = BITS.get((sensor_codigo, estado))
+        return bool(bit and self.notificar.get(usuario_id, 0) & bit)
+
+
+_lock = threading.Lock()
+_estado = {"reglas": None, "version": 0}
+
+
+def reconstruir(db: Session) -> Reglas:
+    """Compila la instantánea completa desde la BD y la publica."""
+    cfg = db.query(models.ConfiguracionSistema).first()
+    umbrales = _get_thresholds(db)
+    triggers = {
+        s: (
+            getattr(cfg, f"{s}_trigger_valor", None) if cfg else None,
+            getattr(cfg, f"{s}_trigger_tipo", "igual") if cfg else "igual",
+        )
+        for s in SENSORES
+    }
+    notificar = {
+        c.usuario_id: mascara_notificaciones(c)
+        for c in db.query(models.ConfiguracionNotificaciones).all()
+    }
+    ingesta = (
+        float(getattr(cfg, "ingesta_peticiones_por_seg", 2) if cfg else 2),
+        int(getattr(cfg, "ingesta_rafaga", 20) if cfg else 20),
+    )
+    deadband = {s: float(getattr(cfg, f"{s}_deadband", 0) or 0) if cfg else 0.0 for s in SENSORES}
+    with _lock:
+        _estado["version"] += 1
+        reglas = Reglas(_estado["version"], umbrales, triggers, notificar, ingesta, deadband)
+        _estado["reglas"] = reglas
+    return reglas
+
+
+def obtener(db: Session) -> Reglas:
+    """Instantánea vigente; solo consulta la BD la primera vez o tras invalidar()."""
+    reglas = _estado["reglas"]
+    if reglas is None:
+        reglas = reconstruir(db)
+    return reglas
+
+
+def obtener_en_sesion() -> Reglas:
+    """obtener() con sesión propia, para código async que no tiene una a mano."""
+    reglas = _estado["reglas"]
+    if reglas is not None:
+        return reglas
+    db = SessionLocal()
+    try:
+        return reconstruir(db)
+    finally:
+        db.close()
+
+
+def invalidar():
+    _estado["reglas"] = None
+
+
+def actualizar_usuario(usuario_id: int, config):
+    """Publica una nueva versión con las preferencias de un usuario (config None = sin notificaciones).
+
+    Llamar tras el commit. Copia el mapa de máscaras para no alterar la
+    instantánea que otros hilos puedan estar usando.
+    """
+    with _lock:
+        actual = _estado["reglas"]
+        if actual is None:
+            return  # se compilará completa en el próximo obtener()
+        notificar = dict(actual.notificar)
+        if config is None:
+            notificar.pop(usuario_id, None)
+        else:
+            notificar[usuario_id] = mascara_notificaciones(config)
+        _estado["version"] += 1
+        _estado["reglas"] = Reglas(_estado["version"], actual.umbrales, actual.triggers, notificar, actual.ingesta, actual.deadband)
+
+
+def version() -> int:
+    reglas = _estado["reglas"]
+    return reglas.version if reglas else 0
@@ -0,0 +1,185 @@
+"""Retención de lecturas crudas: se conservan RETENCION_LECTURAS_DIAS días.
+
+Las tablas lecturas_mqXX (y mediciones con LECTURAS_UNICAS) crecían sin
+límite. Con RETENCION_LECTURAS_DIAS > 0 un hilo en segundo plano borra cada
+RETENCION_INTERVALO_S las filas cuya última lectura (fin_racha: ultimo_en o
+creado_en) es anterior al horizonte. Más atrás solo quedan los agregados por
+minuto/hora/día (agregados.py), que la ingesta mantiene aparte y no se tocan,
+y, con ARCHIVO_LECTURAS=1, el archivo Parquet (archivo.py) que se escribe
+antes de borrar cada tramo.
+
+El borrado va por tramos de RETENCION_LOTE ids consecutivos, cada uno en su
+propia transacción corta, con RETENCION_PAUSA_MS entre tramos: nunca retiene
+bloqueos largos sobre las tablas en las que escribe /lecturas/device. Avanza
+desde el id más bajo y se detiene en el primer tramo sin filas vencidas; una
+lectura atrasada (backfill) con id alto puede quedar hasta que venzan las
+filas insertadas antes que ella.
+
+También se puede correr a mano (p.ej. desde cron con un solo worker):
+    python retencion.py purgar
+"""
+import argparse
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, select
+
+import archivo
+import models
+import recientes
+from database import SessionLocal
+from mediciones import TABLAS_LECTURA, fin_racha
+
+RETENCION_LECTURAS_DIAS = int(os.getenv("RETENCION_LECTURAS_DIAS", "0"))   # 0 = conservar todo
+RETENCION_LOTE = int(os.getenv("RETENCION_LOTE", "1000"))                  # ids por transacción
+RETENCION_PAUSA_MS = int(os.getenv("RETENCION_PAUSA_MS", "200"))           # pausa entre tramos
+RETENCION_INTERVALO_S = int(os.getenv("RETENCION_INTERVALO_S", "3600"))    # entre pasadas
+
+TABLAS = [*TABLAS_LECTURA.values(), models.Medicion]
+
+
+def horizonte(dias: int | None = None) -> datetime | None:
+    """Momento antes del cual las lecturas crudas ya no se conservan (None si no hay retención)."""
+    dias = RETENCION_LECTURAS_DIAS if dias is None else dias
+    if dias <= 0:
+        return None
+    return datetime.now() - timedelta(days=dias)
+
+
+def purgar_tabla(tabla, corte: datetime, lote: int = RETENCION_LOTE, pausa: float = RETENCION_PAUSA_MS / 1000, detener: threading.Event | None = None, archivar=None) -> int:
+    """Borra las filas vencidas de una tabla por tramos de ids. Devuelve cuántas borró.
+
+    Con archivar(filas), cada tramo vencido se archiva antes de borrarlo (y si
+    archivar falla, no se borra).
+    """
+    t = tabla.__table__
+    borradas = 0
+    desde = None
+    while not (detener and detener.is_set()):
+        db = SessionLocal()
+        try:
+            q = db.query(tabla.id)
+            if desde is not None:
+                q = q.filter(tabla.id > desde)
+            # Último id del tramo: los lote ids siguientes que existen (los huecos no cuentan)
+            hasta = db.query(func.max(q.order_by(tabla.id).limit(lote).subquery().c.id)).scalar()
+            if hasta is None:
+                break
+            condiciones = [t.c.id <= hasta, fin_racha(tabla) < corte]
+            if desde is not None:
+                condiciones.append(t.c.id > desde)
+            if archivar is None:
+                n = db.execute(delete(t).where(*condiciones)).rowcount
+            else:
+                filas = db.execute(select(t).where(*condiciones)).all()
+                if filas:
+                    archivar(filas)
+                    db.execute(delete(t).where(t.c.id.in_([f.id for f in filas])))
+                n = len(filas)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+        borradas += n
+        if not n:
+            # Tramo sin filas vencidas: lo que sigue es más nuevo
+            break
+        desde = hasta
+        time.sleep(pausa)
+    return borradas
+
+
+def _archivador(tabla):
+    """Con ARCHIVO_LECTURAS, función que archiva en Parquet las filas de lecturas_<sensor> antes de borrarlas."""
+    if not archivo.ARCHIVO_LECTURAS:
+        return None
+    for sensor_codigo, t in TABLAS_LECTURA.items():
+        if t is tabla:
+            return lambda filas: archivo.guardar(sensor_codigo, filas)
+    return None
+
+
+class Retencion:
+    """Hilo que aplica la retención periódicamente."""
+
+    def __init__(self, intervalo: int = RETENCION_INTERVALO_S):
+        self._intervalo = intervalo
+        self._hilo = None
+        self._detener = threading.Event()
+        self._ultima_pasada = None
+        self._ultimas_borradas = {}
+        self._errores = 0
+
+    def iniciar(self):
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._bucle, name="retencion-lecturas", daemon=True)
+        self._hilo.start()
+
+    def detener(self, timeout: float = 10.0):
+        self._detener.set()
+        if self._hilo:
+            self._hilo.join(timeout)
+
+    def purgar(self) -> dict:
+        """Una pasada sobre todas las tablas de lecturas: tabla -> filas borradas."""
+        corte = horizonte()
+        if corte is None:
+            return {}
+        borradas = {}
+        for tabla in TABLAS:
+            borradas[tabla.__tablename__] = purgar_tabla(tabla, corte, detener=self._detener, archivar=_archivador(tabla))
+        if archivo.ARCHIVO_LECTURAS:
+            archivo.compactar(corte)
+        self._ultima_pasada = datetime.now()
+        self._ultimas_borradas = borradas
+        if any(borradas.values()):
+            # Los anillos de /lecturas/me pueden tener filas que ya no están en la BD
+            recientes.invalidar()
+            print(f"[INFO] retención: borradas {borradas} (anteriores a {corte.isoformat(timespec='minutes')})")
+        return borradas
+
+    def _bucle(self):
+        while not self._detener.is_set():
+            try:
+                self.purgar()
+            except Exception as e:
+                self._errores += 1
+                print(f"[WARN] retención: pasada fallida, reintento en {self._intervalo}s: {e}")
+            self._detener.wait(self._intervalo)
+
+    def estado(self) -> dict:
+        corte = horizonte()
+        return {
+            "dias": RETENCION_LECTURAS_DIAS,
+            "horizonte": corte.isoformat() if corte else None,
+            "activo": bool(self._hilo and self._hilo.is_alive()),
+            "ultima_pasada": self._ultima_pasada.isoformat() if self._ultima_pasada else None,
+            "ultimas_borradas": self._ultimas_borradas,
+            "errores": self._errores,
+        }
+
+
+retencion = Retencion()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Retención de lecturas crudas")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    p_purgar = sub.add_parser("purgar", help="Borrar ahora las lecturas anteriores al horizonte")
+    p_purgar.add_argument("--dias", type=int, default=None, help="Días a conservar (por defecto RETENCION_LECTURAS_DIAS)")
+    args = parser.parse_args()
+
+    if args.comando == "purgar":
+        corte = horizonte(args.dias)
+        if corte is None:
+            parser.error("sin retención configurada: usar --dias o RETENCION_LECTURAS_DIAS")
+        for tabla in TABLAS:
+            print(f"{tabla.__tablename__}: {purgar_tabla(tabla, corte, archivar=_archivador(tabla))} filas borradas")
+        if archivo.ARCHIVO_LECTURAS:
+            archivo.compactar(corte)
@@ -0,0 +1,139 @@
+"""Tabla de ruteo en memoria: sensor_codigo -> usuarios que reciben sus lecturas.
+
+Un usuario recibe las lecturas de un sensor cuando lo tiene ACTIVO
+(sensores_activos) y ASIGNADO (usuarios_sensores). Los endpoints que cambian
+esas tablas actualizan el índice en el momento y, además, se reconcilia
+periódicamente contra la BD para corregir cualquier desvío (otros procesos,
+cambios manuales en la BD, etc.).
+
+También guarda el id de la sesión de captura activa de cada (usuario, sensor)
+para que la ingesta actualice los contadores sin buscarla en cada lote.
+"""
+import os
+import threading
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy.orm import Session
+
+import models
+
+RUTEO_RECONCILIAR_SEGUNDOS = int(os.getenv("RUTEO_RECONCILIAR_SEGUNDOS", "60"))
+
+_lock = threading.Lock()
+_ruteo = {
+    "last_fetch": None,
+    "activos": defaultdict(set),    # sensor_codigo -> {usuario_id}
+    "asignados": defaultdict(set),  # sensor_codigo -> {usuario_id}
+    "sesiones": {},                 # (usuario_id, sensor_codigo) -> id de SesionCaptura activa | None
+}
+
+
+def _should_refresh() -> bool:
+    if _ruteo["last_fetch"] is None:
+        return True
+    return (datetime.utcnow() - _ruteo["last_fetch"]).total_seconds() > RUTEO_RECONCILIAR_SEGUNDOS
+
+
+def reconciliar(db: Session):
+    """Reconstruye el índice completo desde la BD."""
+    activos = defaultdict(set)
+    for fila in db.query(models.SensoresActivos).all():
+        for codigo in ("mq135", "mq4", "mq7"):
+            if getattr(fila, f"{codigo}_activo", False):
+                activos[codigo].add(fila.usuario_id)
+
+    asignados = defaultdict(set)
+    for codigo, usuario_id in db.query(models.Sensor.codigo, models.UsuarioSensor.usuario_id).join(
+        models.UsuarioSensor, models.UsuarioSensor.sensor_id == models.Sensor.id
+    ).all():
+        asignados[codigo].add(usuario_id)
+
+    with _lock:
+        _ruteo["activos"] = activos
+        _ruteo["asignados"] = asignados
+        _ruteo["sesiones"] = {}  # se vuelven a cargar bajo demanda
+        _ruteo["last_fetch"] = datetime.utcnow()
+
+
+def invalidar():
+    _ruteo["last_fetch"] = None
+
+
+def destinatarios(db: Session, codigos) -> dict[str, list[int]]:
+    """Usuarios con cada sensor activo y asignado. Sin consultas salvo al reconciliar."""
+    if _should_refresh():
+        reconciliar(db)
+    with _lock:
+        return {
+            c: sorted(_ruteo["activos"][c] & _ruteo["asignados"][c])
+            for c in set(codigos)
+        }
+
+
+def sesiones_activas(db: Session, claves) -> dict[tuple, int]:
+    """Id de la sesión de captura activa por (usuario_id, sensor_codigo).
+
+    Solo consulta la BD por las claves que aún no están en caché (una consulta
+    para todas); las que no tienen sesión activa se recuerdan como None.
+    """
+    claves = set(claves)
+    with _lock:
+        faltan = [k for k in claves if k not in _ruteo["sesiones"]]
+    if faltan:
+        encontradas = {}
+        for id_, usuario_id, sensor_codigo in db.query(
+            models.SesionCaptura.id, models.SesionCaptura.usuario_id, models.SesionCaptura.sensor_codigo
+        ).filter(
+            models.SesionCaptura.usuario_id.in_({u for u, _ in faltan}),
+            models.SesionCaptura.sensor_codigo.in_({c for _, c in faltan}),
+            models.SesionCaptura.activo == True
+        ).order_by(models.SesionCaptura.id.desc()).all():
+            # Si hubiera más de una activa, cuenta la más reciente
+            encontradas.setdefault((usuario_id, sensor_codigo), id_)
+        with _lock:
+            for k in faltan:
+                _ruteo["sesiones"][k] = encontradas.get(k)
+    with _lock:
+        return {k: _ruteo["sesiones"][k] for k in claves if _ruteo["sesiones"].get(k)}
+
+
+# ----------- ACTUALIZACIONES EN CALIENTE (llamar tras el commit) -----------
+
+def marcar_activo(usuario_id: int, sensor_codigo: str, activo: bool):
+    with _lock:
+        _ruteo["sesiones"].pop((usuario_id, sensor_codigo), None)
+        if activo:
+            _ruteo["activos"][sensor_codigo].add(usuario_id)
+        else:
+            _ruteo["activos"][sensor_codigo].discard(usuario_id)
+
+
+def asignar(usuario_id: int, sensor_codigo: str):
+    with _lock:
+        _ruteo["asignados"][sensor_codigo].add(usuario_id)
+
+
+def desasignar(usuario_id: int, sensor_codigo: str):
+    with _lock:
+        _ruteo["asignados"][sensor_codigo].discard(usuario_id)
+        _ruteo["activos"][sensor_codigo].discard(usuario_id)
+        _ruteo["sesiones"].pop((usuario_id, sensor_codigo), None)
+
+
+def reemplazar_asignaciones(usuario_id: int, codigos):
+    codigos = set(codigos)
+    with _lock:
+        for codigo, usuarios in _ruteo["asignados"].items():
+            if codigo not in codigos:
+                usuarios.discard(usuario_id)
+        for codigo in codigos:
+            _ruteo["asignados"][codigo].add(usuario_id)
+
+
+def olvidar_usuario(usuario_id: int):
+    with _lock:
+        for usuarios in list(_ruteo["activos"].values()) + list(_ruteo["asignados"].values()):
+            usuarios.discard(usuario_id)
+        for clave in [k for k in _ruteo["sesiones"] if k[0] == usuario_id]:
+            del _ruteo["sesiones"][clave]
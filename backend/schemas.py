@@ -1,6 +1,7 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
 from typing import Optional
 import datetime
+import os
 from enum import Enum
 
 # Roles posibles
@@ -68,7 +69,7 @@ class EstadoLecturaEnum(str, Enum):
 
 class LecturaCreate(BaseModel):
     sensor_codigo: str
-    valor: float
+    valor: float = Field(allow_inf_nan=False)
     estado: EstadoLecturaEnum
 
 
@@ -76,6 +77,26 @@ class LecturaCreateDevice(BaseModel):
     lecturas: list[LecturaCreate]
 
 
+BACKFILL_MAX = int(os.getenv("BACKFILL_MAX", "20000"))  # lecturas por petición de backfill
+
+
+class LecturaBackfill(BaseModel):
+    sensor_codigo: str
+    valor: float = Field(allow_inf_nan=False)
+    estado: Optional[EstadoLecturaEnum] = None
+    creado_en: datetime.datetime
+
+
+class LecturaBackfillDevice(BaseModel):
+    """Lecturas que el dispositivo guardó sin conexión, con su hora original."""
+    lecturas: list[LecturaBackfill] = Field(min_length=1, max_length=BACKFILL_MAX)
+
+
+class LecturaStreamDevice(LecturaCreateDevice):
+    """Trama JSON del canal WebSocket; seq identifica el lote para acks e idempotencia."""
+    seq: Optional[int] = None
+
+
 class LecturaOut(BaseModel):
     id: int
     sensor_id: int
@@ -88,6 +109,60 @@ class LecturaOut(BaseModel):
         from_attributes = True
 
 
+# --------- Dispositivos ---------
+
+class DispositivoCreate(BaseModel):
+    codigo: str = Field(min_length=1, max_length=64)
+    nombre: Optional[str] = Field(default=None, max_length=100)
+
+
+class DispositivoUpdate(BaseModel):
+    nombre: Optional[str] = Field(default=None, max_length=100)
+    activo: Optional[bool] = None
+
+
+class DispositivoOut(BaseModel):
+    id: int
+    codigo: str
+    nombre: Optional[str] = None
+    activo: bool
+    creado_en: Optional[datetime.datetime] = None
+
+    class Config:
+        from_attributes = True
+
+
+class DispositivoConClave(DispositivoOut):
+    """Solo se devuelve al crear o rotar: la clave no se puede recuperar después."""
+    api_key: str
+
+
+class CalibracionUpdate(BaseModel):
+    adc_max: Optional[int] = Field(default=None, ge=1, le=65535)
+    vref: Optional[float] = Field(default=None, gt=0)
+    vc: Optional[float] = Field(default=None, gt=0)
+    rl: Optional[float] = Field(default=None, gt=0)
+    r0: Optional[float] = Field(default=None, gt=0)
+    a: Optional[float] = Field(default=None, gt=0)
+    b: Optional[float] = None
+    coef_temp: Optional[float] = None
+    temp_ref: Optional[float] = None
+
+
+class CalibracionOut(BaseModel):
+    sensor_codigo: str
+    adc_max: int
+    vref: float
+    vc: float
+    rl: float
+    r0: float
+    a: float
+    b: float
+    coef_temp: float
+    temp_ref: float
+    personalizada: bool
+
+
 # --------- Sesiones de captura ---------
 
 class SesionOut(BaseModel):
@@ -132,6 +207,9 @@ class NotificacionOut(BaseModel):
     leida: bool
     creado_en: datetime.datetime
     leido_en: Optional[datetime.datetime] = None
+    conteo: int = 1
+    primera_en: Optional[datetime.datetime] = None
+    ultima_en: Optional[datetime.datetime] = None
 
     class Config:
         from_attributes = True
@@ -186,6 +264,11 @@ class ConfiguracionSistemaOut(BaseModel):
     mq4_trigger_tipo: Optional[str] = None
     mq7_trigger_valor: Optional[float] = None
     mq7_trigger_tipo: Optional[str] = None
+    ingesta_peticiones_por_seg: Optional[float] = None
+    ingesta_rafaga: Optional[int] = None
+    mq135_deadband: Optional[float] = None
+    mq4_deadband: Optional[float] = None
+    mq7_deadband: Optional[float] = None
     # ya no exponemos flags de inclusión ni reglas de volumen
 
     class Config:
@@ -205,6 +288,11 @@ class ConfiguracionSistemaUpdate(BaseModel):
     mq4_trigger_tipo: Optional[str] = None
     mq7_trigger_valor: Optional[float] = None
     mq7_trigger_tipo: Optional[str] = None
+    ingesta_peticiones_por_seg: Optional[float] = Field(default=None, ge=0)
+    ingesta_rafaga: Optional[int] = Field(default=None, ge=1)
+    mq135_deadband: Optional[float] = Field(default=None, ge=0)
+    mq4_deadband: Optional[float] = Field(default=None, ge=0)
+    mq7_deadband: Optional[float] = Field(default=None, ge=0)
     # ya no recibimos flags de inclusión ni reglas de volumen
 
 # -------- Configuración por usuario --------
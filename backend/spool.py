@@ -0,0 +1,317 @@
+"""Spool local y durable para la ingesta de dispositivos.
+
+Con INGESTA_SPOOL=1, cada lote aceptado por /lecturas/device se agrega primero
+a un archivo de solo-anexado (una línea JSON por petición) y se confirma con
+fsync agrupado: la primera petición que necesita sincronizar hace el fsync por
+todas las que escribieron antes que ella. Un reproductor en segundo plano
+vacía el spool hacia las tablas de lecturas en lotes grandes cuando la BD
+responde, guardando el avance (offset) en un archivo aparte.
+
+La entrega es "al menos una vez": si el proceso cae entre el commit y la
+escritura del offset, ese tramo se reproduce de nuevo al reiniciar (los
+lotes con X-Lote-Id se descartan entonces por idempotencia).
+
+Si la BD no responde (o falla por cualquier error que no sea de datos) el
+tramo se reintenta completo con espera creciente, sin límite: el spool existe
+justamente para aguantar esas caídas. Solo un tramo que falla por un error de
+datos o de integridad se reproduce registro por registro: los que vuelven a
+fallar por datos pasan al archivo de descartados (ingesta.descartados, con el
+error) y el resto del spool sigue avanzando. `python spool.py rescatar` los
+vuelve a anexar al spool.
+
+SPOOL_DIR es obligatorio con INGESTA_SPOOL=1 y debe estar en un volumen
+persistente: en un contenedor efímero (Railway sin volumen) el spool se pierde
+en cada despliegue.
+
+Uso por consola:
+    python spool.py estado
+    python spool.py mostrar [-n 20]
+    python spool.py reproducir   (con el servidor detenido, para no reproducir dos veces)
+    python spool.py rescatar     (reanexa los registros descartados)
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import exc
+
+INGESTA_SPOOL = os.getenv("INGESTA_SPOOL", "0") == "1"
+SPOOL_DIR = os.getenv("SPOOL_DIR")   # obligatorio con INGESTA_SPOOL=1 (volumen persistente)
+SPOOL_LOTE_MAX = int(os.getenv("SPOOL_LOTE_MAX", "20000"))                    # lecturas por transacción al reproducir
+SPOOL_COMPACTAR_BYTES = int(os.getenv("SPOOL_COMPACTAR_BYTES", str(64 * 1024 * 1024)))
+
+
+# Errores del contenido de un registro: lo único que se descarta. Cualquier otro
+# (conexión, BD caída, esquema) se reintenta sin descartar nada.
+_DE_DATOS = (exc.DataError, exc.IntegrityError, ValueError, TypeError, KeyError, IndexError)
+
+
+def _serializar(lectura) -> list:
+    """[sensor_codigo, valor, estado] más el timestamp epoch si la lectura lo trae."""
+    fila = [lectura[0], lectura[1], lectura[2]]
+    if len(lectura) > 3 and lectura[3] is not None:
+        fila.append(lectura[3].timestamp())
+    return fila
+
+
+def _peticion(registro: dict) -> tuple:
+    """Registro del spool -> (lecturas, lote | None) para la ingesta."""
+    # Cada lectura conserva su timestamp propio o, si no trae, el de aceptación
+    return (
+        [(l[0], l[1], l[2], datetime.fromtimestamp(l[3] if len(l) > 3 else registro["t"])) for l in registro["l"]],
+        (registro["d"], registro["s"]) if "d" in registro else None,
+    )
+
+
+class Spool:
+    def __init__(self, directorio: str | None = SPOOL_DIR):
+        # Sin SPOOL_DIR (solo para la CLI en desarrollo) se usa backend/spool
+        self.directorio = directorio or os.path.join(os.path.dirname(os.path.abspath(__file__)), "spool")
+        self.ruta = os.path.join(self.directorio, "ingesta.spool")
+        self.ruta_offset = os.path.join(self.directorio, "ingesta.offset")
+        self.ruta_descartados = os.path.join(self.directorio, "ingesta.descartados")
+        self._f = None
+        self._cond = threading.Condition()
+        self._escritas = 0        # líneas escritas en el archivo
+        self._sincronizadas = 0   # líneas cubiertas por el último fsync
+        self._sincronizando = False
+        self._hilo = None
+        self._detener = threading.Event()
+        self._errores = 0
+        self._descartados = 0
+
+    # ----------- escritura -----------
+    def _abrir(self):
+        if self._f is None:
+            os.makedirs(self.directorio, exist_ok=True)
+            self._f = open(self.ruta, "a", encoding="utf-8")
+
+    def agregar(self, lecturas: list, lote: tuple | None = None):
+        """Anexa un lote y vuelve cuando está en disco (fsync agrupado)."""
+        registro = {"t": time.time(), "l": [_serializar(l) for l in lecturas]}
+        if lote is not None:
+            registro["d"], registro["s"] = lote
+        linea = json.dumps(registro, separators=(",", ":")) + "\n"
+        with self._cond:
+            self._abrir()
+            self._f.write(linea)
+            self._escritas += 1
+            mia = self._escritas
+            while self._sincronizadas < mia:
+                if self._sincronizando:
+                    self._cond.wait()
+                    continue
+                # Esta petición lidera el fsync de todo lo escrito hasta ahora
+                self._sincronizando = True
+                objetivo = self._escritas
+                self._f.flush()
+                fd = self._f.fileno()
+                self._cond.release()
+                try:
+                    os.fsync(fd)
+                finally:
+                    self._cond.acquire()
+                    self._sincronizando = False
+                self._sincronizadas = objetivo
+                self._cond.notify_all()
+
+    # ----------- lectura -----------
+    def _leer_offset(self) -> int:
+        try:
+            with open(self.ruta_offset, encoding="utf-8") as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _guardar_offset(self, offset: int):
+        tmp = self.ruta_offset + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.ruta_offset)
+
+    def pendientes(self, offset: int | None = None, max_lecturas: int | None = None):
+        """Registros completos desde offset: (lista de registros, offset siguiente)."""
+        offset = self._leer_offset() if offset is None else offset
+        registros = []
+        total = 0
+        if not os.path.exists(self.ruta):
+            return registros, offset
+        with open(self.ruta, "rb") as f:
+            f.seek(offset)
+            for linea in f:
+                if not linea.endswith(b"\n"):
+                    break  # línea a medio escribir: se leerá en la próxima vuelta
+                offset += len(linea)
+                try:
+                    registros.append(json.loads(linea))
+                except ValueError:
+                    print(f"[WARN] spool: registro corrupto ignorado en offset {offset - len(linea)}")
+                    continue
+                total += len(registros[-1]["l"])
+                if max_lecturas and total >= max_lecturas:
+                    break
+        return registros, offset
+
+    def reproducir_una_vez(self, max_lecturas: int = SPOOL_LOTE_MAX) -> int:
+        """Lleva a la BD el siguiente tramo del spool. Devuelve lecturas reproducidas."""
+        from ingesta import procesar_peticiones_en_sesion
+
+        registros, siguiente = self.pendientes(max_lecturas=max_lecturas)
+        if not registros:
+            self._compactar()
+            return 0
+        try:
+            procesar_peticiones_en_sesion([_peticion(r) for r in registros])
+        except _DE_DATOS as e:
+            print(f"[WARN] spool: el tramo falló por sus datos, se reproduce registro por registro: {e}")
+            self._aislar(registros)
+        self._guardar_offset(siguiente)
+        return sum(len(r["l"]) for r in registros)
+
+    def _aislar(self, registros: list):
+        """Guarda cada registro por separado; los que fallan por sus datos van a ingesta.descartados.
+
+        Cualquier otro error se propaga sin avanzar el offset: el tramo se
+        reintenta completo (lo ya guardado se repite, como en "al menos una vez").
+        """
+        from ingesta import procesar_peticiones_en_sesion
+
+        for r in registros:
+            try:
+                procesar_peticiones_en_sesion([_peticion(r)])
+            except _DE_DATOS as e:
+                self._descartar(r, e)
+
+    def _descartar(self, registro: dict, error: Exception):
+        self._descartados += 1
+        print(f"[ERROR] spool: registro descartado ({len(registro['l'])} lecturas): {error}")
+        linea = json.dumps({**registro, "error": str(error)[:500], "descartado_en": time.time()}, separators=(",", ":")) + "\n"
+        with open(self.ruta_descartados, "a", encoding="utf-8") as f:
+            f.write(linea)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def rescatar(self) -> int:
+        """Vuelve a anexar al spool los registros descartados. Devuelve cuántos."""
+        if not os.path.exists(self.ruta_descartados):
+            return 0
+        with open(self.ruta_descartados, encoding="utf-8") as f:
+            registros = [json.loads(linea) for linea in f if linea.strip()]
+        with self._cond:
+            self._abrir()
+            for r in registros:
+                r.pop("error", None)
+                r.pop("descartado_en", None)
+                self._f.write(json.dumps(r, separators=(",", ":")) + "\n")
+            self._f.flush()
+            os.fsync(self._f.fileno())
+        os.remove(self.ruta_descartados)
+        return len(registros)
+
+    def _compactar(self):
+        """Trunca el spool si ya se reprodujo completo y creció demasiado."""
+        with self._cond:
+            if not os.path.exists(self.ruta):
+                return
+            tamano = os.path.getsize(self.ruta)
+            if self._sincronizando or tamano < SPOOL_COMPACTAR_BYTES or self._leer_offset() < tamano:
+                return
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+            with open(self.ruta, "w", encoding="utf-8") as f:
+                f.flush()
+                os.fsync(f.fileno())
+            self._guardar_offset(0)
+
+    # ----------- reproductor en segundo plano -----------
+    def iniciar(self):
+        if not SPOOL_DIR:
+            raise RuntimeError("INGESTA_SPOOL=1 requiere SPOOL_DIR en un volumen persistente")
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._bucle, name="spool-reproductor", daemon=True)
+        self._hilo.start()
+
+    def detener(self, timeout: float = 10.0):
+        self._detener.set()
+        if self._hilo:
+            self._hilo.join(timeout)
+        with self._cond:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+
+    def _bucle(self):
+        espera = 0.5
+        while not self._detener.is_set():
+            try:
+                n = self.reproducir_una_vez()
+                espera = 0.05 if n else 0.5
+            except Exception as e:
+                # BD lenta o caída: reintentar con espera creciente
+                self._errores += 1
+                espera = min(30.0, max(1.0, espera * 2))
+                print(f"[WARN] spool: no se pudo reproducir, reintento en {espera:.0f}s: {e}")
+            self._detener.wait(espera)
+
+    def estado(self) -> dict:
+        tamano = os.path.getsize(self.ruta) if os.path.exists(self.ruta) else 0
+        offset = self._leer_offset()
+        return {
+            "archivo": self.ruta,
+            "bytes": tamano,
+            "offset": offset,
+            "bytes_pendientes": max(0, tamano - offset),
+            "reproductor_activo": bool(self._hilo and self._hilo.is_alive()),
+            "errores": self._errores,
+            "descartados": self._descartados,
+            "archivo_descartados": self.ruta_descartados if os.path.exists(self.ruta_descartados) else None,
+        }
+
+
+spool = Spool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspeccionar y reproducir el spool de ingesta")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    sub.add_parser("estado", help="Tamaño, offset y registros pendientes")
+    p_mostrar = sub.add_parser("mostrar", help="Mostrar registros pendientes")
+    p_mostrar.add_argument("-n", type=int, default=20)
+    sub.add_parser("reproducir", help="Vaciar el spool hacia la BD ahora")
+    sub.add_parser("rescatar", help="Reanexar al spool los registros descartados")
+    args = parser.parse_args()
+
+    if args.comando == "estado":
+        registros, _ = spool.pendientes()
+        info = spool.estado()
+        info.pop("reproductor_activo")
+        info.pop("errores")
+        info.pop("descartados")
+        info["registros_pendientes"] = len(registros)
+        info["lecturas_pendientes"] = sum(len(r["l"]) for r in registros)
+        print(json.dumps(info, indent=2, ensure_ascii=False))
+    elif args.comando == "mostrar":
+        registros, _ = spool.pendientes()
+        for r in registros[:args.n]:
+            print(datetime.fromtimestamp(r["t"]).isoformat(), json.dumps(r["l"], ensure_ascii=False))
+        if len(registros) > args.n:
+            print(f"... {len(registros) - args.n} registros más")
+    elif args.comando == "reproducir":
+        total = 0
+        while True:
+            n = spool.reproducir_una_vez()
+            if not n:
+                break
+            total += n
+            print(f"Reproducidas {total} lecturas")
+        print(f"Spool vacío ({total} lecturas reproducidas)")
+    elif args.comando == "rescatar":
+        print(f"{spool.rescatar()} registros reanexados al spool")
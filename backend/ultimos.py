@@ -0,0 +1,234 @@
+"""Último valor de cada sensor, y de cada usuario y sensor (tabla sensor_ultimo_valor).
+
+/reportes/sensores buscaba la última lectura de cada sensor con un ORDER BY
+creado_en DESC sobre toda la tabla de lecturas. Ahora la ingesta guarda, en la
+misma transacción que las lecturas, la más reciente de cada lote por sensor
+(usuario_id 0) y por cada usuario destinatario, con un upsert que solo pisa la
+fila si la lectura es más nueva (las del spool o el backfill pueden llegar
+tarde). Los reportes leen una caché en memoria de esa tabla chica, que se
+actualiza tras cada commit y se recarga cada ULTIMOS_RECARGAR_SEGUNDOS por si
+otro proceso también ingiere.
+
+ultimo_en es el momento de la última lectura (con banda muerta, el de la
+última lectura de la racha). La retención no lo toca: un sensor sin lecturas
+recientes sigue mostrando la última que se vio.
+
+Para cargar los valores a partir de las lecturas ya guardadas:
+    python ultimos.py reconstruir
+"""
+import argparse
+import os
+import threading
+from datetime import datetime
+
+from sqlalchemy import case
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.orm import Session
+
+import models
+from mediciones import LECTURAS_UNICAS, TABLAS_LECTURA, consulta_lecturas, fin_racha
+
+ULTIMOS_RECARGAR_SEGUNDOS = int(os.getenv("ULTIMOS_RECARGAR_SEGUNDOS", "60"))
+
+SENSOR = 0  # usuario_id de la fila de cada sensor (cualquier usuario)
+
+_ESTADOS = {e.value: e for e in models.EstadoLecturaEnum}
+
+_lock = threading.Lock()
+_cache = {
+    "last_fetch": None,
+    "valores": {},  # (usuario_id, sensor_codigo) -> {"valor", "estado", "ultimo_en"}
+}
+
+
+def _sin_tz(momento: datetime) -> datetime:
+    return momento.astimezone().replace(tzinfo=None) if momento.tzinfo else momento
+
+
+def acumular(ultimos: dict, clave: tuple, valor: float, estado: str, momento: datetime):
+    """Guarda en ultimos[clave] la lectura si es la más reciente vista (a igual momento, la última)."""
+    momento = _sin_tz(momento)
+    actual = ultimos.get(clave)
+    if actual is None or momento >= actual["ultimo_en"]:
+        ultimos[clave] = {"valor": valor, "estado": estado, "ultimo_en": momento}
+
+
+def guardar(db: Session, ultimos: dict):
+    """Upsert de {(usuario_id, sensor_codigo): lectura} en orden de clave. No hace commit."""
+    if not ultimos:
+        return
+    filas = [
+        {"usuario_id": u, "sensor_codigo": s, "valor": l["valor"], "estado": _ESTADOS[l["estado"]], "ultimo_en": l["ultimo_en"]}
+        for (u, s), l in sorted(ultimos.items())
+    ]
+    t = models.UltimoValorSensor.__table__
+    if db.get_bind().dialect.name == "mysql":
+        stmt = mysql.insert(t)
+        mas_nueva = stmt.inserted.ultimo_en >= t.c.ultimo_en
+        # MySQL asigna en orden: ultimo_en va al final para que las condiciones vean el valor anterior
+        stmt = stmt.on_duplicate_key_update([
+            (c, case((mas_nueva, stmt.inserted[c]), else_=t.c[c])) for c in ("valor", "estado", "ultimo_en")
+        ])
+    else:
+        # SQLite (desarrollo): ON CONFLICT ... WHERE
+        stmt = sqlite.insert(t)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["usuario_id", "sensor_codigo"],
+            set_={c: stmt.excluded[c] for c in ("valor", "estado", "ultimo_en")},
+            where=stmt.excluded.ultimo_en >= t.c.ultimo_en,
+        )
+    db.execute(stmt, filas)
+
+
+def actualizar(ultimos: dict):
+    """Tras el commit: pasa a la caché las lecturas que son más nuevas que las que tiene."""
+    with _lock:
+        valores = _cache["valores"]
+        for clave, l in ultimos.items():
+            actual = valores.get(clave)
+            if actual is None or l["ultimo_en"] >= actual["ultimo_en"]:
+                valores[clave] = l
+
+
+# ----------- CONSULTAS -----------
+
+def necesita_recarga() -> bool:
+    if _cache["last_fetch"] is None:
+        return True
+    return (datetime.utcnow() - _cache["last_fetch"]).total_seconds() > ULTIMOS_RECARGAR_SEGUNDOS
+
+
+def recargar(db: Session):
+    valores = {
+        (f.usuario_id, f.sensor_codigo): {"valor": f.valor, "estado": f.estado.value, "ultimo_en": _sin_tz(f.ultimo_en)}
+        for f in db.query(models.UltimoValorSensor).all()
+    }
+    with _lock:
+        _cache["valores"] = valores
+        _cache["last_fetch"] = datetime.utcnow()
+
+
+def invalidar():
+    """Forzar recarga en la próxima consulta (llamar tras el commit)."""
+    _cache["last_fetch"] = None
+
+
+def obtener(db: Session, sensor_codigo: str, usuario_id: int = SENSOR) -> dict | None:
+    """Última lectura del sensor (de cualquier usuario, o del usuario dado), o None si nunca llegó una."""
+    if necesita_recarga():
+        recargar(db)
+    with _lock:
+        return _cache["valores"].get((usuario_id, sensor_codigo))
+
+
+# ----------- CORRECCIONES (borrados) -----------
+
+def _ultima_lectura(db: Session, sensor_codigo: str, usuario_id: int):
+    q, tabla = consulta_lecturas(db, usuario_id, sensor_codigo)
+    return q.with_entities(tabla.valor, tabla.estado, fin_racha(tabla).label("ultimo_en")).order_by(
+        tabla.creado_en.desc(), tabla.id.desc()
+    ).first()
+
+
+def _ultima_medicion(db: Session, sensor_codigo: str):
+    M = models.Medicion
+    return db.query(M.valor, M.estado, fin_racha(M).label("ultimo_en")).filter(
+        M.sensor_codigo == sensor_codigo
+    ).order_by(M.creado_en.desc(), M.id.desc()).first()
+
+
+def _recalcular_sensor(db: Session, sensor_codigo: str):
+    """La fila del sensor pasa a ser la más reciente de las filas por usuario (o se borra si no hay).
+
+    Con LECTURAS_UNICAS no todas las mediciones tienen fila por usuario: se toma
+    la última medición del sensor.
+    """
+    U = models.UltimoValorSensor
+    if LECTURAS_UNICAS:
+        mas_nueva = _ultima_medicion(db, sensor_codigo)
+    else:
+        mas_nueva = db.query(U).filter(U.sensor_codigo == sensor_codigo, U.usuario_id != SENSOR).order_by(U.ultimo_en.desc()).first()
+    fila = db.query(U).filter(U.sensor_codigo == sensor_codigo, U.usuario_id == SENSOR).first()
+    if mas_nueva is None:
+        if fila is not None:
+            db.delete(fila)
+        return
+    if fila is None:
+        fila = U(usuario_id=SENSOR, sensor_codigo=sensor_codigo)
+        db.add(fila)
+    fila.valor, fila.estado, fila.ultimo_en = mas_nueva.valor, mas_nueva.estado, mas_nueva.ultimo_en
+
+
+def recalcular(db: Session, sensor_codigo: str, usuario_id: int | None):
+    """Tras borrar lecturas del usuario en el sensor (antes del commit; luego invalidar()).
+
+    Con usuario_id None solo se recalcula la fila del sensor.
+    """
+    U = models.UltimoValorSensor
+    if usuario_id is None:
+        _recalcular_sensor(db, sensor_codigo)
+        return
+    ultima = _ultima_lectura(db, sensor_codigo, usuario_id)
+    fila = db.query(U).filter(U.sensor_codigo == sensor_codigo, U.usuario_id == usuario_id).first()
+    if ultima is None:
+        if fila is not None:
+            db.delete(fila)
+    else:
+        if fila is None:
+            fila = U(usuario_id=usuario_id, sensor_codigo=sensor_codigo)
+            db.add(fila)
+        fila.valor, fila.estado, fila.ultimo_en = ultima.valor, ultima.estado, ultima.ultimo_en
+    db.flush()
+    _recalcular_sensor(db, sensor_codigo)
+
+
+def olvidar_usuario(db: Session, usuario_id: int):
+    """Al eliminar un usuario (antes del commit; luego invalidar()). Sus lecturas se borran en cascada."""
+    U = models.UltimoValorSensor
+    db.query(U).filter(U.usuario_id == usuario_id).delete()
+    if not LECTURAS_UNICAS:
+        db.flush()
+        for sensor_codigo in TABLAS_LECTURA:
+            _recalcular_sensor(db, sensor_codigo)
+
+
+def reconstruir(db: Session) -> int:
+    """Recalcula toda la tabla desde las lecturas guardadas (una consulta indexada por usuario y sensor)."""
+    ultimos = {}
+    if LECTURAS_UNICAS:
+        # Sin copia por usuario: solo la fila de cada sensor
+        for sensor_codigo in TABLAS_LECTURA:
+            l = _ultima_medicion(db, sensor_codigo)
+            if l is not None:
+                acumular(ultimos, (SENSOR, sensor_codigo), l.valor, l.estado.value, l.ultimo_en)
+    else:
+        for sensor_codigo, tabla in TABLAS_LECTURA.items():
+            for (usuario_id,) in db.query(tabla.usuario_id).distinct().all():
+                l = _ultima_lectura(db, sensor_codigo, usuario_id)
+                acumular(ultimos, (usuario_id, sensor_codigo), l.valor, l.estado.value, l.ultimo_en)
+                acumular(ultimos, (SENSOR, sensor_codigo), l.valor, l.estado.value, l.ultimo_en)
+    db.query(models.UltimoValorSensor).delete()
+    guardar(db, ultimos)
+    db.commit()
+    invalidar()
+    return len(ultimos)
+
+
+def estado() -> dict:
+    return {"valores": len(_cache["valores"]), "recargar_segundos": ULTIMOS_RECARGAR_SEGUNDOS}
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Último valor por sensor y por usuario y sensor")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    sub.add_parser("reconstruir", help="Recalcular sensor_ultimo_valor desde las tablas de lecturas")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.comando == "reconstruir":
+            print(f"{reconstruir(db)} valores guardados")
+    finally:
+        db.close()
@@ -0,0 +1,101 @@
+"""Validación rápida de lotes JSON de dispositivos.
+
+schemas.LecturaCreateDevice crea un modelo Pydantic por lectura y el handler
+luego los recorre para armar las tuplas de la ingesta. Aquí el mismo lote se
+valida con un TypeAdapter sobre TypedDict: pydantic-core aplica las mismas
+reglas por campo pero entrega dicts sin instanciar modelos, y el estado ya
+llega como texto (use_enum_values), así que armar las tuplas es una sola
+pasada. Para lotes de miles de lecturas es ~2x más rápido
+(bench/bench_validacion.py).
+
+Si el lote es inválido se vuelve a validar con el modelo de schemas, de modo
+que el ValidationError (tipos, loc y mensajes) es exactamente el mismo que
+antes. Los modelos siguen siendo la referencia para OpenAPI.
+"""
+import datetime
+import math
+from typing import Annotated, Optional
+
+from pydantic import ConfigDict, Field, TypeAdapter, ValidationError
+from typing_extensions import NotRequired, TypedDict
+
+import schemas
+
+# NaN e infinito no son lecturas (JSON de Python los acepta como literales)
+_Valor = Annotated[float, Field(allow_inf_nan=False)]
+
+
+class _Lectura(TypedDict):
+    __pydantic_config__ = ConfigDict(use_enum_values=True)
+    sensor_codigo: str
+    valor: _Valor
+    estado: schemas.EstadoLecturaEnum
+
+
+class _Lote(TypedDict):
+    lecturas: list[_Lectura]
+
+
+class _Trama(TypedDict):
+    lecturas: list[_Lectura]
+    seq: NotRequired[Optional[int]]
+
+
+class _LecturaBackfill(TypedDict):
+    __pydantic_config__ = ConfigDict(use_enum_values=True)
+    sensor_codigo: str
+    valor: _Valor
+    estado: NotRequired[Optional[schemas.EstadoLecturaEnum]]
+    creado_en: datetime.datetime
+
+
+class _LoteBackfill(TypedDict):
+    lecturas: Annotated[list[_LecturaBackfill], Field(min_length=1, max_length=schemas.BACKFILL_MAX)]
+
+
+_ADAPTADORES = {
+    schemas.LecturaCreateDevice: TypeAdapter(_Lote),
+    schemas.LecturaStreamDevice: TypeAdapter(_Trama),
+    schemas.LecturaBackfillDevice: TypeAdapter(_LoteBackfill),
+}
+
+
+def _validar(modelo, cuerpo: bytes | str) -> dict:
+    try:
+        return _ADAPTADORES[modelo].validate_json(cuerpo)
+    except ValueError:
+        # El modelo original lanza los mismos errores que antes (o acepta el lote en algún caso límite).
+        # Lo que acepta se pasa por el adaptador para entregar los mismos tipos que el camino rápido
+        # (estado como texto, creado_en como datetime).
+        datos = modelo.model_validate_json(cuerpo).model_dump(mode="json")
+        return _ADAPTADORES[modelo].validate_python(datos)
+
+
+def lote_device(cuerpo: bytes | str) -> list[tuple]:
+    """Cuerpo de /lecturas/device -> [(sensor_codigo, valor, estado)]. Lanza ValidationError."""
+    return [(l["sensor_codigo"], l["valor"], l["estado"]) for l in _validar(schemas.LecturaCreateDevice, cuerpo)["lecturas"]]
+
+
+def trama_device(cuerpo: bytes | str) -> tuple[int | None, list[tuple]]:
+    """Trama JSON del WebSocket -> (seq | None, lecturas)."""
+    data = _validar(schemas.LecturaStreamDevice, cuerpo)
+    return data.get("seq"), [(l["sensor_codigo"], l["valor"], l["estado"]) for l in data["lecturas"]]
+
+
+def lote_backfill(cuerpo: bytes | str) -> list[tuple]:
+    """Cuerpo de /lecturas/device/backfill -> [(sensor_codigo, valor, estado | None, creado_en)]."""
+    return [
+        (l["sensor_codigo"], l["valor"], l.get("estado"), l["creado_en"])
+        for l in _validar(schemas.LecturaBackfillDevice, cuerpo)["lecturas"]
+    ]
+
+
+def errores_cuerpo(error: ValidationError) -> list[dict]:
+    """Errores para RequestValidationError, con loc bajo "body" y los NaN/inf de input como texto (no son JSON)."""
+    errores = []
+    for err in error.errors():
+        err = {**err, "loc": ("body", *err["loc"])}
+        if isinstance(err.get("input"), float) and not math.isfinite(err["input"]):
+            err["input"] = str(err["input"])
+        errores.append(err)
+    return errores